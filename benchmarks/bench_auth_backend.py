@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#
+# Shoebill benchmark: cost of creating and deleting a user, and of the
+# lookups made when checking a login, as the number of users grows,
+# JSON files vs SQLite
+#
+# Usage: python benchmarks/bench_auth_backend.py [--users 100,1000,10000]
+#            [--ops N]
+#
+
+from tempfile import mkdtemp
+import argparse
+import shutil
+import time
+
+import shoebill
+
+
+def user_data(n):
+    return {
+        "role": "editor",
+        "hash": "x" * 88,
+        "email_addr": "user%d@example.com" % n,
+        "desc": "User %d" % n,
+        "creation_date": "2020-01-01 00:00:00",
+        "last_login": "2020-01-01 00:00:00",
+    }
+
+
+def bench(store, ops):
+    """Create and delete users as Cork does
+
+    :returns: (create latencies, delete latencies) in seconds
+    """
+    created, deleted = [], []
+    for n in range(ops):
+        username = "bench-%d" % n
+        t0 = time.perf_counter()
+        store.users[username] = user_data(n)
+        store.save_users()
+        t1 = time.perf_counter()
+        store.users.pop(username)
+        store.save_users()
+        t2 = time.perf_counter()
+        created.append(t1 - t0)
+        deleted.append(t2 - t1)
+
+    return sorted(created), sorted(deleted)
+
+
+def bench_lookup(store, ops):
+    """Look up a user and compare its role level, as Cork does on each
+    authenticated request
+
+    :returns: sorted latencies in seconds
+    """
+    timings = []
+    for n in range(ops):
+        t0 = time.perf_counter()
+        user = store.users["user-%d" % (n % 10)]
+        assert "editor" in store.roles
+        assert store.roles[user["role"]] >= store.roles["editor"]
+        timings.append(time.perf_counter() - t0)
+
+    return sorted(timings)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", default="100,1000,10000", help="user counts to test")
+    ap.add_argument("--ops", type=int, default=100, help="users to create and delete")
+    args = ap.parse_args()
+
+    for users in (int(u) for u in args.users.split(",")):
+        for kind in shoebill.AUTH_BACKENDS:
+            auth_dir = mkdtemp()
+            try:
+                store = shoebill.open_auth_backend(auth_dir, kind, initialize=True)
+                store.roles["editor"] = 60
+                store.save_roles()
+                for n in range(users):
+                    store.users["user-%d" % n] = user_data(n)
+                store.save_users()
+
+                created, deleted = bench(store, args.ops)
+                lookups = bench_lookup(store, args.ops)
+                print(
+                    "%-6s users: %6d  create median: %.3f ms  "
+                    "delete median: %.3f ms  lookup median: %.1f us"
+                    % (
+                        kind,
+                        users,
+                        created[len(created) // 2] * 1000,
+                        deleted[len(deleted) // 2] * 1000,
+                        lookups[len(lookups) // 2] * 1e6,
+                    )
+                )
+            finally:
+                shutil.rmtree(auth_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#
+# Shoebill benchmark: save-and-commit latency, running git vs in-process
+#
+# Usage: python benchmarks/bench_git_commit.py [--files N] [--saves N]
+#
+
+from tempfile import mkdtemp
+import argparse
+import os
+import shutil
+import subprocess
+import time
+
+from git import GitDB, Repo
+
+import shoebill
+
+
+def setup_repo(site_path, files):
+    """Create a Git repository with a content dir holding some files"""
+    content_path = os.path.join(site_path, "content")
+    os.mkdir(content_path)
+    for n in range(files):
+        with open(os.path.join(content_path, "post-%05d.rst" % n), "w") as f:
+            f.write("Post %d\n=======\n\nSome text.\n" % n)
+
+    def git(*args):
+        subprocess.check_call(["git", "-C", site_path] + list(args))
+
+    git("init", "-q")
+    git("config", "user.name", "Bench")
+    git("config", "user.email", "bench@example.com")
+    git("add", "content")
+    git("commit", "-q", "-m", "Initial import")
+
+
+def bench(git_ops, saves):
+    """Update a file and commit it, as route_post_save does
+
+    :returns: list of latencies in seconds
+    """
+    shoebill.git_ops = git_ops
+    timings = []
+    for n in range(saves):
+        git_path = os.path.join("content", "post-%05d.rst" % (n % 10))
+        with open(os.path.join(shoebill.git_repo.working_tree_dir, git_path), "a") as f:
+            f.write("Update %d\n" % n)
+
+        t0 = time.perf_counter()
+        git_ops.stage([git_path])
+        assert git_ops.changed_paths([git_path])
+        git_ops.commit([git_path], "Update %d" % n, "bench <bench@example.com>")
+        timings.append(time.perf_counter() - t0)
+
+    return timings
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--files", type=int, default=1000, help="files in the repo")
+    ap.add_argument("--saves", type=int, default=100, help="saves to measure")
+    args = ap.parse_args()
+
+    for git_ops in (shoebill.SubprocessGit(), shoebill.InProcessGit()):
+        site_path = mkdtemp()
+        try:
+            setup_repo(site_path, args.files)
+            if isinstance(git_ops, shoebill.InProcessGit):
+                shoebill.git_repo = Repo(site_path, odbt=GitDB)
+            else:
+                shoebill.git_repo = Repo(site_path)
+            timings = sorted(bench(git_ops, args.saves))
+            print(
+                "%-14s files: %d  saves: %d  median: %.2f ms  p90: %.2f ms"
+                % (
+                    git_ops.__class__.__name__,
+                    args.files,
+                    args.saves,
+                    timings[len(timings) // 2] * 1000,
+                    timings[len(timings) * 9 // 10] * 1000,
+                )
+            )
+        finally:
+            shutil.rmtree(site_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+#
+# Shoebill benchmark: time and memory allocated listing a large directory
+# with Path, as the edit page does when the content index is disabled
+#
+# Usage: python benchmarks/bench_path.py [--entries N] [--runs N]
+#
+
+from tempfile import mkdtemp
+import argparse
+import os
+import shutil
+import time
+import tracemalloc
+
+import shoebill
+
+
+def setup_dir(content_path, entries):
+    """Create a directory holding files, a few subdirectories and a few
+    hidden files
+    """
+    dirname = os.path.join(content_path, "posts")
+    os.makedirs(dirname)
+    for n in range(entries):
+        if n % 100 == 0:
+            os.mkdir(os.path.join(dirname, "dir-%06d" % n))
+        elif n % 100 == 1:
+            open(os.path.join(dirname, ".hidden-%06d" % n), "w").close()
+        else:
+            open(os.path.join(dirname, "post-%06d.rst" % n), "w").close()
+
+
+def bench(path, runs):
+    """:returns: sorted latencies in seconds"""
+    timings = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        path.list_current_dir()
+        timings.append(time.perf_counter() - t0)
+
+    return sorted(timings)
+
+
+def measure_memory(path):
+    """:returns: (bytes allocated at peak, bytes held by the listing)"""
+    tracemalloc.start()
+    try:
+        listing = path.list_current_dir()
+        held, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    del listing
+    return peak, held
+
+
+def bench_checks(path, runs):
+    """Time listing a directory and checking its entries on disk
+
+    :returns: sorted latencies in seconds
+    """
+    timings = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        dirnames, filenames = path.list_current_dir()
+        for d in dirnames:
+            assert d.is_real_dir
+        for f in filenames:
+            assert f.is_real_file and not f.is_hidden
+        timings.append(time.perf_counter() - t0)
+
+    return sorted(timings)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--entries", type=int, default=50000, help="directory entries")
+    ap.add_argument("--runs", type=int, default=20, help="listings to time")
+    args = ap.parse_args()
+
+    site_path = mkdtemp()
+    try:
+        shoebill.content_path = os.path.join(site_path, "content")
+        setup_dir(shoebill.content_path, args.entries)
+        path = shoebill.Path(relurl="posts/post-000002.rst")
+        listed = sum(len(names) for names in path.list_current_dir())
+
+        for name, timings in (
+            ("list", bench(path, args.runs)),
+            ("list and check", bench_checks(path, args.runs)),
+        ):
+            print(
+                "%-15s entries: %d  median: %7.2f ms  p90: %7.2f ms  "
+                "per entry: %.2f us"
+                % (
+                    name,
+                    listed,
+                    timings[len(timings) // 2] * 1000,
+                    timings[len(timings) * 9 // 10] * 1000,
+                    timings[len(timings) // 2] * 1e6 / listed,
+                )
+            )
+
+        peak, held = measure_memory(path)
+        print(
+            "memory          peak: %.1f MB  held by the listing: %.1f MB  "
+            "per entry: %d bytes" % (peak / 1e6, held / 1e6, held / listed)
+        )
+    finally:
+        shoebill.content_path = None
+        shutil.rmtree(site_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+#
+# Shoebill benchmark: edit page throughput with a number of worker processes
+#
+# Usage: python benchmarks/bench_server.py [--workers 1,2,4] [--threads N]
+#            [--clients N] [--duration SECONDS]
+#
+
+from tempfile import mkdtemp
+import argparse
+import http.client
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
+
+PORT = 8199
+
+
+def setup_site(site_path, files):
+    """Create a site dir with a Git repository and some files"""
+    content_path = os.path.join(site_path, "content")
+    os.mkdir(content_path)
+    for n in range(files):
+        with open(os.path.join(content_path, "post-%05d.rst" % n), "w") as f:
+            f.write("Post %d\n=======\n\n%s\n" % (n, "Some text. " * 200))
+
+    def git(*args):
+        subprocess.check_call(["git", "-C", site_path] + list(args))
+
+    git("init", "-q")
+    git("config", "user.name", "Bench")
+    git("config", "user.email", "bench@example.com")
+    git("add", "content")
+    git("commit", "-q", "-m", "Initial import")
+
+
+def start_server(site_path, workers, threads):
+    cmd = [sys.executable, "-c", "import shoebill; shoebill.main()"]
+    cmd += ["--no-auth", "-p", str(PORT), site_path]
+    cmd += ["--workers", str(workers), "--threads", str(threads)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(("localhost", PORT)).close()
+            return proc
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+
+    proc.terminate()
+    raise RuntimeError("The server did not start")
+
+
+def run_client(args):
+    """Fetch edit pages until the deadline
+
+    :returns: list of latencies in seconds
+    """
+    client_id, deadline = args
+    timings = []
+    n = client_id
+    while time.time() < deadline:
+        t0 = time.perf_counter()
+        conn = http.client.HTTPConnection("localhost", PORT)
+        conn.request("GET", "/edit/post-%05d.rst" % (n % 100))
+        resp = conn.getresponse()
+        resp.read()
+        conn.close()
+        assert resp.status == 200, resp.status
+        timings.append(time.perf_counter() - t0)
+        n += 1
+
+    return timings
+
+
+def bench(clients, duration):
+    deadline = time.time() + duration
+    with multiprocessing.Pool(clients) as pool:
+        results = pool.map(run_client, [(n, deadline) for n in range(clients)])
+
+    return sorted(t for timings in results for t in timings)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--workers", default="1,2,4", help="worker counts to test")
+    ap.add_argument("--threads", type=int, default=8, help="threads per worker")
+    ap.add_argument("--clients", type=int, default=8, help="concurrent clients")
+    ap.add_argument("--duration", type=float, default=10, help="seconds per run")
+    args = ap.parse_args()
+
+    site_path = mkdtemp()
+    try:
+        setup_site(site_path, 100)
+        for workers in (int(w) for w in args.workers.split(",")):
+            proc = start_server(site_path, workers, args.threads)
+            try:
+                bench(args.clients, 1)  # warm up
+                timings = bench(args.clients, args.duration)
+            finally:
+                proc.terminate()
+                proc.wait()
+
+            print(
+                "workers: %d  threads: %d  clients: %d  %.0f req/s  "
+                "median: %.2f ms  p90: %.2f ms"
+                % (
+                    workers,
+                    args.threads,
+                    args.clients,
+                    len(timings) / args.duration,
+                    timings[len(timings) // 2] * 1000,
+                    timings[len(timings) * 9 // 10] * 1000,
+                )
+            )
+    finally:
+        shutil.rmtree(site_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+#
+# Shoebill benchmark: cost of sessions for requests of a logged in user,
+# Beaker cookie sessions vs server-side session stores
+#
+# Usage: python benchmarks/bench_sessions.py [--requests N]
+#
+
+from tempfile import mkdtemp
+import argparse
+import os
+import shutil
+import time
+
+from webtest import TestApp
+
+import shoebill
+
+try:
+    from beaker.middleware import SessionMiddleware as BeakerMiddleware
+except ImportError:
+    BeakerMiddleware = None
+
+
+def app(environ, start_response):
+    """Log in on /login, otherwise read the session as Cork does"""
+    session = environ["beaker.session"]
+    if environ["PATH_INFO"] == "/login":
+        session["username"] = "admin"
+        session.save()
+    username = session.get("username")
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [username.encode()]
+
+
+def baseline_app(environ, start_response):
+    """Sessions costing nothing, to tell apart the time spent in WebTest"""
+    environ["beaker.session"] = shoebill.Session({"username": "admin"})
+    return app(environ, start_response)
+
+
+def beaker_app():
+    """The cookie sessions used by previous releases, encrypted if an
+    AES library is installed
+
+    :returns: (WSGI app, description)
+    """
+    opts = {
+        "session.cookie_expires": True,
+        "session.httponly": True,
+        "session.timeout": 3600 * 24,
+        "session.type": "cookie",
+        "session.validate_key": shoebill.gen_random_token(21),
+    }
+    from beaker.crypto import get_crypto_module
+
+    if get_crypto_module("default").has_aes:
+        opts["session.encrypt_key"] = shoebill.gen_random_token(21)
+        return BeakerMiddleware(app, opts), "beaker cookie"
+    return BeakerMiddleware(app, opts), "beaker cookie (signed only, no AES)"
+
+
+def bench(wsgi_app, requests):
+    """Log in, then fetch pages
+
+    :returns: (latencies in seconds, bytes of cookies sent and received)
+    """
+    client = TestApp(wsgi_app)
+    client.get("/login")
+    timings = []
+    cookie_bytes = 0
+    for _ in range(requests):
+        t0 = time.perf_counter()
+        r = client.get("/")
+        timings.append(time.perf_counter() - t0)
+        assert r.body == b"admin"
+        cookie_bytes += len(r.request.headers.get("Cookie", ""))
+        cookie_bytes += len(r.headers.get("Set-Cookie", ""))
+
+    return sorted(timings), cookie_bytes / requests
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--requests", type=int, default=10000, help="requests to time")
+    args = ap.parse_args()
+
+    tmpdir = mkdtemp()
+    try:
+        candidates = [(baseline_app, "baseline")]
+        if BeakerMiddleware:
+            candidates.append(beaker_app())
+        store = shoebill.MemorySessionStore()
+        candidates.append((shoebill.SessionMiddleware(app, store), "memory"))
+        store = shoebill.SQLiteSessionStore(os.path.join(tmpdir, "sessions.sqlite"))
+        candidates.append((shoebill.SessionMiddleware(app, store), "sqlite"))
+
+        for wsgi_app, name in candidates:
+            timings, cookie_bytes = bench(wsgi_app, args.requests)
+            print(
+                "%-38s median: %6.1f us  p90: %6.1f us  cookies: %4d bytes/request"
+                % (
+                    name,
+                    timings[len(timings) // 2] * 1e6,
+                    timings[len(timings) * 9 // 10] * 1e6,
+                    cookie_bytes,
+                )
+            )
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
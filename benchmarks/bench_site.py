@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+#
+# Shoebill benchmark: latency of the directory listing, the edit page,
+# saving a file with a commit and running a make target on synthetic
+# Pelican sites of growing size, with wide and deep content trees
+#
+# Usage: python benchmarks/bench_site.py [--files 1000,10000,100000]
+#            [--shapes wide,deep] [--runs N] [--git-in-process]
+#            [--output results.json] [--compare previous.json]
+#
+# Requests go through WebTest, with no network and no server process.
+# The results can be saved as JSON and compared with a previous run.
+#
+
+from tempfile import mkdtemp
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+
+from webtest import TestApp
+
+import shoebill
+
+SHAPES = ("wide", "deep")
+SCENARIOS = ("listing", "edit", "save", "make")
+
+# Deep trees have this many subdirectories in each directory and this
+# many files in each leaf directory
+FANOUT = 10
+
+MAKEFILE = """\
+html:
+\t@echo Building $(CHANGED_FILES)
+"""
+
+
+def file_relpaths(files, shape):
+    """Paths of the files of a site, relative to the content dir.
+    Wide sites keep all the files in one directory, deep sites spread
+    them FANOUT per directory at the bottom of a tree of directories.
+    """
+    if shape == "wide":
+        return ["posts/post-%06d.rst" % n for n in range(files)]
+
+    depth = 1
+    while FANOUT ** (depth + 1) < files:
+        depth += 1
+
+    paths = []
+    for n in range(files):
+        leaf = n // FANOUT
+        dirs = []
+        for _ in range(depth):
+            dirs.append("d%d" % (leaf % FANOUT))
+            leaf //= FANOUT
+        paths.append("/".join(dirs[::-1] + ["post-%06d.rst" % n]))
+
+    return paths
+
+
+def setup_site(site_path, relpaths):
+    """Create a Pelican site dir with a Git repository"""
+    content_path = os.path.join(site_path, "content")
+    for n, relpath in enumerate(relpaths):
+        path = os.path.join(content_path, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write("Post %d\n=======\n\n:date: 2020-01-01\n\n" % n)
+            f.write("Some text. " * 100 + "\n")
+
+    with open(os.path.join(site_path, "Makefile"), "w") as f:
+        f.write(MAKEFILE)
+
+    def git(*args):
+        subprocess.check_call(["git", "-C", site_path] + list(args))
+
+    git("init", "-q")
+    git("config", "user.name", "Bench")
+    git("config", "user.email", "bench@example.com")
+    # No automatic gc in the background, slowing down commits at random
+    git("config", "gc.auto", "0")
+    with open(os.path.join(site_path, ".gitignore"), "w") as f:
+        f.write(".shoebill_search.sqlite*\n")
+    git("add", ".")
+    git("commit", "-q", "-m", "Initial import")
+
+
+def open_site(site_path, git_in_process):
+    """Set up the module state as the server does for one process"""
+    shoebill.content_path = os.path.join(site_path, "content")
+    # Without inotify, as deep trees can exceed the watch limit
+    shoebill.content_index = shoebill.ContentIndex(
+        shoebill.content_path, use_inotify=False
+    )
+    shoebill.content_index.build()
+    shoebill.setup_search_index(site_path, shoebill.content_path)
+    shoebill.setup_git_repo(site_path, in_process=git_in_process)
+    shoebill.make_targets = ["html"]
+    shoebill.build_queue = shoebill.BuildQueue()
+    shoebill.history_cache = shoebill.LRUCache(
+        maxbytes=shoebill.HISTORY_CACHE_BYTES
+    )
+
+
+def close_site():
+    shoebill.search_index.close()
+    shoebill.git_repo.close()
+    shoebill.content_path = None
+    shoebill.content_index = None
+    shoebill.search_index = None
+    shoebill.git_repo = None
+
+
+def timed(fn, runs):
+    """Call fn(n) once to warm up caches, then runs times
+
+    :returns: sorted latencies in seconds
+    """
+    fn(-1)
+    timings = []
+    for n in range(runs):
+        t0 = time.perf_counter()
+        fn(n)
+        timings.append(time.perf_counter() - t0)
+
+    return sorted(timings)
+
+
+def bench(client, relpath, runs):
+    """Time each scenario on a file and its directory
+
+    :returns: {scenario: sorted latencies in seconds}
+    """
+    dirname = relpath.rsplit("/", 1)[0] + "/"
+
+    def listing(n):
+        client.get("/edit/" + dirname)
+
+    def edit(n):
+        client.get("/edit/" + relpath)
+
+    def save(n):
+        form = {"file_contents": "Post\n====\n\nRevision %d\n" % n, "desc": "Bench"}
+        r = client.post("/edit/" + relpath, form)
+        assert "Saved." in r, r
+
+    def make(n):
+        r = client.post("/make/html")
+        job = shoebill.build_queue.get(int(r.headers["X-Build-Id"]))
+        job.wait()
+        assert job.returncode == 0, list(job.output)
+
+    return {
+        "listing": timed(listing, runs),
+        "edit": timed(edit, runs),
+        "save": timed(save, runs),
+        "make": timed(make, runs),
+    }
+
+
+def summarize(timings):
+    return dict(
+        runs=len(timings),
+        median_ms=timings[len(timings) // 2] * 1000,
+        p90_ms=timings[len(timings) * 9 // 10] * 1000,
+        min_ms=timings[0] * 1000,
+        max_ms=timings[-1] * 1000,
+    )
+
+
+def shoebill_revision():
+    """:returns: the Git commit of the code being measured, if known"""
+    try:
+        out = subprocess.check_output(
+            ["git", "-C", os.path.dirname(shoebill.__file__), "rev-parse", "HEAD"],
+            stderr=subprocess.DEVNULL,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return out.decode().strip()
+
+
+def compare(results, previous):
+    """Print the change in median latency from a previous run"""
+    old = {(r["site"], r["scenario"]): r for r in previous["results"]}
+    for r in results:
+        o = old.get((r["site"], r["scenario"]))
+        if o is None:
+            continue
+        change = (r["median_ms"] / o["median_ms"] - 1) * 100
+        print(
+            "%-12s %-8s median: %9.2f ms -> %9.2f ms  %+6.1f%%"
+            % (r["site"], r["scenario"], o["median_ms"], r["median_ms"], change)
+        )
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--files", default="1000,10000,100000", help="site sizes")
+    ap.add_argument("--shapes", default=",".join(SHAPES), help="wide, deep or both")
+    ap.add_argument("--runs", type=int, default=20, help="requests per scenario")
+    ap.add_argument("--git-in-process", action="store_true", help="commit without git")
+    ap.add_argument("--output", help="save the results to this JSON file")
+    ap.add_argument("--compare", help="JSON file of a previous run to compare with")
+    args = ap.parse_args()
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+
+    shoebill.app.catchall = False
+    client = TestApp(
+        shoebill.CompressionMiddleware(shoebill.app),
+        extra_environ={"REMOTE_ADDR": "127.0.0.1"},
+    )
+    results = []
+    for files in (int(n) for n in args.files.split(",")):
+        for shape in args.shapes.split(","):
+            if shape not in SHAPES:
+                ap.error("Unknown shape %r" % shape)
+            site = "%s-%d" % (shape, files)
+            relpaths = file_relpaths(files, shape)
+            site_path = mkdtemp()
+            try:
+                t0 = time.perf_counter()
+                setup_site(site_path, relpaths)
+                print("%s: site created in %.1fs" % (site, time.perf_counter() - t0))
+                open_site(site_path, args.git_in_process)
+                try:
+                    # Leave out the messages printed on each save and build
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        relpath = relpaths[len(relpaths) // 2]
+                        timings = bench(client, relpath, args.runs)
+                finally:
+                    close_site()
+            finally:
+                shutil.rmtree(site_path)
+
+            for scenario in SCENARIOS:
+                r = dict(site=site, shape=shape, files=files, scenario=scenario)
+                r.update(summarize(timings[scenario]))
+                results.append(r)
+                print(
+                    "%-12s %-8s median: %9.2f ms  p90: %9.2f ms"
+                    % (site, scenario, r["median_ms"], r["p90_ms"])
+                )
+
+    if previous:
+        compare(results, previous)
+
+    if args.output:
+        metadata = dict(
+            date=datetime.datetime.now().isoformat(timespec="seconds"),
+            revision=shoebill_revision(),
+            python=sys.version.split()[0],
+            platform=platform.platform(),
+            cpus=os.cpu_count(),
+            runs=args.runs,
+            git_in_process=args.git_in_process,
+        )
+        with open(args.output, "w") as f:
+            json.dump(dict(metadata=metadata, results=results), f, indent=2)
+        print("Results saved to %s" % args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -34,12 +34,15 @@ setup(
     classifiers=CLASSIFIERS,
     keywords="pelican nikola static generator editor",
     install_requires=[
-        "Beaker>=1.6.3",
-        "Bottle>=0.10.11",
-        "GitPython>=0.1.7",
+        "Bottle>=0.13",
+        "GitPython>=3.1",
         "bottle-cork",
         "setproctitle>=1.0.1",
     ],
+    extras_require={
+        "brotli": ["Brotli"],
+        "cookie-sessions": ["Beaker>=1.6.3", "cryptography"],
+    },
     packages=["shoebill"],
     package_dir={"shoebill": "shoebill"},
     platforms=["Linux"],
@@ -17,17 +17,65 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
-from base64 import b64encode
+from base64 import b64decode, b64encode
 from datetime import datetime
-from git import Repo, InvalidGitRepositoryError
+from git import Actor, GitCommandError, GitDB, InvalidGitRepositoryError, Repo
+from git.index.base import IndexFile
+from git.index.fun import stat_mode_to_index_mode
+from git.index.typ import BaseIndexEntry, IndexEntry
+from git.objects.commit import Commit
+from git.objects.fun import tree_entries_from_data
+from git.objects.tree import Tree
+from gitdb.base import IStream
+from gitdb.exc import BadName
 from pkg_resources import resource_filename
 from setproctitle import setproctitle
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
 import argparse
+import atexit
+import bisect
 import bottle
+import codecs
+import collections
+import collections.abc
+import concurrent.futures
+import contextlib
+import cProfile
+import ctypes
+import ctypes.util
+import fcntl
+import functools
+import hashlib
+import hmac
+import http.cookies
+import io
+import itertools
+import json
 import logging
+import marshal
+import math
+import mmap
+import multiprocessing
 import os
+import pstats
+import queue
+import random
+import re
+import secrets
+import select
+import shutil
+import signal
+import sqlite3
+import stat
+import struct
 import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
 
 log = logging.getLogger("shoebill")
 
@@ -39,18 +87,106 @@ bottle.TEMPLATE_PATH.insert(0, tpl_path)
 static_path = resource_filename("shoebill", "static")
 
 try:
-    from beaker.middleware import SessionMiddleware
-    from cork import Cork
+    from cork import AuthException, Cork
+    from cork.base_backend import BackendIOException
+    from cork.json_backend import BytesEncoder, JsonBackend
 
     aaa_available = True
 except ImportError:  # pragma: nocover
     aaa_available = False
+    Cork = JsonBackend = object
+
+try:
+    import brotli
+except ImportError:  # pragma: nocover
+    brotli = None
+
+try:
+    from beaker.middleware import SessionMiddleware as BeakerSessionMiddleware
+except ImportError:  # pragma: nocover
+    BeakerSessionMiddleware = None
 
 
 git_repo = None
 content_path = None
+content_index = None
+search_index = None
 make_targets = None
 
+# Maximum size of a line of make output held in memory
+MAX_OUTPUT_LINE = 8192
+
+# Number of output lines kept in memory for each build, and their
+# total size in characters
+MAX_BUILD_OUTPUT_LINES = 10000
+MAX_BUILD_OUTPUT_SIZE = 1024 * 1024
+
+# Finished builds whose output is kept in memory: older ones keep only
+# their state
+BUILD_OUTPUTS_KEPT = 10
+
+# Changed files tracked for each make target: with more, the next build
+# is a full one
+MAX_CHANGED_FILES = 10000
+
+# Maximum length of the CHANGED_FILES make argument, well below the
+# limit of the length of a single argument on Linux (128 KiB)
+MAX_CHANGED_FILES_ARG = 32768
+
+# Files bigger than this are edited in pages
+large_file_threshold = 1024 * 1024
+LARGE_FILE_PAGE_SIZE = 64 * 1024
+MMAP_CHUNK_SIZE = 256 * 1024
+
+# Seconds for which users and roles are served from memory before checking
+# if other processes have changed them
+AUTH_CACHE_TTL = 5
+
+# Processes hashing passwords and hashes allowed to wait for them
+PASSWORD_HASH_PROCESSES = 2
+PASSWORD_HASH_QUEUE = 32
+
+# Sessions expire after this many seconds without requests; their last
+# access time is stored at most once per interval
+SESSION_TIMEOUT = 3600 * 24
+SESSION_TOUCH_INTERVAL = 60
+# Sessions kept by the in-memory store before dropping the least recent
+SESSION_MEMORY_MAX = 10000
+
+# Request profiles kept by each process, and functions listed in their
+# text summaries
+PROFILES_KEPT = 50
+PROFILE_TEXT_LINES = 40
+profile_store = None
+
+# Clients sending "Authorization: Bearer <token>" can read /metrics
+# without logging in
+metrics_token = None
+
+# Number of commits listed in each history page
+HISTORY_PAGE_SIZE = 50
+
+# Total size of the diffs kept in the history cache, in bytes
+HISTORY_CACHE_BYTES = 32 * 1024 * 1024
+
+# Static files linked by the templates, served with content-hashed names
+STATIC_ASSETS = ("edit.css", "edit.js", "msgbox.css")
+
+# Responses smaller than this are not compressed
+COMPRESS_MIN_SIZE = 512
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json")
+
+# When to fsync saved files: "none", "file" (before renaming them into
+# place) or "full" (the file and its directory)
+FSYNC_POLICIES = ("none", "file", "full")
+fsync_policy = "file"
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Permissions of new files, as open() would create them
+_umask = os.umask(0)
+os.umask(_umask)
+NEW_FILE_MODE = 0o666 & ~_umask
+
 
 def gen_random_token(length) -> str:
     """Generate a printable random string"""
@@ -58,27 +194,59 @@ def gen_random_token(length) -> str:
 
 
 class Path(object):
-    """Represent a path to a file or directory in the site dir"""
+    """Represent a path to a file or directory in the site dir.
+    The relative path, the URL and the hidden flag are computed once, as
+    listings create thousands of paths. Paths in the content dir are
+    stored relative to it, to keep listings small.
+    """
 
-    def __init__(self, relurl=None, absfile=None):
-        global content_path
-        self._content_path = content_path
-        self._ossep = os.sep
-        self._urlsep = "/"
-        # print "relurl %r" % relurl
-        # print "absfile %r" % absfile
+    __slots__ = ("_content_path", "_abspath", "_relpath", "_url", "_hidden", "_type")
+    _ossep = os.sep
+    _urlsep = "/"
+
+    def __init__(self, relurl=None, absfile=None, entry=None):
+        """Create a path from a URL relative to the content dir, or from an
+        absolute path
 
+        :param entry: :class:`os.DirEntry` of the path, if it comes from a
+            directory scan, to know its type without a stat call
+        """
+        self._content_path = content_path
         if absfile:
-            self._abspath = absfile
+            abspath = absfile
         else:
             relurl = relurl.lstrip("/")  # Prevent directory traversal attacks
             relpath = self._ossep.join(relurl.split(self._urlsep))
-            self._abspath = os.path.join(self._content_path, relpath)
+            abspath = os.path.join(self._content_path, relpath)
 
-        if self.is_dir:
-            assert self.as_url.endswith(self._urlsep), "%r" % self.as_url
+        trunc = len(self._content_path) + 1
+        relpath = abspath[trunc:]
+        in_content = abspath[trunc - 1 : trunc] == self._ossep
+        if in_content and abspath.startswith(self._content_path):
+            self._abspath = None
+        else:
+            self._abspath = abspath
+
+        self._relpath = relpath
+        self._hidden = relpath.startswith(".") or self._ossep + "." in relpath
+        url = relpath
+        if self._ossep != self._urlsep:
+            url = url.replace(self._ossep, self._urlsep)
+        if abspath.endswith(self._ossep):
+            if not url.endswith(self._urlsep):
+                url += self._urlsep
         else:
-            assert not self.as_url.endswith(self._urlsep), "%r" % self.as_url
+            url = url.rstrip(self._urlsep)
+        self._url = url
+
+        if entry is None:
+            self._type = None
+        elif entry.is_dir():
+            self._type = "dir"
+        elif entry.is_file():
+            self._type = "file"
+        else:
+            self._type = "other"
 
     @property
     def is_dir(self) -> bool:
@@ -87,7 +255,7 @@ class Path(object):
 
         :returns: bool
         """
-        return self._abspath.endswith(self._ossep)
+        return self._url.endswith(self._urlsep)
 
     @property
     def as_abs_path(self):
@@ -95,7 +263,10 @@ class Path(object):
 
         :returns: str
         """
-        return self._abspath
+        if self._abspath is not None:
+            return self._abspath
+
+        return self._content_path + self._ossep + self._relpath
 
     @property
     def as_relative_path(self):
@@ -103,31 +274,26 @@ class Path(object):
 
         :returns: str
         """
-        trunc = len(self._content_path) + 1
-        relpath = self._abspath[trunc:]
-        return relpath
+        return self._relpath
 
     @property
-    def as_url(self):
-        """Returns a relative URL from the current path
+    def as_site_relative_path(self):
+        """Returns the path relative to the site directory
 
         :returns: str
         """
-        relpath = self.as_relative_path
-        url = self._urlsep.join(relpath.split(self._ossep))
-        assert self._content_path not in url
-
-        if self.is_dir:
-            if not url.endswith(self._urlsep):
-                url += self._urlsep
+        return os.path.relpath(self.as_abs_path, os.path.dirname(self._content_path))
 
-            return url
+    @property
+    def as_url(self):
+        """Returns a relative URL from the current path
 
-        return url.rstrip(self._urlsep)
+        :returns: str
+        """
+        return self._url
 
     def url_chunks(self):
-        relpath = self.as_relative_path
-        return relpath.split(self._ossep)
+        return self._relpath.split(self._ossep)
 
     @property
     def is_hidden(self):
@@ -135,18 +301,14 @@ class Path(object):
 
         :returns: bool
         """
-        for c in self.url_chunks():
-            if c.startswith("."):
-                return True
-
-        return False
+        return self._hidden
 
     def basedir(self):
         """Extract base directory of the current path
 
         :returns: :class:`Path`
         """
-        dn = os.path.dirname(self._abspath)
+        dn = os.path.dirname(self.as_abs_path)
         return Path(absfile=dn)
 
     @property
@@ -155,7 +317,10 @@ class Path(object):
 
         :returns: bool
         """
-        return os.path.isdir(self._abspath)
+        if self._type is not None:
+            return self._type == "dir"
+
+        return os.path.isdir(self.as_abs_path)
 
     @property
     def is_real_file(self):
@@ -163,7 +328,10 @@ class Path(object):
 
         :returns: bool
         """
-        return os.path.isfile(self._abspath)
+        if self._type is not None:
+            return self._type == "file"
+
+        return os.path.isfile(self.as_abs_path)
 
     def list_current_dir(self):
         """List current directory contents.
@@ -171,31 +339,493 @@ class Path(object):
 
         :returns: (dirname, filenames) lists
         """
-        bdn = os.path.dirname(self._abspath)
-        w = os.walk(bdn)
-        _, dirnames, filenames = next(w)
-        dirnames = [Path(absfile=os.path.join(bdn, d) + "/") for d in sorted(dirnames)]
-        dirnames = [d for d in dirnames if not d.is_hidden]
-
-        filenames = [Path(absfile=os.path.join(bdn, f)) for f in sorted(filenames)]
-        filenames = [f for f in filenames if not f.is_hidden]
-
+        if self.basedir().is_hidden:
+            return [], []
+
+        dirnames = []
+        filenames = []
+        with os.scandir(os.path.dirname(self.as_abs_path)) as it:
+            for e in it:
+                if e.name.startswith("."):
+                    continue
+                if e.is_dir():
+                    dirnames.append(Path(absfile=e.path + self._ossep, entry=e))
+                else:
+                    filenames.append(Path(absfile=e.path, entry=e))
+
+        # Sort by name: paths in the same dir only differ by it
+        dirnames.sort(key=lambda d: d._relpath[:-1])
+        filenames.sort(key=lambda f: f._relpath)
         return dirnames, filenames
 
     def basename(self):
         """"""
-        if self.is_dir:
-            return self.basedir().basename()
-
-        return os.path.basename(self._abspath)
+        return os.path.basename(self.as_abs_path.rstrip(self._ossep))
 
     def __repr__(self):
-        return "<Path '%s' url='%s'>" % (self._abspath, self.as_url)
+        return "<Path '%s' url='%s'>" % (self.as_abs_path, self._url)
+
+
+class Inotify(object):
+    """Minimal inotify interface based on ctypes"""
+
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+
+    _event_header = struct.Struct("iIII")
+
+    def __init__(self):
+        libname = ctypes.util.find_library("c")
+        self._libc = ctypes.CDLL(libname, use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self, path, mask):
+        """Watch a path
+
+        :returns: int -- watch descriptor
+        """
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+
+        return wd
+
+    def read_events(self, timeout=None):
+        """Wait for events
+
+        :returns: [(wd, mask, name), ...]
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        try:
+            buf = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+
+        events = []
+        pos = 0
+        while pos < len(buf):
+            wd, mask, _, namelen = self._event_header.unpack_from(buf, pos)
+            pos += self._event_header.size
+            name = buf[pos : pos + namelen].rstrip(b"\0")
+            pos += namelen
+            events.append((wd, mask, os.fsdecode(name)))
+
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+DirListing = collections.namedtuple("DirListing", "mtime_ns digest dirs files")
+
+
+def listing_digest(dirs, files):
+    """Digest of the contents of a directory listing. It does not depend on
+    the process, as opposed to a counter.
+
+    :returns: str
+    """
+    h = hashlib.sha1()
+    for url, _ in itertools.chain(dirs, files):
+        h.update(url.encode("utf-8", "surrogateescape"))
+        h.update(b"\0")
+
+    return h.hexdigest()
+
+
+class ContentIndex(object):
+    """In-memory listing of the directories and files in the content dir.
+    Hidden directories and files are not listed.
+    Directories are scanned on first access and rescanned after inotify
+    reports a change. If inotify is not available, a directory is rescanned
+    when its mtime changes.
+    """
+
+    _watch_mask = (
+        Inotify.IN_CREATE
+        | Inotify.IN_DELETE
+        | Inotify.IN_MOVED_FROM
+        | Inotify.IN_MOVED_TO
+        | Inotify.IN_DELETE_SELF
+        | Inotify.IN_MOVE_SELF
+        | Inotify.IN_ONLYDIR
+    )
+
+    def __init__(self, root, use_inotify=True):
+        self._root = root
+        self._lock = threading.RLock()
+        self._dirs = {}
+        self._dirty = set()
+        self._wds = {}
+        # Directories that could not be watched, polled by mtime instead
+        self._unwatched = set()
+        self._inotify = None
+        self._watcher = None
+        self.scan_time = None
+        if use_inotify:
+            try:
+                self._inotify = Inotify()
+            except (AttributeError, OSError) as e:
+                log.info("inotify not available, falling back to polling: %s", e)
+
+    @property
+    def uses_inotify(self):
+        return self._inotify is not None
+
+    def build(self):
+        """Scan the whole content tree and start watching for changes.
+        Symlinks to directories are listed but not scanned, as they can
+        lead outside the content dir or into a loop.
+
+        :returns: int -- number of directories indexed
+        """
+        t0 = time.monotonic()
+        todo = [""]
+        while todo:
+            reldir = todo.pop()
+            dirs, _ = self.listdir(reldir)
+            for _, name in dirs:
+                relpath = os.path.join(reldir, name)
+                if not os.path.islink(os.path.join(self._root, relpath)):
+                    todo.append(relpath)
+
+        self.scan_time = time.monotonic() - t0
+        return len(self._dirs)
+
+    def listdir(self, reldir):
+        """List a directory
+
+        :param reldir: directory path relative to the content dir
+        :returns: (dirs, files) lists of (url, name) tuples
+        """
+        listing = self.get_listing(reldir)
+        return listing.dirs, listing.files
+
+    def get_listing(self, reldir):
+        """Get the listing of a directory, including its mtime and a digest
+        of its contents
+
+        :returns: :class:`DirListing`
+        """
+        with self._lock:
+            listing = self._dirs.get(reldir)
+            if listing is None or reldir in self._dirty:
+                return self._scan(reldir)
+
+            if self._inotify is None or reldir in self._unwatched:
+                try:
+                    mtime = os.stat(os.path.join(self._root, reldir)).st_mtime_ns
+                except OSError:
+                    mtime = None
+                if mtime != listing.mtime_ns:
+                    return self._scan(reldir)
+
+            return listing
+
+    def invalidate(self, reldir):
+        """Force a directory to be rescanned on next access"""
+        with self._lock:
+            self._dirty.add(reldir)
+
+    def _scan(self, reldir):
+        """Scan a directory and store its listing"""
+        self._dirty.discard(reldir)
+        absdir = os.path.join(self._root, reldir)
+        if self._inotify is not None:
+            self._watch(reldir, absdir)
+
+        urldir = "/".join(reldir.split(os.sep))
+        urldir = urldir + "/" if urldir else ""
+        dirs = []
+        files = []
+        mtime = None
+        try:
+            mtime = os.stat(absdir).st_mtime_ns
+            with os.scandir(absdir) as it:
+                for e in it:
+                    if e.name.startswith("."):
+                        continue
+                    if e.is_dir():
+                        dirs.append((urldir + e.name + "/", e.name))
+                    else:
+                        files.append((urldir + e.name, e.name))
+        except FileNotFoundError:
+            mtime = None
+        except OSError as e:
+            # e.g. permission denied: listed as empty until its mtime changes
+            log.warning("Unable to list %s: %s", absdir, e)
+            dirs = []
+            files = []
+
+        dirs.sort(key=lambda d: d[1])
+        files.sort(key=lambda f: f[1])
+        listing = DirListing(mtime, listing_digest(dirs, files), dirs, files)
+        self._dirs[reldir] = listing
+        return listing
+
+    def _watch(self, reldir, absdir):
+        try:
+            wd = self._inotify.add_watch(absdir, self._watch_mask)
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            # e.g. out of watches: fs.inotify.max_user_watches
+            if not self._unwatched:
+                log.warning("Unable to watch %s, polling it instead: %s", absdir, e)
+            self._unwatched.add(reldir)
+            return
+
+        self._unwatched.discard(reldir)
+        self._wds[wd] = reldir
+        if self._watcher is None:
+            self._watcher = threading.Thread(target=self._watch_events, daemon=True)
+            self._watcher.start()
+
+    def _watch_events(self):
+        while True:
+            for wd, mask, name in self._inotify.read_events(timeout=1):
+                with self._lock:
+                    if mask & Inotify.IN_Q_OVERFLOW:
+                        self._dirty.update(self._dirs)
+                        continue
+
+                    reldir = self._wds.get(wd)
+                    if reldir is None:
+                        continue
+
+                    if mask & Inotify.IN_IGNORED:
+                        del self._wds[wd]
+
+                    self._dirty.add(reldir)
+                    self._dirs.pop(os.path.join(reldir, name), None)
+
+
+class SearchIndex(object):
+    """Full-text index of the files in the content dir, stored on disk
+    using SQLite FTS5. Hidden and binary files are not indexed, only the
+    beginning of large files is.
+    """
+
+    # Markers used to highlight matches in snippets, escaped later on
+    _hl_start = "\x02"
+    _hl_end = "\x03"
+
+    def __init__(self, db_path, root, max_file_size=1024 * 1024):
+        self._root = root
+        self._max_file_size = max_file_size
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY,
+                path TEXT UNIQUE NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS docs USING fts5(body);
+            """
+        )
+
+    def sync(self):
+        """Bring the index up to date with the content dir, reading only
+        files that are new or have a different mtime or size
+
+        :returns: int -- number of files (re)indexed
+        """
+        with self._lock, self._db:
+            known = {
+                path: (fid, mtime_ns, size)
+                for fid, path, mtime_ns, size in self._db.execute(
+                    "SELECT id, path, mtime_ns, size FROM files"
+                )
+            }
+            cnt = 0
+            for relpath, st in self._walk():
+                fid, mtime_ns, size = known.pop(relpath, (None, None, None))
+                if (mtime_ns, size) != (st.st_mtime_ns, st.st_size):
+                    if self._index(relpath, st):
+                        cnt += 1
+
+            for relpath in known:
+                self._remove(relpath)
+
+        return cnt
+
+    def update(self, relpath):
+        """Index or reindex a file
+
+        :param relpath: path relative to the content dir
+        """
+        try:
+            st = os.stat(os.path.join(self._root, relpath))
+        except FileNotFoundError:
+            return self.remove(relpath)
+
+        with self._lock, self._db:
+            self._index(relpath, st)
+
+    def remove(self, relpath):
+        """Remove a file from the index"""
+        with self._lock, self._db:
+            self._remove(relpath)
+
+    def search(self, query, limit=50):
+        """Search files containing every word in the query,
+        ranked by relevance
+
+        :returns: [(url, snippet_html), ...]
+        """
+        words = query.split()
+        if not words:
+            return []
+
+        match = " ".join('"%s"' % w.replace('"', '""') for w in words)
+        with self._lock:
+            rows = self._db.execute(
+                """
+                SELECT files.path, snippet(docs, 0, ?, ?, '...', 16)
+                FROM docs JOIN files ON files.id = docs.rowid
+                WHERE docs MATCH ? ORDER BY bm25(docs) LIMIT ?
+                """,
+                (self._hl_start, self._hl_end, match, limit),
+            ).fetchall()
+
+        results = []
+        for relpath, snippet in rows:
+            snippet = bottle.html_escape(snippet)
+            snippet = snippet.replace(self._hl_start, "<b>")
+            snippet = snippet.replace(self._hl_end, "</b>")
+            results.append(("/".join(relpath.split(os.sep)), snippet))
+
+        return results
+
+    def _walk(self):
+        """Generate (relpath, stat) for the non-hidden files. Symlinks to
+        directories are skipped: they can lead outside the content dir or
+        into a loop. Entries that cannot be read are logged and skipped.
+        """
+        todo = [""]
+        while todo:
+            reldir = todo.pop()
+            found = []
+            try:
+                with os.scandir(os.path.join(self._root, reldir)) as it:
+                    for e in it:
+                        if e.name.startswith("."):
+                            continue
+                        relpath = os.path.join(reldir, e.name)
+                        if e.is_dir(follow_symlinks=False):
+                            todo.append(relpath)
+                        elif e.is_file():
+                            try:
+                                found.append((relpath, e.stat()))
+                            except FileNotFoundError:
+                                pass
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                log.warning("Unable to index %s: %s", reldir or ".", e)
+
+            yield from found
+
+    def _index(self, relpath, st):
+        """Index a file, or remove it from the index if it cannot be read
+
+        :returns: bool -- True if the file has been indexed
+        """
+        try:
+            # file names that are not valid UTF-8 cannot be stored
+            relpath.encode("utf-8")
+        except UnicodeError as e:
+            log.warning("Unable to index %r: %s", relpath, e)
+            return False
+
+        self._remove(relpath)
+        try:
+            with open(os.path.join(self._root, relpath), "rb") as f:
+                body = f.read(self._max_file_size)
+        except OSError as e:
+            log.warning("Unable to index %s: %s", relpath, e)
+            return False
+
+        if b"\0" in body[:8000]:
+            # binary file: record it without contents
+            body = b""
+
+        cur = self._db.execute(
+            "INSERT INTO files (path, mtime_ns, size) VALUES (?, ?, ?)",
+            (relpath, st.st_mtime_ns, st.st_size),
+        )
+        self._db.execute(
+            "INSERT INTO docs (rowid, body) VALUES (?, ?)",
+            (cur.lastrowid, body.decode("utf-8", errors="replace")),
+        )
+        return True
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _remove(self, relpath):
+        row = self._db.execute("SELECT id FROM files WHERE path = ?", (relpath,))
+        row = row.fetchone()
+        if row is not None:
+            self._db.execute("DELETE FROM docs WHERE rowid = ?", row)
+            self._db.execute("DELETE FROM files WHERE id = ?", row)
 
 
 ## Webapp methods ##
 
 
+def static_asset_names():
+    """Map the static assets to their names including a digest of their
+    contents, e.g. edit.css -> edit.0123456789ab.css
+
+    :returns: dict
+    """
+    global _static_asset_names
+    if _static_asset_names is None:
+        names = {}
+        for name in STATIC_ASSETS:
+            with open(os.path.join(static_path, name), "rb") as f:
+                digest = hashlib.sha1(f.read()).hexdigest()[:12]
+            base, ext = os.path.splitext(name)
+            names[name] = "%s.%s%s" % (base, digest, ext)
+        _static_asset_names = names
+
+    return _static_asset_names
+
+
+_static_asset_names = None
+
+
+def asset_url(name):
+    """URL of a static asset. It changes when the asset changes, so that
+    browsers can cache it forever.
+
+    :returns: str
+    """
+    return "/static/" + static_asset_names()[name]
+
+
+bottle.BaseTemplate.defaults["asset_url"] = asset_url
+
+
 def post_get(name):
     return bottle.request.forms[name].strip()
 
@@ -210,6 +840,118 @@ def msg(text):
     return bottle.template("msgbox", output=text.split("\n"), errmsg="")
 
 
+def list_current_dir(path):
+    """List the contents of the directory containing path,
+    using the content index when available
+
+    :returns: (dirs, files) lists of (url, name) tuples
+    """
+    if content_index is None:
+        dirnames, filenames = path.list_current_dir()
+        return (
+            [(d.as_url, d.basename()) for d in dirnames],
+            [(f.as_url, f.basename()) for f in filenames],
+        )
+
+    return content_index.listdir(path.basedir().as_relative_path)
+
+
+def edit_template_version():
+    """Digest of the edit page template
+
+    :returns: str
+    """
+    global _edit_template_version
+    if _edit_template_version is None:
+        with open(os.path.join(tpl_path, "edit.tpl"), "rb") as f:
+            h = hashlib.sha1(f.read())
+        # The page links the assets by their hashed names
+        for name in STATIC_ASSETS:
+            h.update(asset_url(name).encode())
+        _edit_template_version = h.hexdigest()
+
+    return _edit_template_version
+
+
+_edit_template_version = None
+
+
+def edit_page_validators(path, offset=0):
+    """Compute the ETag and Last-Modified timestamp of an edit page from the
+    file stat data, the directory listing and the page settings
+
+    :returns: (etag, last_modified)
+    """
+    try:
+        st = os.stat(path.as_abs_path)
+        file_key = "%d-%d" % (st.st_mtime_ns, st.st_size)
+        mtime_ns = st.st_mtime_ns
+    except FileNotFoundError:
+        file_key = "-"
+        mtime_ns = 0
+
+    if content_index is None:
+        dirs, files = list_current_dir(path)
+        digest = listing_digest(dirs, files)
+        dir_mtime_ns = os.stat(path.basedir().as_abs_path).st_mtime_ns
+    else:
+        listing = content_index.get_listing(path.basedir().as_relative_path)
+        digest = listing.digest
+        dir_mtime_ns = listing.mtime_ns or 0
+
+    key = "\0".join(
+        (
+            path.as_url,
+            str(offset),
+            file_key,
+            digest,
+            edit_template_version(),
+            " ".join(make_targets or ()),
+            str(bool(git_repo)),
+            str(bool(aaa)),
+        )
+    )
+    etag = '"%s"' % hashlib.sha1(key.encode("utf-8", "surrogateescape")).hexdigest()
+    return etag, max(mtime_ns, dir_mtime_ns) // 10**9
+
+
+def check_not_modified(etag, last_modified):
+    """Set the validators headers and reply with 304 Not Modified
+    if the client has a fresh copy of the page. The ETag is checked first.
+    Last-Modified has a resolution of one second: it is neither sent nor
+    trusted when the page changed during the current second, as it would
+    not change if the page is changed again within that second.
+
+    :returns: the validators headers
+    """
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "private, no-cache",
+    }
+    last_modified = int(last_modified)
+    settled = last_modified < int(time.time())
+    if settled:
+        headers["Last-Modified"] = bottle.http_date(last_modified)
+    for k, v in headers.items():
+        bottle.response.set_header(k, v)
+
+    if_none_match = bottle.request.environ.get("HTTP_IF_NONE_MATCH")
+    if if_none_match is not None:
+        tags = [t.strip() for t in if_none_match.split(",")]
+        tags = [t[2:] if t.startswith("W/") else t for t in tags]
+        fresh = etag in tags or "*" in tags
+
+    else:
+        ims = bottle.request.environ.get("HTTP_IF_MODIFIED_SINCE")
+        ims = ims and bottle.parse_date(ims.split(";")[0].strip())
+        fresh = bool(ims) and settled and last_modified <= ims
+
+    if fresh:
+        raise bottle.HTTPResponse(status=304, headers=headers)
+
+    return headers
+
+
 path_not_found = error("Error: the directory you specified does not exists.")
 
 
@@ -225,15 +967,449 @@ def route_login_form():
     pass
 
 
+class Histogram(object):
+    """Thread-safe histogram of durations in seconds, counting values up to
+    each bucket upper bound as Prometheus does
+    """
+
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        n = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[n] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q):
+        """Estimate a quantile as the upper bound of the bucket holding it
+
+        :returns: float (inf beyond the last bucket) or None if empty
+        """
+        with self._lock:
+            rank = q * self.count
+            seen = 0
+            for n, cnt in enumerate(self.counts):
+                seen += cnt
+                if cnt and seen >= rank:
+                    return self.buckets[n] if n < len(self.buckets) else math.inf
+
+        return None
+
+
+class Counter(object):
+    """Thread-safe counter"""
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Metric(object):
+    """Counters, or histograms if buckets are set, sharing a name: one for
+    each combination of label values
+    """
+
+    def __init__(self, name, help, labelnames=(), buckets=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = buckets
+        self.kind = "counter" if buckets is None else "histogram"
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        """:returns: :class:`Counter` or :class:`Histogram`"""
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    if self.buckets is None:
+                        child = Counter()
+                    else:
+                        child = Histogram(self.buckets)
+                    self._children[values] = child
+
+        return child
+
+    def snapshot(self):
+        """:returns: [[label values, count or [bucket counts, sum]], ...]"""
+        with self._lock:
+            children = list(self._children.items())
+        if self.buckets is None:
+            return [[list(values), c.value] for values, c in children]
+
+        snap = []
+        for values, h in children:
+            with h._lock:
+                snap.append([list(values), [list(h.counts), h.sum]])
+        return snap
+
+
+class MetricsRegistry(object):
+    """Metrics of this process, served at /metrics in the Prometheus text
+    format. With worker processes, each one saves its metrics in a shared
+    directory at most every flush_interval seconds, when serving requests,
+    and /metrics reports the sum.
+    """
+
+    flush_interval = 5
+
+    def __init__(self):
+        self.directory = None
+        self._metrics = []
+        self._next_flush = 0
+        self._flush_lock = threading.Lock()
+
+    def counter(self, name, help, labelnames=()):
+        metric = Metric(name, help, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labelnames=(), buckets=Histogram.default_buckets):
+        metric = Metric(name, help, labelnames, tuple(buckets))
+        self._metrics.append(metric)
+        return metric
+
+    def snapshot(self):
+        """:returns: {name: metric snapshot}"""
+        return {m.name: m.snapshot() for m in self._metrics}
+
+    def flush(self, force=False):
+        """Save the metrics of this process for the other workers"""
+        if self.directory is None:
+            return
+        now = time.monotonic()
+        if not force and now < self._next_flush:
+            return
+        if not self._flush_lock.acquire(blocking=False):
+            return
+
+        try:
+            self._next_flush = now + self.flush_interval
+            path = os.path.join(self.directory, "%d.json" % os.getpid())
+            with open(path + ".tmp", "w") as f:
+                json.dump(self.snapshot(), f)
+            os.replace(path + ".tmp", path)
+        finally:
+            self._flush_lock.release()
+
+    def collect(self):
+        """Sum the metrics of this process and the ones saved by the
+        other workers, including those that exited
+
+        :returns: {name: {label values: count or [bucket counts, sum]}}
+        """
+        snapshots = [self.snapshot()]
+        own = "%d.json" % os.getpid()
+        if self.directory is not None:
+            for fname in os.listdir(self.directory):
+                if fname.endswith(".json") and fname != own:
+                    try:
+                        with open(os.path.join(self.directory, fname)) as f:
+                            snapshots.append(json.load(f))
+                    except (OSError, ValueError):
+                        pass
+
+        totals = {m.name: {} for m in self._metrics}
+        for snap in snapshots:
+            for name, children in snap.items():
+                metric_totals = totals.get(name)
+                if metric_totals is None:
+                    continue
+                for values, data in children:
+                    values = tuple(values)
+                    if values not in metric_totals:
+                        metric_totals[values] = data
+                    elif isinstance(data, list):
+                        counts, total = metric_totals[values]
+                        counts = [a + b for a, b in zip(counts, data[0])]
+                        metric_totals[values] = [counts, total + data[1]]
+                    else:
+                        metric_totals[values] += data
+
+        return totals
+
+    def render(self):
+        """:returns: str in the Prometheus text exposition format"""
+        totals = self.collect()
+        lines = []
+        for m in self._metrics:
+            lines.append("# HELP %s %s" % (m.name, m.help))
+            lines.append("# TYPE %s %s" % (m.name, m.kind))
+            for values, data in sorted(totals[m.name].items()):
+                labels = list(zip(m.labelnames, values))
+                if m.buckets is None:
+                    lines.append("%s%s %s" % (m.name, _labels(labels), data))
+                    continue
+
+                counts, total = data
+                cumulative = 0
+                bounds = [repr(float(b)) for b in m.buckets] + ["+Inf"]
+                for le, cnt in zip(bounds, counts):
+                    cumulative += cnt
+                    le_labels = _labels(labels + [("le", le)])
+                    lines.append("%s_bucket%s %d" % (m.name, le_labels, cumulative))
+                lines.append("%s_sum%s %r" % (m.name, _labels(labels), total))
+                lines.append("%s_count%s %d" % (m.name, _labels(labels), cumulative))
+
+        return "\n".join(lines) + "\n"
+
+
+def _labels(pairs):
+    """Format Prometheus labels from (name, value) pairs"""
+    if not pairs:
+        return ""
+    escaped = (
+        (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in pairs
+    )
+    return "{%s}" % ",".join('%s="%s"' % kv for kv in escaped)
+
+
+def timed(metric, *labels):
+    """Decorator recording the duration of each call in a histogram"""
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            t0 = time.monotonic()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                metric.labels(*labels).observe(time.monotonic() - t0)
+
+        return wrapper
+
+    return decorator
+
+
+# File sizes, from 1 KiB to 64 MiB
+SIZE_BUCKETS = tuple(1024 * 4**n for n in range(9))
+
+metrics = MetricsRegistry()
+http_requests = metrics.counter(
+    "shoebill_http_requests_total",
+    "HTTP requests handled, by route",
+    ("route", "method", "status"),
+)
+http_request_duration = metrics.histogram(
+    "shoebill_http_request_duration_seconds",
+    "Time spent handling HTTP requests, by route",
+    ("route", "method"),
+)
+make_runs = metrics.counter(
+    "shoebill_make_runs_total", "make runs, by exit code", ("target", "exit_code")
+)
+make_duration = metrics.histogram(
+    "shoebill_make_duration_seconds",
+    "Duration of make runs",
+    ("target",),
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600),
+)
+git_duration = metrics.histogram(
+    "shoebill_git_operation_duration_seconds",
+    "Duration of Git operations",
+    ("operation",),
+)
+file_read_bytes = metrics.histogram(
+    "shoebill_file_read_bytes", "Size of the files read", buckets=SIZE_BUCKETS
+)
+file_write_bytes = metrics.histogram(
+    "shoebill_file_write_bytes", "Size of the files written", buckets=SIZE_BUCKETS
+)
+auth_check_duration = metrics.histogram(
+    "shoebill_auth_check_duration_seconds",
+    "Time spent checking if requests are authenticated",
+)
+
+
+class PasswordHasherBusy(Exception):
+    """Too many password hashes are waiting to be computed"""
+
+
+class PasswordHasher(object):
+    """Hash passwords in a pool of processes, as scrypt keeps a CPU busy
+    and would stall the threads serving requests. Hashes beyond the queue
+    limit are refused with :class:`PasswordHasherBusy`.
+    The pool is started on first use, hence in each worker process.
+    """
+
+    def __init__(
+        self, processes=PASSWORD_HASH_PROCESSES, max_queue=PASSWORD_HASH_QUEUE
+    ):
+        self.processes = processes
+        self.max_queue = max_queue
+        self.pending = 0
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def run(self, fn, *args):
+        """Call fn(*args) in the pool and wait for the result"""
+        with self._lock:
+            if self.pending >= self.max_queue:
+                raise PasswordHasherBusy()
+            self.pending += 1
+            if self._pool is None:
+                # Forking a process running threads could copy held locks
+                ctx = multiprocessing.get_context("forkserver")
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    self.processes, mp_context=ctx
+                )
+            pool = self._pool
+
+        try:
+            return pool.submit(fn, *args).result()
+        except concurrent.futures.process.BrokenProcessPool:
+            with self._lock:
+                if self._pool is pool:
+                    self._pool = None
+            raise
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    def close(self):
+        """Stop the pool processes"""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown()
+
+
+password_hasher = PasswordHasher()
+# Left running, the pool is torn down after the modules it needs when
+# daemon threads are still alive
+atexit.register(password_hasher.close)
+
+
+class PooledCork(Cork):
+    """Cork computing password hashes in :data:`password_hasher`"""
+
+    @timed(auth_check_duration)
+    def require(self, *args, **kwargs):
+        return super(PooledCork, self).require(*args, **kwargs)
+
+    _hash_functions = {"PBKDF2": "_hash_pbkdf2", "scrypt": "_hash_scrypt"}
+    _hash_types = {b"p": "PBKDF2", b"s": "scrypt"}
+
+    def __init__(self, *args, preferred_hashing_algorithm="PBKDF2", **kw):
+        super(PooledCork, self).__init__(*args, **kw)
+        self.preferred_hashing_algorithm = preferred_hashing_algorithm
+
+    def _hash(self, username, pwd, salt=None, algo=None):
+        algo = algo or self.preferred_hashing_algorithm
+        if algo not in self._hash_functions:
+            raise RuntimeError("Unknown hashing algorithm requested: %s" % algo)
+
+        # Static methods of Cork can be pickled and run in the pool
+        fn = getattr(Cork, self._hash_functions[algo])
+        return password_hasher.run(fn, username, pwd, salt)
+
+    def _verify_password(self, username, pwd, salted_hash):
+        decoded = b64decode(salted_hash)
+        algo = self._hash_types.get(decoded[:1])
+        if algo is None:
+            raise RuntimeError("Unknown hashing algorithm in hash: %r" % decoded)
+
+        h = self._hash(username, pwd, decoded[1:33], algo)
+        return hmac.compare_digest(h, salted_hash)
+
+
+class LoginThrottle(object):
+    """Slow down password guessing: once a client address has failed to
+    log in free_attempts times, each further failure doubles the time it
+    must wait before trying again, up to max_delay seconds. Only the most
+    recent max_clients addresses are tracked.
+    """
+
+    def __init__(self, free_attempts=5, max_delay=300, max_clients=10000):
+        self.free_attempts = free_attempts
+        self.max_delay = max_delay
+        self._max_clients = max_clients
+        self._lock = threading.Lock()
+        # address -> (failures, time of the last failure)
+        self._failures = collections.OrderedDict()
+
+    def retry_after(self, addr):
+        """:returns: seconds to wait before the next attempt, 0 if none"""
+        with self._lock:
+            failures, last = self._failures.get(addr, (0, 0))
+
+        if failures < self.free_attempts:
+            return 0
+
+        delay = min(2 ** (failures - self.free_attempts), self.max_delay)
+        return max(0, last + delay - time.monotonic())
+
+    def failed(self, addr):
+        with self._lock:
+            failures, _ = self._failures.pop(addr, (0, 0))
+            self._failures[addr] = (failures + 1, time.monotonic())
+            if len(self._failures) > self._max_clients:
+                self._failures.popitem(last=False)
+
+    def succeeded(self, addr):
+        with self._lock:
+            self._failures.pop(addr, None)
+
+
+login_throttle = LoginThrottle()
+login_latency = metrics.histogram(
+    "shoebill_login_duration_seconds", "Duration of logins, including password hashing"
+).labels()
+
+
+def password_hasher_busy():
+    """:returns: 503 error page asking to retry"""
+    bottle.response.status = 503
+    bottle.response.set_header("Retry-After", "1")
+    return error("The server is busy, please retry in a moment")
+
+
 @bottle.post("/login")
 def login():
-    """Authenticate users"""
+    """Authenticate users. Clients that keep failing are slowed down."""
     if not aaa:
         return bottle.redirect("/edit")
 
+    # Not the spoofable X-Forwarded-For header
+    addr = bottle.request.environ.get("REMOTE_ADDR")
+    wait = login_throttle.retry_after(addr)
+    if wait:
+        bottle.response.status = 429
+        bottle.response.set_header("Retry-After", str(math.ceil(wait)))
+        return error("Too many failed logins, retry in %d seconds" % math.ceil(wait))
+
     username = post_get("username")
     password = post_get("password")
-    aaa.login(username, password, success_redirect="/edit", fail_redirect="/login")
+    t0 = time.monotonic()
+    try:
+        authenticated = aaa.login(username, password)
+    except PasswordHasherBusy:
+        return password_hasher_busy()
+    finally:
+        login_latency.observe(time.monotonic() - t0)
+
+    if not authenticated:
+        login_throttle.failed(addr)
+        return bottle.redirect("/login")
+
+    login_throttle.succeeded(addr)
+    return bottle.redirect("/edit")
 
 
 @bottle.route("/logout")
@@ -261,7 +1437,10 @@ def route_change_password():
 
     aaa.require(fail_redirect="/login")
     password = post_get("password")
-    aaa.current_user.update(pwd=password)
+    try:
+        aaa.current_user.update(pwd=password)
+    except PasswordHasherBusy:
+        return password_hasher_busy()
 
     return msg("Password updated.")
 
@@ -297,14 +1476,41 @@ def route_edit(path="", savemsg=None):
         # path ends without '/' but there is a directory with that name
         return bottle.redirect(path.as_url + "/")
 
+    try:
+        offset = int(bottle.request.query.offset or 0)
+    except ValueError:
+        offset = 0
+
+    if bottle.request.method in ("GET", "HEAD"):
+        check_not_modified(*edit_page_validators(path, offset))
+
     contents = ""
+    page = None
+    page_readonly = False
     if path.is_real_file and not path.is_dir:
-        with open(path.as_abs_path) as f:
-            contents = f.read()
+        size = os.path.getsize(path.as_abs_path)
+        if size > large_file_threshold:
+            page = read_file_page(path.as_abs_path, offset, LARGE_FILE_PAGE_SIZE)
+            try:
+                contents = page.data.decode("utf-8")
+            except UnicodeDecodeError:
+                # Saving it back would replace the bytes that are not UTF-8
+                contents = page.data.decode("utf-8", errors="replace")
+                page_readonly = True
+            file_read_bytes.labels().observe(len(page.data))
+        else:
+            with open(path.as_abs_path) as f:
+                contents = f.read()
+            file_read_bytes.labels().observe(size)
 
+    cwd_dirnames, cwd_filenames = list_current_dir(path)
     d = dict(
         path=path,
         contents=contents,
+        page=page,
+        page_readonly=page_readonly,
+        cwd_dirnames=cwd_dirnames,
+        cwd_filenames=cwd_filenames,
         savemsg=savemsg,
         git_enabled=bool(git_repo),
         make_targets=make_targets,
@@ -313,115 +1519,3031 @@ def route_edit(path="", savemsg=None):
     return d
 
 
-@bottle.post("/edit/<path:path>")
-def route_post_save(path):
-    """Save changes to a file (or create new file)
-    Commits on Git if a repository exists.
-    """
-    if aaa:
-        aaa.require(fail_redirect="/login")
+FilePage = collections.namedtuple("FilePage", "start end size prev base data")
 
-    path = path.strip()
-    path = Path(relurl=path)
-    if path.is_dir or path.is_real_dir:
-        # Path should point to a file, not a directory
-        return path_not_found
 
-    if not path.basedir().is_real_dir:
-        # The file should be in an existing directory
-        return path_not_found
+def file_version(st):
+    """Identify a version of a file from its stat data
 
-    if path.is_hidden:
-        # hidden files are not accessible
-        return path_not_found
+    :returns: str
+    """
+    return "%d-%d" % (st.st_mtime_ns, st.st_size)
 
-    already_existing = path.is_real_file
 
-    print("writing %s", path.as_abs_path)
-    file_contents = bottle.request.forms.file_contents
-    with open(path.as_abs_path, "w") as f:
-        f.write(file_contents)
+def _utf8_boundary(m, pos):
+    """Move pos back to the beginning of a UTF-8 character"""
+    while pos > 0 and m[pos] & 0xC0 == 0x80:
+        pos -= 1
 
-    if not git_repo:
-        return route_edit(path=path.as_url, savemsg="Saved.")
+    return pos
 
-    repo_is_dirty = git_repo.is_dirty()
-    git_repo.git.add(path.as_abs_path)
-    repo_is_dirty = repo_is_dirty or git_repo.is_dirty()
 
-    if already_existing and not repo_is_dirty:
-        return route_edit(path=path.as_url, savemsg="No changes to be saved!")
+def _page_start(m, pos, page_size):
+    """Move pos back to the beginning of its line, or of its UTF-8 character
+    if the line is longer than a page
+    """
+    if pos <= 0:
+        return 0
 
-    description = post_get("desc") or "Update %s" % path.as_abs_path
+    nl = m.rfind(b"\n", max(0, pos - page_size), pos)
+    if nl >= 0:
+        return nl + 1
 
-    if aaa:
-        cu = aaa.current_user
-        email_addr = cu.email_addr or ""
-        author = "%s <%s>" % (cu.username, email_addr)
-        git_repo.git.commit(m=description, author=author)
+    return _utf8_boundary(m, pos)
 
-    else:
-        git_repo.git.commit(m=description)
 
-    return route_edit(path=path.as_url, savemsg="Saved.")
+def read_file_page(abspath, offset, page_size):
+    """Read a page of about page_size bytes from a file, aligned to line
+    boundaries when possible. The file is mmap-ed: memory usage does not
+    depend on the file size.
 
+    :returns: :class:`FilePage`
+    """
+    with open(abspath, "rb") as f:
+        st = os.fstat(f.fileno())
+        size = st.st_size
+        if size == 0:
+            return FilePage(0, 0, 0, None, file_version(st), b"")
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            start = _page_start(m, min(max(offset, 0), size - 1), page_size)
+            end = start + page_size
+            if end >= size:
+                end = size
+            else:
+                nl = m.find(b"\n", end - 1, end - 1 + page_size)
+                end = nl + 1 if nl >= 0 else _utf8_boundary(m, end)
+
+            prev = None
+            if start > 0:
+                pos = max(0, start - page_size)
+                if pos <= page_size and m.rfind(b"\n", 0, pos) < 0:
+                    prev = 0
+                else:
+                    prev = _page_start(m, pos, page_size)
+
+            return FilePage(start, end, size, prev, file_version(st), m[start:end])
+
+
+def patch_file(abspath, offset, length, data):
+    """Replace length bytes at offset with data, atomically: a copy of the
+    file is created and renamed over it, copying the unchanged parts with
+    copy_file_range where available.
+    """
+    file_write_bytes.labels().observe(len(data))
+    with open(abspath, "rb") as src:
 
-@bottle.route("/make")
-@bottle.route("/make/")
-@bottle.route("/make/<target>")
-def route_get_make_target(target=None):
-    """Redirect GETs on /make to /edit"""
-    if aaa:
-        aaa.require(fail_redirect="/login")
+        def fill(tmpfd):
+            size = os.fstat(src.fileno()).st_size
+            _copy_range(src.fileno(), tmpfd, 0, offset)
+            _write_all(tmpfd, data)
+            tail = size - offset - length
+            _copy_range(src.fileno(), tmpfd, offset + length, tail)
 
-    raise bottle.redirect("/edit/")
+        replace_file(abspath, fill)
 
 
-@bottle.post("/make/<target>")
-@bottle.view("msgbox")
-def route_run_make_target(target):
-    """Execute make target, serve output page"""
-    global content_path
-    global make_targets
+def replace_file(abspath, fill):
+    """Replace a file atomically: fill(fd) writes the new contents into a
+    temporary file in the same directory, which is then renamed over
+    abspath. Readers see either the old or the new file, never a partial
+    one. Nothing is changed if fill returns False or raises.
+    If abspath is a symlink, the file it points to is replaced.
 
-    if aaa:
-        aaa.require(fail_redirect="/login")
+    :returns: True if the file has been replaced
+    """
+    abspath = os.path.realpath(abspath)
+    dirname, basename = os.path.split(abspath)
+    tmpfd, tmpname = tempfile.mkstemp(dir=dirname, prefix=".%s." % basename)
+    try:
+        try:
+            replace = fill(tmpfd) is not False
+            if replace and fsync_policy != "none":
+                os.fsync(tmpfd)
+        finally:
+            os.close(tmpfd)
+
+        if replace:
+            try:
+                shutil.copymode(abspath, tmpname)
+            except FileNotFoundError:
+                os.chmod(tmpname, NEW_FILE_MODE)
+            os.replace(tmpname, abspath)
+
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+
+    if not replace:
+        os.unlink(tmpname)
+        return False
 
-    target = target.strip()
-    print("Running target: %r" % target)
+    if fsync_policy == "full":
+        dirfd = os.open(dirname, os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
 
-    if target != "publish" and target not in make_targets:
-        return error("Unknown make target")
+    return True
 
-    site_path = os.path.dirname(content_path)
 
-    cmd = subprocess.Popen(
-        ["make", target],
-        cwd=site_path,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-    )
-    output = cmd.communicate()[0]
-    output = output.decode().split("\n")
-    return dict(output=output, errmsg=None)
+def write_file(abspath, chunks):
+    """Write an iterable of bytes into a file atomically. The write is
+    skipped if the file already has the same contents, leaving its mtime
+    untouched.
 
+    :returns: True if the file has been written
+    """
 
-@bottle.route("/favicon.ico")
-def serve_favicon():
-    return bottle.static_file("favicon.ico", root=static_path)
+    sizes = []
 
+    def fill(tmpfd):
+        h = hashlib.sha256()
+        size = 0
+        for chunk in chunks:
+            h.update(chunk)
+            size += len(chunk)
+            _write_all(tmpfd, chunk)
 
-# Admin-only pages
+        sizes.append(size)
+        return file_digest(abspath, size) != h.digest()
 
+    written = replace_file(abspath, fill)
+    if written:
+        file_write_bytes.labels().observe(sizes[0])
+    return written
 
-@bottle.route("/admin")
+
+def file_digest(abspath, size=None):
+    """Hash the contents of a file with SHA-256
+
+    :returns: digest (bytes) or None if the file does not exist or its size
+        is not the expected one
+    """
+    try:
+        with open(abspath, "rb") as f:
+            if size is not None and os.fstat(f.fileno()).st_size != size:
+                return None
+            h = hashlib.sha256()
+            for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b""):
+                h.update(chunk)
+            return h.digest()
+    except FileNotFoundError:
+        return None
+
+
+def iter_form_field(name):
+    """Generate the value of a form field as chunks of UTF-8 encoded bytes.
+    Large fields of multipart forms are spooled to disk by Bottle and read
+    back in chunks.
+    """
+    value = bottle.request.POST.get(name)
+    if isinstance(value, bottle.FileUpload):
+        value.file.seek(0)
+        yield from iter(lambda: value.file.read(COPY_CHUNK_SIZE), b"")
+    else:
+        yield bottle.request.forms.getunicode(name, default="").encode("utf-8")
+
+
+def _write_all(fd, data, offset=None):
+    """Write data to a file descriptor, at offset if set"""
+    view = memoryview(data)
+    while view:
+        if offset is None:
+            written = os.write(fd, view)
+        else:
+            written = os.pwrite(fd, view, offset)
+            offset += written
+        view = view[written:]
+
+
+def _copy_range(srcfd, dstfd, offset, count):
+    """Copy count bytes of srcfd from offset to the current position of dstfd"""
+    if hasattr(os, "copy_file_range"):
+        try:
+            while count > 0:
+                copied = os.copy_file_range(srcfd, dstfd, count, offset)
+                if copied == 0:
+                    return
+                offset += copied
+                count -= copied
+            return
+        except OSError:
+            # Not supported by the filesystem: fall back to read/write
+            pass
+
+    while count > 0:
+        chunk = os.pread(srcfd, min(count, COPY_CHUNK_SIZE), offset)
+        if not chunk:
+            return
+        _write_all(dstfd, chunk)
+        offset += len(chunk)
+        count -= len(chunk)
+
+
+def save_file_page(path, data):
+    """Save the page of a large file edited in the form. The write is
+    skipped if the page is unchanged.
+
+    :returns: True if the file has been written
+    :raises: ValueError if the file changed after the page was served
+    """
+    forms = bottle.request.forms
+    try:
+        offset = int(forms.page_offset)
+        length = int(forms.page_length)
+    except ValueError:
+        raise ValueError("Invalid page")
+
+    try:
+        st = os.stat(path.as_abs_path)
+    except FileNotFoundError:
+        raise ValueError("The file has been deleted")
+
+    if file_version(st) != forms.page_base:
+        raise ValueError("The file has been changed, please reload it")
+
+    if offset < 0 or length < 0 or offset + length > st.st_size:
+        raise ValueError("Invalid page")
+
+    if length > 2 * LARGE_FILE_PAGE_SIZE:
+        raise ValueError("Invalid page")
+
+    with open(path.as_abs_path, "rb") as f:
+        current = os.pread(f.fileno(), length, offset)
+    try:
+        current.decode("utf-8")
+    except UnicodeDecodeError:
+        raise ValueError("This page is not UTF-8 text and cannot be edited")
+
+    if not forms.page_crlf:
+        # Browsers submit textarea contents with CRLF line endings
+        data = data.replace(b"\r\n", b"\n")
+
+    if data == current:
+        return False
+
+    patch_file(path.as_abs_path, offset, length, data)
+    return True
+
+
+@bottle.route("/raw/<path:path>")
+def route_raw(path):
+    """Serve the contents of a file as bytes, supporting Range requests"""
+    if aaa:
+        aaa.require(fail_redirect="/login")
+
+    path = Path(relurl=path.strip())
+    if path.is_dir or path.is_hidden or not path.is_real_file:
+        raise bottle.HTTPError(404, "File not found")
+
+    return serve_file_range(path.as_abs_path)
+
+
+def serve_file_range(abspath, headers=None):
+    """Serve a file or the byte range set in the Range header, reading
+    it through mmap in chunks of MMAP_CHUNK_SIZE bytes
+
+    :param headers: additional response headers
+    :returns: :class:`bottle.HTTPResponse`
+    """
+    f = open(abspath, "rb")
+    size = os.fstat(f.fileno()).st_size
+    headers = dict(headers or {})
+    headers["Content-Type"] = "application/octet-stream"
+    headers["Accept-Ranges"] = "bytes"
+    status = 200
+    start, end = 0, size
+    range_header = bottle.request.environ.get("HTTP_RANGE")
+    if range_header:
+        ranges = list(bottle.parse_range_header(range_header, size))
+        if not ranges:
+            f.close()
+            headers["Content-Range"] = "bytes */%d" % size
+            return bottle.HTTPResponse(status=416, headers=headers)
+
+        start, end = ranges[0]
+        headers["Content-Range"] = "bytes %d-%d/%d" % (start, end - 1, size)
+        status = 206
+
+    headers["Content-Length"] = str(end - start)
+    file_read_bytes.labels().observe(end - start)
+    return bottle.HTTPResponse(iter_mmap(f, start, end), status=status, headers=headers)
+
+
+def iter_mmap(f, start, end):
+    """Generate the contents of a file between start and end in chunks,
+    then close it
+    """
+    try:
+        if end <= start:
+            return
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            for pos in range(start, end, MMAP_CHUNK_SIZE):
+                yield m[pos : min(pos + MMAP_CHUNK_SIZE, end)]
+    finally:
+        f.close()
+
+
+@bottle.route("/search")
+@bottle.view("search")
+def route_search():
+    """Search the content dir, serve a list of matching files"""
+    if aaa:
+        aaa.require(fail_redirect="/login")
+
+    query = bottle.request.query.getunicode("q", "").strip()
+    results = []
+    if query and search_index is not None:
+        results = search_index.search(query)
+
+    return dict(query=query, results=results, search_enabled=bool(search_index))
+
+
+@bottle.post("/edit/<path:path>")
+def route_post_save(path):
+    """Save changes to a file (or create new file)
+    Commits on Git if a repository exists.
+    """
+    if aaa:
+        aaa.require(fail_redirect="/login")
+
+    path = path.strip()
+    path = Path(relurl=path)
+    if not is_valid_file_path(path):
+        return path_not_found
+
+    print("writing %s", path.as_abs_path)
+    file_contents = iter_form_field("file_contents")
+    description = bottle.request.forms.desc.strip()
+    description = description or "Update %s" % path.as_abs_path
+    with locks.writing(path.as_relative_path):
+        already_existing = path.is_real_file
+        if bottle.request.forms.page_offset:
+            # Only a page of a large file has been edited
+            try:
+                written = save_file_page(path, b"".join(file_contents))
+            except ValueError as e:
+                return error(str(e))
+
+        else:
+            written = write_file(path.as_abs_path, file_contents)
+
+        if written:
+            record_changed_file(path, listing_changed=not already_existing)
+
+        if not git_repo:
+            savemsg = "Saved." if written else "No changes to be saved!"
+            return route_edit(path=path.as_url, savemsg=savemsg)
+
+        committed = commit_file(path, description)
+
+    if not committed and already_existing:
+        return route_edit(path=path.as_url, savemsg="No changes to be saved!")
+
+    if committer.delay:
+        return route_edit(path=path.as_url, savemsg="Saved, commit pending.")
+
+    return route_edit(path=path.as_url, savemsg="Saved.")
+
+
+def is_valid_file_path(path):
+    """Check if a path can point to a file: it must not be a directory,
+    it must not be hidden (this also prevents directory traversal) and it
+    must be in an existing directory
+
+    :returns: bool
+    """
+    if path.is_dir or path.is_real_dir or path.is_hidden:
+        return False
+
+    return path.basedir().is_real_dir
+
+
+def record_changed_file(path, listing_changed):
+    """Update the pending builds and the indexes after a file has been
+    written or deleted
+
+    :param listing_changed: the file has been created or deleted
+    """
+    build_queue.record_change(path.as_site_relative_path)
+    if content_index is not None and listing_changed:
+        content_index.invalidate(path.basedir().as_relative_path)
+    if search_index is not None:
+        search_index.update(path.as_relative_path)
+
+
+def current_author():
+    """:returns: "username <email>" of the logged in user or None"""
+    if not aaa:
+        return None
+
+    cu = aaa.current_user
+    email_addr = cu.email_addr or ""
+    return "%s <%s>" % (cu.username, email_addr)
+
+
+def commit_file(path, description, deleted=False):
+    """Stage a file and hand it over to the committer, if it has changes
+
+    :returns: True if the file has changes to be committed
+    """
+    # Git commands are limited to the file: their cost does not
+    # depend on the size of the worktree
+    git_path = path.as_site_relative_path
+    with git_lock:
+        if deleted:
+            git_ops.stage_removal([git_path])
+        else:
+            git_ops.stage([git_path])
+        if not git_ops.changed_paths([git_path]):
+            return False
+
+    committer.add(git_path, description, current_author())
+    return True
+
+
+# JSON API for scripts. Pages are not rendered and directory listings come
+# from the content index.
+
+
+def api_error(status, msg):
+    """:returns: :class:`bottle.HTTPResponse` with a JSON error message"""
+    body = json.dumps({"error": msg})
+    return bottle.HTTPResponse(
+        body, status, headers={"Content-Type": "application/json"}
+    )
+
+
+def api_require_auth(role=None):
+    """Reply 401 to clients that are not logged in, or lack the role if
+    set, instead of redirecting them to the login form
+    """
+    if aaa:
+        try:
+            aaa.require(role=role)
+        except AuthException:
+            raise api_error(401, "Authentication required")
+
+
+def api_file_path(relurl):
+    """Validate a file path sent by an API client
+
+    :returns: :class:`Path`
+    """
+    path = Path(relurl=relurl.strip())
+    if not is_valid_file_path(path):
+        raise api_error(404, "Invalid path")
+
+    return path
+
+
+def iter_request_body():
+    """Generate the request body in chunks. When its length is known it is
+    read straight from the WSGI input, without being spooled.
+    """
+    length = bottle.request.content_length
+    if length < 0 or "bottle.request.body" in bottle.request.environ:
+        body = bottle.request.body
+        yield from iter(lambda: body.read(COPY_CHUNK_SIZE), b"")
+        return
+
+    stream = bottle.request.environ["wsgi.input"]
+    while length > 0:
+        chunk = stream.read(min(length, COPY_CHUNK_SIZE))
+        if not chunk:
+            raise EOFError("Incomplete request body")
+        length -= len(chunk)
+        yield chunk
+
+
+@bottle.get("/api/files/<path:path>")
+def route_api_get_file(path):
+    """Send the contents of a file"""
+    api_require_auth()
+    path = api_file_path(path)
+    try:
+        st = os.stat(path.as_abs_path)
+    except FileNotFoundError:
+        raise api_error(404, "File not found")
+
+    headers = check_not_modified('"%s"' % file_version(st), st.st_mtime)
+    return serve_file_range(path.as_abs_path, headers)
+
+
+@bottle.put("/api/files/<path:path>")
+def route_api_put_file(path):
+    """Create or replace a file with the request body.
+    The optional "desc" query parameter sets the commit message.
+    """
+    api_require_auth()
+    path = api_file_path(path)
+    desc = bottle.request.query.desc or "Update %s" % path.as_abs_path
+    with locks.writing(path.as_relative_path):
+        created = not path.is_real_file
+        try:
+            written = write_file(path.as_abs_path, iter_request_body())
+        except EOFError as e:
+            raise api_error(400, str(e))
+        if written:
+            record_changed_file(path, listing_changed=created)
+            if git_repo:
+                commit_file(path, desc)
+
+    bottle.response.status = 201 if created else 200
+    return {"path": path.as_url, "changed": written}
+
+
+@bottle.delete("/api/files/<path:path>")
+def route_api_delete_file(path):
+    """Delete a file.
+    The optional "desc" query parameter sets the commit message.
+    """
+    api_require_auth()
+    path = api_file_path(path)
+    desc = bottle.request.query.desc or "Delete %s" % path.as_abs_path
+    with locks.writing(path.as_relative_path):
+        try:
+            os.unlink(path.as_abs_path)
+        except FileNotFoundError:
+            raise api_error(404, "File not found")
+
+        record_changed_file(path, listing_changed=True)
+        if git_repo:
+            commit_file(path, desc, deleted=True)
+
+    bottle.response.status = 204
+
+
+class ChunkReader(io.RawIOBase):
+    """Read-only file object over an iterable of bytes"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buf:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._buf = memoryview(chunk)
+
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+        return n
+
+
+def iter_tar_members(fileobj):
+    """Read a (possibly compressed) tar archive sequentially
+
+    :returns: generator of (name, kind, fileobj) where kind is "dir", "file"
+        or None for unsupported member types
+    """
+    with tarfile.open(fileobj=fileobj, mode="r|*") as tf:
+        for m in tf:
+            if m.isdir():
+                yield m.name, "dir", None
+            elif m.isfile():
+                yield m.name, "file", tf.extractfile(m)
+            else:
+                yield m.name, None, None
+
+
+def iter_zip_members(fileobj):
+    """Read a zip archive. fileobj must be seekable.
+
+    :returns: generator of (name, kind, fileobj), as :func:`iter_tar_members`
+    """
+    with zipfile.ZipFile(fileobj) as zf:
+        for info in zf.infolist():
+            if info.is_dir():
+                yield info.filename, "dir", None
+            elif stat.S_ISLNK(info.external_attr >> 16):
+                yield info.filename, None, None
+            else:
+                with zf.open(info) as f:
+                    yield info.filename, "file", f
+
+
+def create_parent_dirs(path):
+    """Create the missing directories containing path. Paths ending with a
+    slash are directories and are created too.
+    """
+    missing = []
+    d = path.basedir()
+    while not d.is_real_dir:
+        missing.append(d)
+        d = d.basedir()
+
+    for d in reversed(missing):
+        try:
+            os.mkdir(d.as_abs_path)
+        except FileExistsError:
+            # Created by a concurrent request
+            continue
+        if content_index is not None:
+            content_index.invalidate(d.basedir().as_relative_path)
+
+
+def import_archive(members):
+    """Write the files of an archive into the content dir, one at a time
+    as the archive is read. Paths are validated as in the editor.
+
+    :param members: generator from :func:`iter_tar_members` or
+        :func:`iter_zip_members`
+    :returns: (results, written, error) where results is a list of
+        per-member dicts, written the list of the :class:`Path` written and
+        error a message if the archive is invalid or cannot be read to the
+        end. Files extracted before the error are kept.
+    """
+    results = []
+    written = []
+    try:
+        for result, path in _import_members(members):
+            results.append(result)
+            if path is not None:
+                written.append(path)
+    except (tarfile.TarError, zipfile.BadZipFile, zlib.error, EOFError) as e:
+        return results, written, "Invalid archive: %s" % e
+    except OSError as e:
+        # e.g. the client disconnected
+        return results, written, "Unable to read the archive: %s" % e
+
+    return results, written, None
+
+
+def _import_members(members):
+    """Extract archive members
+
+    :returns: generator of (result, path) where path is the :class:`Path`
+        written or None
+    """
+    for name, kind, f in members:
+        parts = [p for p in name.split("/") if p not in ("", ".")]
+        if not parts:
+            continue
+
+        relurl = "/".join(parts)
+        if kind is None:
+            error = "Unsupported file type"
+            yield {"path": relurl, "status": "rejected", "error": error}, None
+            continue
+
+        path = Path(relurl=relurl + "/" if kind == "dir" else relurl)
+        if path.is_hidden or (kind == "file" and path.is_real_dir):
+            yield {"path": relurl, "status": "rejected", "error": "Invalid path"}, None
+            continue
+
+        try:
+            with locks.writing(path.as_relative_path):
+                if kind == "dir":
+                    created = changed = not path.is_real_dir
+                    # Invalidates the listings containing the new dirs
+                    create_parent_dirs(path)
+                    if created:
+                        build_queue.record_change(path.as_site_relative_path)
+                else:
+                    create_parent_dirs(path)
+                    created = not path.is_real_file
+                    chunks = iter(lambda: f.read(COPY_CHUNK_SIZE), b"")
+                    changed = write_file(path.as_abs_path, chunks)
+                    if changed:
+                        record_changed_file(path, listing_changed=created)
+
+        except OSError as e:
+            error = e.strerror or str(e)
+            yield {"path": relurl, "status": "rejected", "error": error}, None
+            continue
+
+        if not changed:
+            yield {"path": relurl, "status": "unchanged"}, None
+            continue
+
+        status = "created" if created else "updated"
+        # Directories have nothing to commit
+        yield {"path": relurl, "status": status}, None if kind == "dir" else path
+
+
+def commit_files(paths, description):
+    """Stage files with one git add and commit them together
+
+    :returns: True if a commit has been created
+    """
+    git_paths = [p.as_site_relative_path for p in paths]
+    # Pending changes to the same files are committed first
+    committer.flush()
+    with git_lock:
+        git_ops.stage(git_paths)
+        git_paths = git_ops.changed_paths(git_paths)
+        if not git_paths:
+            return False
+
+        try:
+            git_ops.commit(git_paths, description, current_author())
+        except (GitCommandError, ValueError) as e:
+            log.error("Unable to commit %s: %s", " ".join(git_paths), e)
+            return False
+
+    return True
+
+
+@bottle.post("/bulk")
+def route_bulk_import():
+    """Import a tar (optionally compressed) or zip archive into the content
+    dir and commit the files in one commit.
+    The optional "desc" query parameter sets the commit message.
+    """
+    api_require_auth()
+    if bottle.request.content_type in ("application/zip", "application/x-zip"):
+        # The zip index is at the end of the archive: Bottle spools it
+        members = iter_zip_members(bottle.request.body)
+    else:
+        # Tar archives are read while they are uploaded
+        stream = io.BufferedReader(ChunkReader(iter_request_body()))
+        members = iter_tar_members(stream)
+
+    results, written, error = import_archive(members)
+    committed = False
+    if git_repo and written:
+        desc = bottle.request.query.desc or "Import %d files" % len(written)
+        committed = commit_files(written, desc)
+
+    resp = {"files": results, "committed": committed}
+    if error:
+        resp["error"] = error
+        bottle.response.status = 400
+
+    return resp
+
+
+@bottle.get("/api/tree")
+@bottle.get("/api/tree/")
+@bottle.get("/api/tree/<path:path>")
+def route_api_tree(path=""):
+    """List a directory as JSON"""
+    api_require_auth()
+    path = Path(relurl=path.strip().rstrip("/") + "/")
+    if path.is_hidden or not path.is_real_dir:
+        raise api_error(404, "Directory not found")
+
+    dirs, files = list_current_dir(path)
+    return {
+        "path": path.as_url,
+        "dirs": [{"name": name, "path": url} for url, name in dirs],
+        "files": [{"name": name, "path": url} for url, name in files],
+    }
+
+
+class FileLock(object):
+    """Reentrant lock shared by threads and, once a path is set, by the
+    processes that lock the same file through flock(2)
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def acquire(self):
+        self._lock.acquire()
+        try:
+            if self._depth == 0 and self.path is not None:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                except BaseException:
+                    os.close(fd)
+                    raise
+                self._fd = fd
+        except BaseException:
+            self._lock.release()
+            raise
+
+        self._depth += 1
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0 and self._fd is not None:
+            # Closing the file releases the flock
+            os.close(self._fd)
+            self._fd = None
+
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class SharedLock(object):
+    """Readers-writer lock, held either by any number of threads in shared
+    mode or by one in exclusive mode. Once a path is set, processes lock
+    the same file through flock(2). Waiting writers block new readers.
+    Acquisitions must not be nested.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    def _flock(self, operation):
+        if self.path is None:
+            return None
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+        try:
+            fcntl.flock(fd, operation)
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd
+
+    @contextlib.contextmanager
+    def shared(self):
+        with self._cond:
+            self._cond.wait_for(lambda: not self._writer and not self._writers_waiting)
+            self._readers += 1
+        try:
+            fd = self._flock(fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                if fd is not None:
+                    os.close(fd)
+        finally:
+            with self._cond:
+                self._readers -= 1
+                self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        with self._cond:
+            self._writers_waiting += 1
+            try:
+                self._cond.wait_for(lambda: not self._writer and not self._readers)
+            finally:
+                self._writers_waiting -= 1
+            self._writer = True
+        try:
+            fd = self._flock(fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fd is not None:
+                    os.close(fd)
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+class LockManager(object):
+    """Locks coordinating the threads and worker processes that change the
+    content dir:
+    - a lock for each path, picked from a fixed set of stripes, orders the
+      writes to the same file and their staging on Git while writes to
+      other files run in parallel
+    - the content lock is held in shared mode by writers and in exclusive
+      mode when a build starts, so that it starts with no save half done
+    Lock files are created in lock_dir, once set by :meth:`configure`.
+    Locks are acquired in this order, git_lock last.
+    """
+
+    def __init__(self, stripes=64):
+        self._stripes = [FileLock() for _ in range(stripes)]
+        self.content = SharedLock()
+
+    def configure(self, lock_dir):
+        for n, lock in enumerate(self._stripes):
+            lock.path = os.path.join(lock_dir, "path-%d.lock" % n)
+        self.content.path = os.path.join(lock_dir, "content.lock")
+
+    def path(self, relpath):
+        """:returns: :class:`FileLock` for a path relative to the content dir"""
+        n = zlib.crc32(relpath.encode("utf-8")) % len(self._stripes)
+        return self._stripes[n]
+
+    @contextlib.contextmanager
+    def writing(self, relpath):
+        """Hold the locks needed to write a file"""
+        with self.content.shared(), self.path(relpath):
+            yield
+
+
+# Serializes Git commands that update the index and the use of git_repo,
+# which is not thread-safe
+git_lock = FileLock()
+locks = LockManager()
+
+
+class SubprocessGit(object):
+    """Stage and commit files by running git commands.
+    Paths are relative to the repository root.
+    """
+
+    @timed(git_duration, "add")
+    def stage(self, git_paths):
+        git_repo.git.add(*git_paths)
+
+    @timed(git_duration, "rm")
+    def stage_removal(self, git_paths):
+        """Remove deleted files from the index"""
+        git_repo.git.rm("--cached", "--ignore-unmatch", "-q", "--", *git_paths)
+
+    @timed(git_duration, "is_dirty")
+    def changed_paths(self, git_paths):
+        """Find the paths with staged changes
+
+        :returns: list
+        """
+        if len(git_paths) == 1:
+            dirty = git_repo.is_dirty(index=True, working_tree=False, path=git_paths[0])
+            return list(git_paths) if dirty else []
+
+        staged = git_repo.git.diff("--cached", "--name-only", "--", *git_paths)
+        staged = set(staged.splitlines())
+        return [p for p in git_paths if p in staged]
+
+    @timed(git_duration, "commit")
+    def commit(self, git_paths, message, author=None):
+        """Commit the staged changes to the given paths only
+
+        :param author: "name <email>" or None for the Git default
+        """
+        if author:
+            git_repo.git.commit("--", *git_paths, m=message, author=author)
+        else:
+            git_repo.git.commit("--", *git_paths, m=message)
+
+
+class InProcessGit(SubprocessGit):
+    """Stage and commit files through GitPython's index and object database,
+    without running git. Commit hooks are not run.
+    The repository must be opened with the pure Python object database
+    (odbt=GitDB), as the default one runs git to store objects.
+    The index is reread only when it changes on disk, and commits rewrite
+    only the trees along the committed paths.
+    """
+
+    _tree_mode = 0o40000
+
+    def __init__(self, max_cached_trees=64):
+        self._index = None
+        self._index_key = None
+        self._trees = collections.OrderedDict()
+        self._max_cached_trees = max_cached_trees
+
+    def _index_stat(self):
+        try:
+            st = os.stat(os.path.join(git_repo.git_dir, "index"))
+        except FileNotFoundError:
+            return None
+
+        return (git_repo.git_dir, st.st_ino, st.st_mtime_ns, st.st_size)
+
+    @property
+    def index(self):
+        """The repository index, reread if changed by other processes
+
+        :returns: :class:`git.index.base.IndexFile`
+        """
+        key = self._index_stat()
+        if self._index is None or key != self._index_key:
+            self._index = IndexFile(git_repo)
+            self._index_key = key
+
+        return self._index
+
+    @timed(git_duration, "add")
+    def stage(self, git_paths):
+        # Not through IndexFile.add(), which changes the working directory
+        # of the whole process while other threads serve requests
+        index = self.index
+        for p in git_paths:
+            index.entries[(p, 0)] = IndexEntry.from_base(self._store_blob(p))
+        index.write(ignore_extension_data=True)
+        self._index_key = self._index_stat()
+
+    def _store_blob(self, git_path):
+        """Store a file or symlink of the working tree as a blob
+
+        :returns: :class:`git.index.typ.BaseIndexEntry`
+        """
+        abspath = os.path.join(git_repo.working_tree_dir, git_path)
+        st = os.lstat(abspath)
+        if stat.S_ISLNK(st.st_mode):
+            target = os.fsencode(os.readlink(abspath))
+            istream = IStream("blob", len(target), io.BytesIO(target))
+            binsha = git_repo.odb.store(istream).binsha
+        elif stat.S_ISREG(st.st_mode):
+            with open(abspath, "rb") as f:
+                st = os.fstat(f.fileno())
+                binsha = git_repo.odb.store(IStream("blob", st.st_size, f)).binsha
+        else:
+            raise ValueError("Can only stage a regular file or symlink: %r" % git_path)
+
+        mode = stat_mode_to_index_mode(st.st_mode)
+        return BaseIndexEntry((mode, binsha, 0, git_path))
+
+    @timed(git_duration, "rm")
+    def stage_removal(self, git_paths):
+        """Remove deleted files from the index"""
+        index = self.index
+        removed = [index.entries.pop((p, 0), None) for p in git_paths]
+        if any(e is not None for e in removed):
+            index.write(ignore_extension_data=True)
+            self._index_key = self._index_stat()
+
+    @timed(git_duration, "is_dirty")
+    def changed_paths(self, git_paths):
+        """Find the paths whose staged blob differs from HEAD
+
+        :returns: list
+        """
+        entries = self.index.entries
+        head_tree = self._head_tree()
+        changed = []
+        for p in git_paths:
+            entry = entries.get((p, 0))
+            staged = None if entry is None else (entry.binsha, entry.mode)
+            if staged != self._lookup(head_tree, p.split("/")):
+                changed.append(p)
+
+        return changed
+
+    @timed(git_duration, "commit")
+    def commit(self, git_paths, message, author=None):
+        """Commit the staged changes to the given paths only,
+        by applying them to the tree of HEAD
+        """
+        entries = self.index.entries
+        root = self._head_tree()
+        for p in git_paths:
+            entry = entries.get((p, 0))
+            blob = None if entry is None else (entry.binsha, entry.mode)
+            root = self._update_tree(root, p.split("/"), blob)
+
+        if root is None:
+            root = self._write_tree({})
+
+        if author:
+            author = Actor._from_string(author)
+
+        tree = Tree(git_repo, root)
+        Commit.create_from_tree(git_repo, tree, message, head=True, author=author)
+
+    def _head_tree(self):
+        """:returns: binsha of the HEAD tree or None"""
+        if not git_repo.head.is_valid():
+            return None
+
+        return git_repo.head.commit.tree.binsha
+
+    def _read_tree(self, binsha):
+        """Read a tree object, caching the result. Trees are immutable.
+
+        :returns: {name: (binsha, mode)}
+        """
+        if binsha is None:
+            return {}
+
+        tree = self._trees.get(binsha)
+        if tree is None:
+            data = git_repo.odb.stream(binsha).read()
+            entries = tree_entries_from_data(data)
+            tree = {name: (sha, mode) for sha, mode, name in entries}
+            self._cache_tree(binsha, tree)
+        else:
+            self._trees.move_to_end(binsha)
+
+        return tree
+
+    def _cache_tree(self, binsha, tree):
+        self._trees[binsha] = tree
+        while len(self._trees) > self._max_cached_trees:
+            self._trees.popitem(last=False)
+
+    def _write_tree(self, tree):
+        """Store a tree object
+
+        :returns: binsha
+        """
+
+        def sort_key(item):
+            name, (_, mode) = item
+            return name + "/" if mode == self._tree_mode else name
+
+        data = b"".join(
+            b"%o %s\0%s" % (mode, name.encode(), sha)
+            for name, (sha, mode) in sorted(tree.items(), key=sort_key)
+        )
+        istream = git_repo.odb.store(IStream("tree", len(data), io.BytesIO(data)))
+        self._cache_tree(istream.binsha, tree)
+        return istream.binsha
+
+    def _lookup(self, tree_binsha, parts):
+        """Find a path in a tree
+
+        :returns: (binsha, mode) or None
+        """
+        for name in parts[:-1]:
+            item = self._read_tree(tree_binsha).get(name)
+            if item is None or item[1] != self._tree_mode:
+                return None
+            tree_binsha = item[0]
+
+        return self._read_tree(tree_binsha).get(parts[-1])
+
+    def _update_tree(self, tree_binsha, parts, blob):
+        """Set or remove (if blob is None) an entry in a tree, rewriting
+        the subtrees along its path
+
+        :returns: binsha of the new tree or None if the tree is empty
+        """
+        tree = dict(self._read_tree(tree_binsha))
+        name = parts[0]
+        if len(parts) > 1:
+            item = tree.get(name)
+            subtree = item[0] if item and item[1] == self._tree_mode else None
+            blob = self._update_tree(subtree, parts[1:], blob)
+            if blob is not None:
+                blob = (blob, self._tree_mode)
+
+        if blob is None:
+            tree.pop(name, None)
+        else:
+            tree[name] = blob
+
+        if not tree:
+            return None
+
+        return self._write_tree(tree)
+
+
+git_ops = SubprocessGit()
+
+
+class GroupCommitter(object):
+    """Commit saved files to Git.
+    If a delay is set, files saved within that time window are committed
+    together when it expires, or when :meth:`flush` is called.
+    """
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self._lock = threading.Lock()
+        self._pending = []
+        self._timer = None
+
+    def add(self, git_path, description, author=None):
+        """Commit a staged file, now or at the end of the time window
+
+        :param git_path: path relative to the repository root
+        :param author: "name <email>" or None for the Git default
+        """
+        if not self.delay:
+            with git_lock:
+                self._commit([(git_path, description, author)])
+            return
+
+        with self._lock:
+            self._pending.append((git_path, description, author))
+            if self._timer is None:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """Commit pending changes, if any"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+            changes, self._pending = self._pending, []
+
+        if changes:
+            with git_lock:
+                self._commit(changes)
+
+    def _commit(self, changes):
+        paths = sorted(set(c[0] for c in changes))
+        if len(changes) > 1:
+            # Paths saved back to their committed contents have nothing
+            # left to commit
+            paths = git_ops.changed_paths(paths)
+            if not paths:
+                return
+
+        message, author = self.format_message(changes)
+        try:
+            git_ops.commit(paths, message, author)
+        except (GitCommandError, ValueError) as e:
+            log.error("Unable to commit %s: %s", " ".join(paths), e)
+
+    @staticmethod
+    def format_message(changes):
+        """Combine the descriptions of the changes in one commit message.
+        The commit is attributed to the first author, other authors are
+        added as Co-authored-by trailers.
+
+        :returns: (message, author)
+        """
+        if len(changes) == 1:
+            _, description, author = changes[0]
+            return description, author
+
+        authors = []
+        lines = ["Update %d files" % len(set(c[0] for c in changes)), ""]
+        for _, description, author in changes:
+            if author:
+                if author not in authors:
+                    authors.append(author)
+                lines.append("- %s (%s)" % (description, author.split(" <")[0]))
+            else:
+                lines.append("- %s" % description)
+
+        if len(authors) > 1:
+            lines.append("")
+            lines.extend("Co-authored-by: %s" % a for a in authors[1:])
+
+        return "\n".join(lines), authors[0] if authors else None
+
+
+committer = GroupCommitter()
+
+
+@bottle.route("/make")
+@bottle.route("/make/")
+@bottle.route("/make/<target>")
+def route_get_make_target(target=None):
+    """Redirect GETs on /make to /edit"""
+    if aaa:
+        aaa.require(fail_redirect="/login")
+
+    raise bottle.redirect("/edit/")
+
+
+@bottle.post("/make/<target>")
+def route_run_make_target(target):
+    """Queue a make target and redirect to the build page"""
+    global make_targets
+
+    if aaa:
+        aaa.require(fail_redirect="/login")
+
+    target = target.strip()
+    if target != "publish" and target not in make_targets:
+        return error("Unknown make target")
+
+    job = build_queue.submit(target)
+    bottle.response.set_header("X-Build-Id", str(job.job_id))
+    return bottle.redirect("/builds/%d" % job.job_id, 303)
+
+
+@bottle.route("/builds/<job_id:int>")
+def route_build(job_id):
+    """Serve the output of a build, streaming it while make is running"""
+    if aaa:
+        aaa.require(fail_redirect="/login")
+
+    job = build_queue.get(job_id)
+    if job is None:
+        return error("Unknown build")
+
+    return stream_build_output(job)
+
+
+@bottle.route("/builds/<job_id:int>/status")
+def route_build_status(job_id):
+    """Report the state of a build as JSON"""
+    if aaa:
+        aaa.require(fail_redirect="/login")
+
+    job = build_queue.get(job_id)
+    if job is None:
+        raise bottle.HTTPError(404, "Unknown build")
+
+    return job.as_dict()
+
+
+def spawn_make(target, changed_files=None, changed_list=None):
+    """Start a make target in the site directory.
+    If the files changed since the last build are known, they are listed
+    one per line, relative to the site dir, in the changed_list file,
+    passed to make as CHANGED_FILES_LIST. Short lists of paths without
+    spaces are also passed as a space-separated list in CHANGED_FILES.
+
+    :returns: :class:`subprocess.Popen`
+    """
+    site_path = os.path.dirname(content_path)
+    args = ["make", target]
+    if changed_files is not None:
+        args.append("CHANGED_FILES_LIST=%s" % changed_list)
+        value = " ".join(changed_files)
+        ambiguous = any(len(f.split()) != 1 for f in changed_files)
+        if len(value) <= MAX_CHANGED_FILES_ARG and not ambiguous:
+            args.append("CHANGED_FILES=%s" % value)
+
+    return subprocess.Popen(
+        args,
+        cwd=site_path,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+
+
+def iter_output_lines(stream):
+    """Read lines from a binary stream as they are written.
+    Overlong lines are split into chunks of at most MAX_OUTPUT_LINE bytes
+    to keep memory usage bounded.
+
+    :returns: str generator
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    for chunk in iter(lambda: stream.readline(MAX_OUTPUT_LINE), b""):
+        yield decoder.decode(chunk)
+
+
+def format_output_line(line):
+    """Render a line of make output as HTML, highlighting errors
+
+    :returns: str
+    """
+    text = bottle.html_escape(line.rstrip("\r\n"))
+    if line.startswith(("ERROR:", "CRITICAL:")):
+        return '<span class="errorline"> %s</span><br/>\n' % text
+
+    return "<span> %s</span><br/>\n" % text
+
+
+def stream_build_output(job):
+    """Generate the build output page, following the job until it ends"""
+    yield bottle.template("make_output_head", job=job)
+    for line in job.follow():
+        yield format_output_line(line)
+
+    yield bottle.template("make_output_tail", job=job)
+
+
+class BuildJob(object):
+    """A make target run scheduled on the :class:`BuildQueue`.
+    Only the last MAX_BUILD_OUTPUT_LINES lines of output are kept, up to
+    MAX_BUILD_OUTPUT_SIZE characters, until :meth:`drop_output` is called.
+    With a state_dir the job state and its full output are also written
+    there, for other worker processes to read through :class:`SharedBuildJob`.
+    """
+
+    def __init__(self, job_id, target, state_dir=None):
+        self.job_id = job_id
+        self.target = target
+        self.state = "queued"
+        self.returncode = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.output = collections.deque(maxlen=MAX_BUILD_OUTPUT_LINES)
+        self.output_dropped = False
+        self.lines_count = 0
+        self._output_size = 0
+        self._cond = threading.Condition()
+        self._state_dir = state_dir
+        self._log = None
+        if state_dir:
+            self._save_state()
+
+    @property
+    def done(self):
+        return self.state in ("succeeded", "failed")
+
+    def _save_state(self):
+        data = json.dumps(self.as_dict()).encode()
+        path = os.path.join(self._state_dir, "%d.json" % self.job_id)
+        replace_file(path, lambda fd: _write_all(fd, data))
+
+    def start(self):
+        with self._cond:
+            self.state = "running"
+            self.started = time.time()
+            if self._state_dir:
+                path = os.path.join(self._state_dir, "%d.log" % self.job_id)
+                self._log = open(path, "w", encoding="utf-8")
+                self._save_state()
+            self._cond.notify_all()
+
+    def append_output(self, line):
+        with self._cond:
+            output = self.output
+            if len(output) == output.maxlen:
+                self._output_size -= len(output[0])
+            output.append(line)
+            self._output_size += len(line)
+            while self._output_size > MAX_BUILD_OUTPUT_SIZE and len(output) > 1:
+                self._output_size -= len(output.popleft())
+            self.lines_count += 1
+            if self._log:
+                self._log.write(line if line.endswith("\n") else line + "\n")
+                self._log.flush()
+            self._cond.notify_all()
+
+    def finish(self, returncode):
+        with self._cond:
+            self.returncode = returncode
+            self.state = "succeeded" if returncode == 0 else "failed"
+            self.finished = time.time()
+            if self._log:
+                self._log.close()
+                self._log = None
+            if self._state_dir:
+                self._save_state()
+            self._cond.notify_all()
+
+    def drop_output(self):
+        """Free the output kept in memory"""
+        with self._cond:
+            self.output.clear()
+            self.output_dropped = True
+            self._output_size = 0
+
+    def wait(self, timeout=None):
+        """Wait for the job to end
+
+        :returns: bool -- True if the job has ended
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self.done, timeout)
+
+    def follow(self):
+        """Generate output lines, including the ones that are produced
+        until the job ends. Lines dropped from the buffer are skipped.
+
+        :returns: str generator
+        """
+        pos = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: pos < self.lines_count or self.done)
+                first = self.lines_count - len(self.output)
+                pos = max(pos, first)
+                lines = list(itertools.islice(self.output, pos - first, None))
+                pos = self.lines_count
+                done = self.done
+
+            for line in lines:
+                yield line
+
+            if done and not lines:
+                return
+
+    def as_dict(self):
+        return dict(
+            id=self.job_id,
+            target=self.target,
+            state=self.state,
+            returncode=self.returncode,
+            created=self.created,
+            started=self.started,
+            finished=self.finished,
+            output_lines=self.lines_count,
+        )
+
+
+class SharedBuildJob(object):
+    """Read-only view of a build run by another worker process, loaded
+    from the files written by its :class:`BuildJob` in the state dir
+    """
+
+    poll_interval = 0.2
+
+    def __init__(self, state_dir, job_id):
+        self.job_id = job_id
+        self._state_dir = state_dir
+        self._load()
+
+    def _path(self, ext):
+        return os.path.join(self._state_dir, "%d.%s" % (self.job_id, ext))
+
+    def _load(self):
+        with open(self._path("json")) as f:
+            state = json.load(f)
+
+        for name in ("target", "state", "returncode", "created"):
+            setattr(self, name, state[name])
+        self.started = state["started"]
+        self.finished = state["finished"]
+
+    @property
+    def done(self):
+        return self.state in ("succeeded", "failed")
+
+    def follow(self):
+        """Generate output lines, polling the log until the job ends
+
+        :returns: str generator
+        """
+        f = None
+        partial = ""
+        try:
+            while True:
+                # The log is complete once the job is marked as done
+                done = self.done
+                if f is None and self.state != "queued":
+                    f = open(self._path("log"), encoding="utf-8", errors="replace")
+
+                lines = f.readlines() if f else []
+                if lines:
+                    lines[0] = partial + lines[0]
+                    partial = "" if lines[-1].endswith("\n") else lines.pop()
+                for line in lines:
+                    yield line
+
+                if done and not lines:
+                    return
+
+                if not lines:
+                    time.sleep(self.poll_interval)
+                    self._load()
+        finally:
+            if f:
+                f.close()
+
+    def as_dict(self):
+        try:
+            with open(self._path("log"), "rb") as f:
+                lines_count = sum(1 for _ in f)
+        except FileNotFoundError:
+            lines_count = 0
+
+        return dict(
+            id=self.job_id,
+            target=self.target,
+            state=self.state,
+            returncode=self.returncode,
+            created=self.created,
+            started=self.started,
+            finished=self.finished,
+            output_lines=lines_count,
+        )
+
+
+class BuildQueue(object):
+    """Run make targets one at a time in a background thread.
+    Submitting a target that is already waiting in the queue returns the
+    queued job instead of scheduling a new run.
+    Files changed since the last successful run of each target are
+    tracked to allow incremental builds.
+
+    Worker processes share a state_dir: job IDs are unique across them,
+    each process can serve the output of any build, and builds run one
+    at a time. As no process sees all the changed files, every build is
+    a full one.
+    """
+
+    def __init__(self, max_jobs=100, state_dir=None):
+        self._max_jobs = max_jobs
+        self._state_dir = state_dir
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._jobs = collections.OrderedDict()
+        self._queued = {}
+        self._ids = itertools.count(1)
+        self._worker = None
+        self._changed = {}
+        self._built = set()
+
+    def submit(self, target):
+        """Schedule a make target, or join an already queued run
+
+        :returns: :class:`BuildJob`
+        """
+        with self._lock:
+            job = self._queued.get(target)
+            if job is not None:
+                return job
+
+            job = BuildJob(self._next_id(), target, self._state_dir)
+            self._queued[target] = job
+            self._jobs[job.job_id] = job
+            self._expire_jobs()
+            self._queue.put(job)
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+
+        return job
+
+    def record_change(self, relpath):
+        """Record a file created, updated or deleted in the site
+
+        :param relpath: path relative to the site directory
+        """
+        with self._lock:
+            for target, changed in self._changed.items():
+                changed.add(relpath)
+                if len(changed) > MAX_CHANGED_FILES:
+                    # Too many to list: rebuild everything
+                    changed.clear()
+                    self._built.discard(target)
+
+    def get(self, job_id):
+        """Get a job by ID
+
+        :returns: :class:`BuildJob`, :class:`SharedBuildJob` or None
+        """
+        job = self._jobs.get(job_id)
+        if self._state_dir and (job is None or job.output_dropped):
+            # The full output is still on disk
+            try:
+                return SharedBuildJob(self._state_dir, job_id)
+            except (FileNotFoundError, ValueError):
+                return job
+
+        return job
+
+    def _next_id(self):
+        """Allocate a job ID, unique across the processes sharing the
+        state dir. Files of old jobs are removed.
+        """
+        if not self._state_dir:
+            return next(self._ids)
+
+        while True:
+            job_id = next(self._ids)
+            path = os.path.join(self._state_dir, "%d.json" % job_id)
+            try:
+                os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+                break
+            except FileExistsError:
+                continue
+
+        for name in os.listdir(self._state_dir):
+            m = re.match(r"^(\d+)\.(json|log)$", name)
+            if m and int(m.group(1)) <= job_id - self._max_jobs:
+                try:
+                    os.unlink(os.path.join(self._state_dir, name))
+                except FileNotFoundError:
+                    pass
+
+        return job_id
+
+    def _expire_jobs(self):
+        """Forget the oldest finished jobs, and the output of all but the
+        last BUILD_OUTPUTS_KEPT of them. Call while holding the lock.
+        """
+        for job_id in list(self._jobs):
+            if len(self._jobs) <= self._max_jobs:
+                break
+            if self._jobs[job_id].done:
+                del self._jobs[job_id]
+
+        kept = 0
+        for job in reversed(self._jobs.values()):
+            if not job.done or job.output_dropped:
+                continue
+            if kept < BUILD_OUTPUTS_KEPT:
+                kept += 1
+            else:
+                job.drop_output()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            with self._lock:
+                # Requests from now on need a new run to pick up changes
+                del self._queued[job.target]
+
+            self._execute(job)
+
+    def _execute(self, job):
+        print("Running target: %r" % job.target)
+        with self._lock:
+            changed = self._changed.setdefault(job.target, set())
+        snapshot = set()
+
+        t0 = None
+        try:
+            # The build starts once the saves in progress are done and
+            # committed. Saves made while make runs do not wait for it:
+            # they replace files atomically and are left in changed for
+            # the next run.
+            with locks.content.exclusive():
+                with self._lock:
+                    snapshot = set(changed)
+                    incremental = job.target in self._built and not self._state_dir
+                job.start()
+                t0 = time.monotonic()
+                if git_repo:
+                    # The build must see committed content
+                    committer.flush()
+
+            with tempfile.NamedTemporaryFile(
+                "w", encoding="utf-8", prefix="shoebill-changed-"
+            ) as changed_list:
+                changed_files = None
+                if incremental:
+                    changed_files = sorted(snapshot)
+                    changed_list.writelines(f + "\n" for f in changed_files)
+                    changed_list.flush()
+                cmd = spawn_make(job.target, changed_files, changed_list.name)
+                for line in iter_output_lines(cmd.stdout):
+                    job.append_output(line)
+
+                cmd.stdout.close()
+                returncode = cmd.wait()
+        except Exception as e:
+            log.exception("Unable to run make %s", job.target)
+            job.append_output("ERROR: %s" % e)
+            returncode = -1
+
+        with self._lock:
+            changed -= snapshot
+            if returncode == 0:
+                self._built.add(job.target)
+            else:
+                # The changes might not be built: the next run is a full one
+                self._built.discard(job.target)
+
+        if t0 is not None:
+            make_duration.labels(job.target).observe(time.monotonic() - t0)
+        make_runs.labels(job.target, str(returncode)).inc()
+        job.finish(returncode)
+        with self._lock:
+            self._expire_jobs()
+
+
+build_queue = BuildQueue()
+
+
+class LRUCache(object):
+    """Thread-safe least-recently-used cache, bounded by number of entries
+    and, optionally, by their total size. Values larger than maxbytes are
+    not cached.
+    """
+
+    def __init__(self, maxsize=256, maxbytes=None):
+        self._maxsize = maxsize
+        self._maxbytes = maxbytes
+        self._lock = threading.Lock()
+        self._items = collections.OrderedDict()
+        self._bytes = 0
+
+    def get(self, key, compute, sizeof=None):
+        """Get a cached value, calling compute() to generate it if missing
+
+        :param sizeof: function returning the size of a value in bytes,
+            counted against maxbytes
+        """
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key][0]
+
+        value = compute()
+        size = sizeof(value) if sizeof else 0
+        if self._maxbytes is not None and size > self._maxbytes:
+            return value
+
+        with self._lock:
+            if key in self._items:
+                self._bytes -= self._items[key][1]
+            self._items[key] = (value, size)
+            self._bytes += size
+            while len(self._items) > self._maxsize or (
+                self._maxbytes is not None and self._bytes > self._maxbytes
+            ):
+                _, (_, evicted) = self._items.popitem(last=False)
+                self._bytes -= evicted
+
+        return value
+
+
+history_cache = LRUCache(maxbytes=HISTORY_CACHE_BYTES)
+
+
+def git_head_sha():
+    """:returns: str -- HEAD commit SHA or None for an empty repository"""
+    with git_lock:
+        if not git_repo.head.is_valid():
+            return None
+
+        return git_repo.head.commit.hexsha
+
+
+def get_file_history(git_path, page):
+    """List a page of the commits that changed a file.
+    Results are cached by HEAD commit.
+
+    :returns: list of dicts
+    """
+
+    def compute():
+        with git_lock:
+            commits = git_repo.iter_commits(
+                paths=git_path,
+                max_count=HISTORY_PAGE_SIZE + 1,
+                skip=(page - 1) * HISTORY_PAGE_SIZE,
+            )
+            return [
+                dict(
+                    sha=c.hexsha,
+                    author=c.author.name,
+                    date=datetime.utcfromtimestamp(c.authored_date),
+                    summary=c.summary,
+                )
+                for c in commits
+            ]
+
+    return history_cache.get(("history", git_head_sha(), git_path, page), compute)
+
+
+def get_file_diff(git_path, sha):
+    """Get the changes made to a file by a commit. Commits are immutable,
+    hence the result is cached by commit SHA.
+
+    :returns: list of lines
+    """
+
+    def compute():
+        with git_lock:
+            out = git_repo.git.show(sha, "--format=", "--patch", "--", git_path)
+        return out.splitlines()
+
+    def sizeof(lines):
+        return sum(len(line) for line in lines)
+
+    return history_cache.get(("diff", sha, git_path), compute, sizeof)
+
+
+@bottle.route("/history/<path:path>")
+@bottle.view("history")
+def route_history(path):
+    """Serve the list of commits that changed a file"""
+    if aaa:
+        aaa.require(fail_redirect="/login")
+
+    if not git_repo:
+        return error("Git is not enabled")
+
+    path = Path(relurl=path.strip())
+    if path.is_dir or path.is_hidden:
+        return path_not_found
+
+    try:
+        page = max(1, int(bottle.request.query.page or 1))
+    except ValueError:
+        page = 1
+
+    commits = get_file_history(path.as_site_relative_path, page)
+    return dict(
+        path=path,
+        commits=commits[:HISTORY_PAGE_SIZE],
+        page=page,
+        has_next=len(commits) > HISTORY_PAGE_SIZE,
+    )
+
+
+@bottle.route("/diff/<path:path>")
+@bottle.view("diff")
+def route_diff(path):
+    """Serve the changes made to a file by a commit"""
+    if aaa:
+        aaa.require(fail_redirect="/login")
+
+    if not git_repo:
+        return error("Git is not enabled")
+
+    path = Path(relurl=path.strip())
+    if path.is_dir or path.is_hidden:
+        return path_not_found
+
+    rev = bottle.request.query.rev.strip()
+    if not re.match("^[0-9a-f]{4,40}$", rev):
+        return error("Invalid revision")
+
+    try:
+        with git_lock:
+            sha = git_repo.commit(rev).hexsha
+    except (BadName, ValueError):
+        return error("Unknown revision")
+
+    lines = get_file_diff(path.as_site_relative_path, sha)
+    return dict(path=path, sha=sha, lines=lines)
+
+
+@bottle.route("/favicon.ico")
+def serve_favicon():
+    return bottle.static_file("favicon.ico", root=static_path)
+
+
+@bottle.route("/static/<filename>")
+def serve_static_asset(filename):
+    """Serve a static asset by its hashed name"""
+    for name, hashed_name in static_asset_names().items():
+        if hashed_name == filename:
+            resp = bottle.static_file(name, root=static_path)
+            resp.set_header("Cache-Control", "public, max-age=31536000, immutable")
+            return resp
+
+    raise bottle.HTTPError(404, "File not found")
+
+
+def negotiate_encoding(accept_encoding):
+    """Pick the preferred content coding among the supported ones
+
+    :param accept_encoding: Accept-Encoding header
+    :returns: "br", "gzip" or None
+    """
+    qvalues = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        qvalues[coding.strip().lower()] = q
+
+    best, best_q = None, 0.0
+    for coding in ("br", "gzip") if brotli else ("gzip",):
+        q = qvalues.get(coding, qvalues.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+
+    return best
+
+
+class GzipCompressor(object):
+    """Incremental gzip compressor"""
+
+    def __init__(self, level=6):
+        self._c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        """Compress a chunk, flushing it to the output"""
+        return self._c.compress(data) + self._c.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._c.flush()
+
+
+class BrotliCompressor(object):
+    """Incremental brotli compressor"""
+
+    def __init__(self, quality=5):
+        self._c = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        """Compress a chunk, flushing it to the output"""
+        return self._c.process(data) + self._c.flush()
+
+    def finish(self):
+        return self._c.finish()
+
+
+class CompressionMiddleware(object):
+    """WSGI middleware compressing text responses with brotli (when
+    installed) or gzip, as negotiated with the Accept-Encoding header.
+    Each chunk is flushed as it is generated: streamed pages like the make
+    output are still displayed progressively.
+    """
+
+    compressors = {"br": BrotliCompressor, "gzip": GzipCompressor}
+
+    def __init__(self, app, min_size=COMPRESS_MIN_SIZE):
+        self._app = app
+        self._min_size = min_size
+
+    def __call__(self, environ, start_response):
+        coding = None
+        if environ.get("REQUEST_METHOD") != "HEAD":
+            coding = negotiate_encoding(environ.get("HTTP_ACCEPT_ENCODING", ""))
+
+        compressor = []
+
+        def _start_response(status, headers, exc_info=None):
+            if self._is_compressible(status, headers):
+                headers = self._vary(headers)
+                if coding:
+                    headers = self._encode(headers, coding)
+                    compressor.append(self.compressors[coding]())
+
+            return start_response(status, headers, exc_info)
+
+        app_iter = self._app(environ, _start_response)
+        return self._iter_compressed(app_iter, compressor)
+
+    def _is_compressible(self, status, headers):
+        if status[:3] in ("204", "206", "304"):
+            return False
+
+        headers = {k.lower(): v for k, v in headers}
+        if "content-encoding" in headers:
+            return False
+        if "no-transform" in headers.get("cache-control", ""):
+            return False
+        if not headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES):
+            return False
+
+        length = headers.get("content-length")
+        return length is None or int(length) >= self._min_size
+
+    @staticmethod
+    def _vary(headers):
+        """Add Accept-Encoding to the Vary header"""
+        vary = [v for k, v in headers if k.lower() == "vary"]
+        headers = [(k, v) for k, v in headers if k.lower() != "vary"]
+        vary.append("Accept-Encoding")
+        headers.append(("Vary", ", ".join(vary)))
+        return headers
+
+    @staticmethod
+    def _encode(headers, coding):
+        """Set the headers of a compressed response. The length is not known
+        in advance and strong ETags become weak, as the compressed bytes
+        are not identical to the original ones.
+        """
+        out = []
+        for k, v in headers:
+            lk = k.lower()
+            if lk == "content-length":
+                continue
+            if lk == "etag" and v.startswith('"'):
+                v = "W/" + v
+            out.append((k, v))
+
+        out.append(("Content-Encoding", coding))
+        return out
+
+    @staticmethod
+    def _iter_compressed(app_iter, compressor):
+        try:
+            for chunk in app_iter:
+                if not compressor:
+                    yield chunk
+                    continue
+
+                data = compressor[0].compress(chunk)
+                if data:
+                    yield data
+
+            if compressor:
+                yield compressor[0].finish()
+
+        finally:
+            if hasattr(app_iter, "close"):
+                app_iter.close()
+
+
+class ProfileStore(object):
+    """Ring buffer of the last request profiles of a process. With worker
+    processes, profiles are saved as files in a shared directory, so that
+    any worker can serve them.
+    """
+
+    def __init__(self, keep=PROFILES_KEPT, directory=None):
+        self.directory = directory
+        self._profiles = collections.OrderedDict()
+        self._keep = keep
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def add(self, info, profile=None, stacks=None):
+        """Store a profile
+
+        :param info: dict describing the request
+        :param profile: :class:`cProfile.Profile` or None
+        :param stacks: {collapsed stack: samples} or None
+        """
+        info = dict(info, id="%d-%d" % (os.getpid(), next(self._ids)))
+        info["formats"] = ["txt", "pstats"] if profile else []
+        if stacks is not None:
+            info["formats"].append("collapsed")
+        if profile:
+            profile.create_stats()
+
+        with self._lock:
+            if self.directory is not None:
+                base = os.path.join(self.directory, info["id"])
+                if profile:
+                    profile.dump_stats(base + ".pstats")
+                with open(base + ".json", "w") as f:
+                    json.dump(dict(info, stacks=stacks), f)
+                profile = stacks = None
+
+            self._profiles[info["id"]] = (info, profile, stacks)
+            while len(self._profiles) > self._keep:
+                old_id, _ = self._profiles.popitem(last=False)
+                self._remove_files(old_id)
+
+    def _remove_files(self, profile_id):
+        if self.directory is None:
+            return
+        for ext in (".json", ".pstats"):
+            try:
+                os.unlink(os.path.join(self.directory, profile_id + ext))
+            except FileNotFoundError:
+                pass
+
+    def list(self):
+        """:returns: [info dict, ...], most recent first"""
+        if self.directory is None:
+            with self._lock:
+                profiles = [info for info, _, _ in self._profiles.values()]
+        else:
+            profiles = []
+            for fname in os.listdir(self.directory):
+                if fname.endswith(".json"):
+                    info = self._load(fname[:-5])
+                    if info:
+                        info.pop("stacks")
+                        profiles.append(info)
+
+        return sorted(profiles, key=lambda info: info["time"], reverse=True)
+
+    def _load(self, profile_id):
+        try:
+            with open(os.path.join(self.directory, profile_id + ".json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def render(self, profile_id, fmt):
+        """Render a profile as pstats data, a text summary of the functions
+        with the highest cumulative time, or collapsed stacks
+
+        :returns: bytes or None if not available
+        """
+        if self.directory is None:
+            with self._lock:
+                info, profile, stacks = self._profiles.get(profile_id, ({}, 0, 0))
+            stats_source = profile
+        else:
+            info = self._load(profile_id) or {}
+            stacks = info.get("stacks")
+            stats_source = os.path.join(self.directory, profile_id + ".pstats")
+
+        if fmt not in info.get("formats", ()):
+            return None
+
+        if fmt == "collapsed":
+            lines = ("%s %d\n" % (stack, n) for stack, n in sorted(stacks.items()))
+            return "".join(lines).encode()
+
+        try:
+            stats = pstats.Stats(stats_source, stream=io.StringIO())
+        except OSError:
+            return None
+        if fmt == "pstats":
+            return marshal.dumps(stats.stats)
+
+        stats.sort_stats("cumulative").print_stats(PROFILE_TEXT_LINES)
+        return stats.stream.getvalue().encode()
+
+
+class ProfilerMiddleware(object):
+    """WSGI middleware profiling a random fraction of the requests with
+    cProfile. Requests are also sampled by a thread recording their stacks
+    every interval seconds; when a slow threshold is set, every request is
+    sampled and those taking longer are kept. Streamed responses are
+    profiled until they are closed.
+    """
+
+    def __init__(self, app, store, rate=0.0, slow=None, interval=0.005):
+        self.app = app
+        self.store = store
+        self.rate = rate
+        self.slow = slow
+        self.interval = interval
+        # Stacks of the requests being sampled, by thread id
+        self._active = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._sampler = None
+
+    def __call__(self, environ, start_response):
+        profiled = self.rate and random.random() < self.rate
+        if not profiled and self.slow is None:
+            return self.app(environ, start_response)
+        return self._profile(environ, start_response, profiled)
+
+    def _profile(self, environ, start_response, profiled):
+        t0 = time.monotonic()
+        status = []
+
+        def _start_response(status_line, headers, exc_info=None):
+            status[:] = [int(status_line.split()[0])]
+            return start_response(status_line, headers, exc_info)
+
+        profile = cProfile.Profile() if profiled else None
+        stacks = collections.Counter()
+        self._start_sampling(stacks)
+        try:
+            if profile:
+                profile.enable()
+        except ValueError:
+            # Another profiler is running in this process
+            profile = None
+
+        app_iter = None
+        try:
+            app_iter = self.app(environ, _start_response)
+            yield from app_iter
+        finally:
+            try:
+                if hasattr(app_iter, "close"):
+                    app_iter.close()
+            finally:
+                if profile:
+                    profile.disable()
+                with self._lock:
+                    self._active.pop(threading.get_ident(), None)
+
+                duration = time.monotonic() - t0
+                if profiled or (self.slow is not None and duration >= self.slow):
+                    info = dict(
+                        time=time.time(),
+                        method=environ.get("REQUEST_METHOD"),
+                        path=environ.get("PATH_INFO"),
+                        status=status[0] if status else None,
+                        duration=duration,
+                    )
+                    self.store.add(info, profile, stacks)
+
+    def _start_sampling(self, stacks):
+        with self._lock:
+            if self._sampler is None or not self._sampler.is_alive():
+                # Started on first use, hence in each worker process
+                self._sampler = threading.Thread(target=self._sample, daemon=True)
+                self._sampler.start()
+            self._active[threading.get_ident()] = stacks
+            self._wakeup.set()
+
+    def _sample(self):
+        while True:
+            self._wakeup.wait()
+            time.sleep(self.interval)
+            with self._lock:
+                active = list(self._active.items())
+                if not active:
+                    self._wakeup.clear()
+                    continue
+
+            frames = sys._current_frames()
+            samples = []
+            for thread_id, stacks in active:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    samples.append((thread_id, stacks, self._collapse(frame)))
+            del frames
+
+            # Requests read their stacks once they are no longer active
+            with self._lock:
+                for thread_id, stacks, stack in samples:
+                    if self._active.get(thread_id) is stacks:
+                        stacks[stack] += 1
+
+    @staticmethod
+    def _collapse(frame):
+        """Describe a stack as flamegraph tools expect, from the outermost
+        frame below the middleware to the innermost
+        """
+        names = []
+        while frame is not None and frame.f_code is not _PROFILE_CODE:
+            code = frame.f_code
+            names.append(
+                "%s (%s:%d)" % (code.co_name, code.co_filename, code.co_firstlineno)
+            )
+            frame = frame.f_back
+
+        return ";".join(reversed(names))
+
+
+_PROFILE_CODE = ProfilerMiddleware._profile.__code__
+
+
+class LockedJsonBackend(JsonBackend):
+    """Cork JSON backend shared by worker processes. Users and roles are
+    served from memory; files are saved atomically while holding a lock
+    and reloaded by :meth:`refresh` when another process has replaced them.
+    """
+
+    def __init__(self, directory, initialize=False, ttl=None):
+        self._lock = FileLock(os.path.join(directory, "auth.lock"))
+        self._ttl = AUTH_CACHE_TTL if ttl is None else ttl
+        super(LockedJsonBackend, self).__init__(
+            directory,
+            users_fname="users",
+            roles_fname="roles",
+            pending_reg_fname="register",
+            initialize=initialize,
+        )
+        self._expires = time.monotonic() + self._ttl
+
+    def refresh(self, force=False):
+        """Reload the files changed by other processes, checking them at
+        most once every ttl seconds unless forced
+        """
+        now = time.monotonic()
+        if force or now >= self._expires:
+            self._expires = now + self._ttl
+            self._refresh()
+
+    def _refresh(self):
+        # Requests read the dicts concurrently: reloaded ones replace
+        # them in one step instead of being updated in place
+        self.users = self._load(self._users_fname, self.users)
+        self.roles = self._load(self._roles_fname, self.roles)
+        self.pending_registrations = self._load(
+            self._pending_reg_fname, self.pending_registrations
+        )
+
+    @staticmethod
+    def _file_key(path):
+        # Saving replaces the file: a new inode tells apart changes made
+        # within the resolution of mtime
+        st = os.stat(path)
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _load(self, fname, current):
+        """Load a JSON file unless it is unchanged since the last load
+
+        :returns: dict
+        """
+        path = "%s/%s.json" % (self._directory, fname)
+        try:
+            key = self._file_key(path)
+            if self._mtimes.get(path) == key:
+                return current
+
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            raise BackendIOException("Unable to read json file %s: %s" % (path, e))
+
+        self._mtimes[path] = key
+        return data
+
+    def _savejson(self, fname, obj):
+        fname = "%s/%s.json" % (self._directory, fname)
+        data = json.dumps(obj, cls=BytesEncoder).encode()
+        try:
+            with self._lock:
+                replace_file(fname, lambda fd: _write_all(fd, data))
+                # Our own changes do not need to be reloaded
+                self._mtimes[fname] = self._file_key(fname)
+        except OSError as e:
+            raise BackendIOException("Unable to save JSON file %s: %s" % (fname, e))
+
+
+class SQLiteRecord(dict):
+    """User or pending registration read from a :class:`SQLiteTable`.
+    Setting an item updates that field in the database too, as Cork
+    changes records in place before calling save_users()
+    """
+
+    def __init__(self, table, key, data):
+        super(SQLiteRecord, self).__init__(data)
+        self._table = table
+        self._key = key
+
+    def __setitem__(self, name, value):
+        super(SQLiteRecord, self).__setitem__(name, value)
+        self._table.set_field(self._key, name, value)
+
+
+class SQLiteTable(collections.abc.MutableMapping):
+    """Dict-like view of a table of :class:`SQLiteAuthBackend`. Every
+    lookup and change is a single statement on the primary key.
+    Values are JSON objects, or integers for roles.
+    With cache set, lookups by key are kept in memory until
+    :meth:`invalidate` is called or the key is changed.
+    """
+
+    def __init__(self, backend, table, key, json_values=True, cache=False):
+        self._backend = backend
+        self._table = table
+        self._key = key
+        self._json_values = json_values
+        self._value = "data" if json_values else "level"
+        # {key: value, or None if not found}, or None when not caching
+        self._cache = {} if cache else None
+        # Incremented on every change, so that lookups running at the
+        # same time as a change do not cache what they read
+        self._version = 0
+
+    def _execute(self, query, args=()):
+        query = query.format(table=self._table, key=self._key, value=self._value)
+        return self._backend.execute(query, args)
+
+    def _encode(self, value):
+        if self._json_values:
+            return json.dumps(value, cls=BytesEncoder)
+        return value
+
+    def _lookup(self, key):
+        """:returns: the value of key, or None if not found"""
+        rows = self._execute("SELECT {value} FROM {table} WHERE {key} = ?", (key,))
+        if not rows:
+            return None
+        if self._json_values:
+            return SQLiteRecord(self, key, json.loads(rows[0][0]))
+        return rows[0][0]
+
+    def _get(self, key):
+        cache = self._cache
+        if cache is None:
+            return self._lookup(key)
+
+        try:
+            return cache[key]
+        except KeyError:
+            pass
+
+        version = self._version
+        value = self._lookup(key)
+        if version == self._version:
+            cache[key] = value
+        return value
+
+    def _changed(self, key):
+        self._version += 1
+        if self._cache is not None:
+            self._cache.pop(key, None)
+
+    def invalidate(self):
+        """Forget the cached lookups, e.g. to see changes made by other
+        processes
+        """
+        self._version += 1
+        if self._cache is not None:
+            self._cache = {}
+
+    def __getitem__(self, key):
+        value = self._get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        try:
+            self._execute(
+                "INSERT OR REPLACE INTO {table} ({key}, {value}) VALUES (?, ?)",
+                (key, self._encode(value)),
+            )
+        finally:
+            self._changed(key)
+
+    def __delitem__(self, key):
+        query = "DELETE FROM {table} WHERE {key} = ? RETURNING 1"
+        try:
+            deleted = self._execute(query, (key,))
+        finally:
+            self._changed(key)
+        if not deleted:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return self._get(key) is not None
+
+    def __iter__(self):
+        return iter([row[0] for row in self._execute("SELECT {key} FROM {table}")])
+
+    def __len__(self):
+        return self._execute("SELECT COUNT(*) FROM {table}")[0][0]
+
+    def items(self):
+        """Read every row with one query
+
+        :returns: [(key, value), ...]
+        """
+        rows = self._execute("SELECT {key}, {value} FROM {table}")
+        if self._json_values:
+            return [(k, SQLiteRecord(self, k, json.loads(v))) for k, v in rows]
+        return rows
+
+    # Used by Cork to look up users by email address
+    iteritems = items
+
+    def set_field(self, key, name, value):
+        """Update one field of a record, leaving the others as they are
+        in the database
+        """
+        try:
+            self._execute(
+                "UPDATE {table} SET data = json_set(data, ?, json(?)) WHERE {key} = ?",
+                ('$."%s"' % name, self._encode(value), key),
+            )
+        finally:
+            self._changed(key)
+
+
+class SQLiteDatabase(object):
+    """SQLite database shared by threads and worker processes. Queries
+    run one at a time in each process, each in its own transaction.
+    """
+
+    schema = ""
+
+    def __init__(self, db_path):
+        self._db_path = db_path
+        self._lock = threading.Lock()
+        self._db = None
+        self._pid = None
+        with self._lock:
+            self._connection()
+
+    def _connection(self):
+        """Connect on first use in each process, as SQLite connections
+        cannot be used across fork(). Call while holding the lock.
+        """
+        if self._pid != os.getpid():
+            self._db = sqlite3.connect(
+                self._db_path, check_same_thread=False, isolation_level=None, timeout=30
+            )
+            self._db.execute("PRAGMA journal_mode = WAL")
+            self._db.executescript(self.schema)
+            self._pid = os.getpid()
+        return self._db
+
+    def execute(self, query, args=()):
+        """Run a query in its own transaction
+
+        :returns: list of rows
+        """
+        with self._lock:
+            return self._connection().execute(query, args).fetchall()
+
+
+class SQLiteAuthBackend(SQLiteDatabase):
+    """Cork backend storing users, roles and pending registrations in
+    SQLite. Each change is committed on its own by a single statement,
+    at a cost that does not depend on the number of users; the save_*
+    methods have nothing left to do.
+    Users and roles read are kept in memory, as with
+    :class:`LockedJsonBackend`, and forgotten by :meth:`refresh`.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS roles (
+            role TEXT PRIMARY KEY,
+            level INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS register (
+            code TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, db_path, ttl=None):
+        super(SQLiteAuthBackend, self).__init__(db_path)
+        self.users = SQLiteTable(self, "users", "username", cache=True)
+        self.roles = SQLiteTable(self, "roles", "role", json_values=False, cache=True)
+        self.pending_registrations = SQLiteTable(self, "register", "code")
+        self._ttl = AUTH_CACHE_TTL if ttl is None else ttl
+        self._expires = time.monotonic() + self._ttl
+
+    def refresh(self, force=False):
+        """Forget the users and roles read, to see the changes made by
+        other processes, at most once every ttl seconds unless forced
+        """
+        now = time.monotonic()
+        if force or now >= self._expires:
+            self._expires = now + self._ttl
+            self.users.invalidate()
+            self.roles.invalidate()
+
+    def migrate_json(self, directory):
+        """Import the users, roles and pending registrations saved by
+        the JSON backend in one transaction, unless there are users in
+        the database already. The JSON files are left in place.
+
+        :returns: int -- number of users imported
+        """
+        try:
+            data = {}
+            for fname in ("users", "roles", "register"):
+                with open(os.path.join(directory, fname + ".json")) as f:
+                    data[fname] = json.load(f)
+        except FileNotFoundError:
+            return 0
+
+        with self._lock:
+            db = self._connection()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                if db.execute("SELECT 1 FROM users LIMIT 1").fetchall():
+                    db.execute("ROLLBACK")
+                    return 0
+
+                for fname, table in (
+                    ("users", self.users),
+                    ("register", self.pending_registrations),
+                ):
+                    db.executemany(
+                        "INSERT INTO %s VALUES (?, ?)" % fname,
+                        ((k, table._encode(v)) for k, v in data[fname].items()),
+                    )
+                db.executemany("INSERT INTO roles VALUES (?, ?)", data["roles"].items())
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+        self.refresh(force=True)
+        return len(data["users"])
+
+    def save_users(self):
+        pass
+
+    def save_roles(self):
+        pass
+
+    def save_pending_registrations(self):
+        pass
+
+
+AUTH_BACKENDS = ("json", "sqlite")
+
+
+def open_auth_backend(directory, kind="json", initialize=False):
+    """Open the users and roles store, migrating the JSON files into
+    a new SQLite database
+
+    :param kind: one of AUTH_BACKENDS
+    """
+    if kind == "json":
+        return LockedJsonBackend(directory, initialize=initialize)
+
+    backend = SQLiteAuthBackend(os.path.join(directory, "auth.sqlite"))
+    if not initialize:
+        cnt = backend.migrate_json(directory)
+        if cnt:
+            print("Migrated %d users from JSON files to SQLite" % cnt)
+    return backend
+
+
+class Session(dict):
+    """Session data of a request, with the methods of Beaker sessions
+    used by Cork. The data is stored once the response starts.
+    """
+
+    def __init__(self, data=None, session_id=None):
+        super(Session, self).__init__(data or {})
+        self.id = session_id
+        # User the session was loaded with, to detect logins
+        self.username = self.get("username")
+        self.domain = None
+        self.changed = False
+        self.deleted = False
+
+    def save(self):
+        self.changed = True
+
+    def delete(self):
+        self.clear()
+        self.deleted = True
+
+
+class MemorySessionStore(object):
+    """Sessions kept by a single process, dropping the least recently
+    used ones when there are more than max_sessions
+    """
+
+    def __init__(self, max_sessions=SESSION_MEMORY_MAX):
+        self.max_sessions = max_sessions
+        self._sessions = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        with self._lock:
+            data = self._sessions.get(session_id)
+            if data is None:
+                return None
+            self._sessions.move_to_end(session_id)
+            return dict(data)
+
+    def save(self, session_id, data):
+        with self._lock:
+            self._sessions[session_id] = dict(data)
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+
+class SQLiteSessionStore(SQLiteDatabase):
+    """Sessions stored in SQLite, shared by worker processes and kept
+    across restarts. Expired sessions are purged at most once an hour.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            expires REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires);
+    """
+
+    def __init__(self, db_path, timeout=SESSION_TIMEOUT):
+        super(SQLiteSessionStore, self).__init__(db_path)
+        self.timeout = timeout
+        self._next_purge = 0
+
+    def get(self, session_id):
+        rows = self.execute(
+            "SELECT data FROM sessions WHERE id = ? AND expires > ?",
+            (session_id, time.time()),
+        )
+        return json.loads(rows[0][0]) if rows else None
+
+    def save(self, session_id, data):
+        now = time.time()
+        self.execute(
+            "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)",
+            (session_id, json.dumps(data), now + self.timeout),
+        )
+        if time.monotonic() >= self._next_purge:
+            self._next_purge = time.monotonic() + 3600
+            self.execute("DELETE FROM sessions WHERE expires <= ?", (now,))
+
+    def delete(self, session_id):
+        self.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+
+SESSION_STORES = ("memory", "sqlite", "cookie")
+
+
+def cookie_session_app(app, auth_dir):
+    """Keep sessions in encrypted cookies with Beaker, as previous releases
+    did. The key is kept in the token file in auth_dir.
+
+    :raises: ValueError if Beaker or an AES library is missing
+    """
+    if BeakerSessionMiddleware is None:
+        raise ValueError("cookie sessions need the Beaker library")
+
+    from beaker.crypto import get_crypto_module
+
+    if not get_crypto_module("default").has_aes:
+        raise ValueError("cookie sessions need an AES library, e.g. cryptography")
+
+    token_path = os.path.join(auth_dir, "token")
+    if not os.path.exists(token_path):
+        fd = os.open(token_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(gen_random_token(21))
+
+    with open(token_path) as f:
+        key = f.read()
+
+    session_opts = {
+        "session.cookie_expires": True,
+        "session.encrypt_key": key,
+        "session.httponly": True,
+        "session.timeout": SESSION_TIMEOUT,
+        "session.type": "cookie",
+        "session.validate_key": key,
+    }
+    return BeakerSessionMiddleware(app, session_opts)
+
+
+class SessionMiddleware(object):
+    """WSGI middleware providing sessions to Cork, in place of Beaker.
+    Sessions are kept by a store on the server: the cookie carries a
+    random id only, and is sent when a session starts or ends.
+    """
+
+    cookie_name = "shoebill_session"
+    # Where Cork looks for the session
+    environ_key = "beaker.session"
+
+    def __init__(
+        self,
+        app,
+        store,
+        timeout=SESSION_TIMEOUT,
+        touch_interval=SESSION_TOUCH_INTERVAL,
+    ):
+        self.app = app
+        self.store = store
+        self.timeout = timeout
+        self.touch_interval = touch_interval
+
+    def load(self, environ):
+        """Load the session of a request, or start an empty one
+
+        :returns: Session
+        """
+        try:
+            cookies = http.cookies.SimpleCookie(environ.get("HTTP_COOKIE", ""))
+        except http.cookies.CookieError:
+            return Session()
+
+        morsel = cookies.get(self.cookie_name)
+        data = self.store.get(morsel.value) if morsel else None
+        if data is None:
+            return Session()
+
+        session = Session(data, morsel.value)
+        idle = time.time() - data.get("_accessed_time", 0)
+        if idle > self.timeout:
+            self.store.delete(session.id)
+            return Session()
+        if idle > self.touch_interval:
+            session.changed = True
+        return session
+
+    def persist(self, session, environ):
+        """Store or delete a session
+
+        :returns: Set-Cookie header value or None
+        """
+        if session.deleted:
+            if session.id is None:
+                return None
+            self.store.delete(session.id)
+            return self._cookie(environ, session, "", "; Max-Age=0")
+
+        if not session.changed:
+            return None
+
+        now = time.time()
+        if session.id is not None and session.get("username") != session.username:
+            # The user changed: issue a new id, so that an id planted in
+            # the browser before a login cannot be used to ride on it
+            self.store.delete(session.id)
+            session.id = None
+        new = session.id is None
+        if new:
+            session.id = secrets.token_urlsafe(24)
+            session["_id"] = session.id
+            session["_creation_time"] = now
+        session["_accessed_time"] = now
+        self.store.save(session.id, session)
+        session.changed = False
+        if new:
+            return self._cookie(environ, session, session.id)
+        return None
+
+    def _cookie(self, environ, session, value, attrs=""):
+        cookie = "%s=%s; Path=/; HttpOnly; SameSite=Lax%s" % (
+            self.cookie_name,
+            value,
+            attrs,
+        )
+        if session.domain:
+            cookie += "; Domain=%s" % session.domain
+        if environ.get("wsgi.url_scheme") == "https":
+            cookie += "; Secure"
+        return cookie
+
+    def __call__(self, environ, start_response):
+        session = self.load(environ)
+        environ[self.environ_key] = session
+
+        def session_start_response(status, headers, exc_info=None):
+            cookie = self.persist(session, environ)
+            if cookie:
+                headers.append(("Set-Cookie", cookie))
+            return start_response(status, headers, exc_info)
+
+        return self.app(environ, session_start_response)
+
+
+@bottle.hook("before_request")
+def refresh_auth_data():
+    """Pick up users and roles changed by other worker processes. Logins
+    and changes to users are made on up to date data.
+    """
+    if aaa and isinstance(aaa._store, (LockedJsonBackend, SQLiteAuthBackend)):
+        aaa._store.refresh(force=bottle.request.method == "POST")
+
+
+class MetricsPlugin(object):
+    """Bottle plugin counting and timing the requests to each route.
+    Streamed responses are timed until the app returns them.
+    """
+
+    name = "metrics"
+    api = 2
+
+    def apply(self, callback, route):
+        rule = route.rule
+        method = route.method
+        duration = http_request_duration.labels(rule, method)
+
+        def wrapper(*args, **kwargs):
+            t0 = time.monotonic()
+            status = 500
+            try:
+                rv = callback(*args, **kwargs)
+                if isinstance(rv, bottle.HTTPResponse):
+                    status = rv.status_code
+                else:
+                    status = bottle.response.status_code
+                return rv
+            except bottle.HTTPResponse as e:
+                status = e.status_code
+                raise
+            finally:
+                duration.observe(time.monotonic() - t0)
+                http_requests.labels(rule, method, str(status)).inc()
+                metrics.flush()
+
+        return wrapper
+
+
+app.install(MetricsPlugin())
+
+
+@bottle.get("/metrics")
+def route_metrics():
+    """Serve the metrics of all the worker processes in the Prometheus
+    text format
+    """
+    auth = bottle.request.get_header("Authorization", "").encode()
+    if not (
+        metrics_token
+        and hmac.compare_digest(auth, b"Bearer " + metrics_token.encode())
+    ):
+        api_require_auth()
+
+    bottle.response.content_type = "text/plain; version=0.0.4; charset=utf-8"
+    return metrics.render()
+
+
+@bottle.get("/admin/profiles")
+def route_profiles():
+    """List the request profiles kept by --profile and --profile-slow"""
+    api_require_auth(role="admin")
+    if profile_store is None:
+        raise api_error(404, "Profiling is not enabled")
+
+    return {"profiles": profile_store.list()}
+
+
+@bottle.get("/admin/profiles/<profile_id:re:[0-9]+-[0-9]+>.<fmt>")
+def route_profile(profile_id, fmt):
+    """Serve a request profile as a text summary, as pstats data to load
+    with the pstats module or snakeviz, or as collapsed stacks for
+    flamegraph.pl or speedscope
+    """
+    api_require_auth(role="admin")
+    data = None
+    if profile_store is not None:
+        data = profile_store.render(profile_id, fmt)
+    if data is None:
+        raise api_error(404, "Profile not found")
+
+    if fmt == "pstats":
+        bottle.response.content_type = "application/octet-stream"
+        bottle.response.set_header(
+            "Content-Disposition", 'attachment; filename="%s.pstats"' % profile_id
+        )
+    else:
+        bottle.response.content_type = "text/plain; charset=utf-8"
+    return data
+
+
+# Admin-only pages
+
+
+@bottle.route("/admin")
 @bottle.route("/admin/")
 @bottle.view("admin_page")
 def admin():
     """Only admin users can see this"""
     # aaa.require(role='admin', fail_redirect='/')
     return dict(
-        current_user=aaa.current_user, users=aaa.list_users(), roles=aaa.list_roles()
+        current_user=aaa.current_user,
+        users=aaa.list_users(),
+        roles=aaa.list_roles(),
+        login_latency=login_latency,
+        password_hasher=password_hasher,
     )
 
 
@@ -431,7 +4553,7 @@ def create_user():
         aaa.create_user(post_get("username"), post_get("role"), post_get("password"))
         return msg("User created")
     except Exception as e:
-        return error(msg=e.message)
+        return error(msg=str(e))
 
 
 @bottle.post("/delete_user")
@@ -440,7 +4562,7 @@ def delete_user():
         aaa.delete_user(post_get("username"))
         return msg("User deleted")
     except Exception as e:
-        return error(msg=e.message)
+        return error(msg=str(e))
 
 
 @bottle.post("/create_role")
@@ -449,7 +4571,7 @@ def create_role():
         aaa.create_role(post_get("role"), post_get("level"))
         return msg("Role created")
     except Exception as e:
-        return error(msg=e.message)
+        return error(msg=str(e))
 
 
 @bottle.post("/delete_role")
@@ -458,12 +4580,197 @@ def delete_role():
         aaa.delete_role(post_get("role"))
         return msg("Role deleted")
     except Exception as e:
-        return error(msg=e.message)
+        return error(msg=str(e))
 
 
 # end of admin-only pages
 
 
+class ThreadPoolWSGIServer(WSGIServer):
+    """WSGI server handling requests in a pool of threads. The pool is
+    created on the first request, hence after forking worker processes.
+    """
+
+    threads = 8
+    # Length of the listen(2) backlog, 5 by default
+    request_queue_size = 128
+    _pool = None
+
+    def process_request(self, request, client_address):
+        if self._pool is None:
+            self._pool = concurrent.futures.ThreadPoolExecutor(self.threads)
+        self._pool.submit(self._process_request_thread, request, client_address)
+
+    def _process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super(ThreadPoolWSGIServer, self).server_close()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kw):
+        pass
+
+
+class ThreadedServer(bottle.ServerAdapter):
+    """Bottle adapter for :class:`ThreadPoolWSGIServer`.
+    Options: threads (per process), workers (processes forked to accept
+    connections on the same socket) and init_worker, a function called in
+    each worker process after forking.
+    """
+
+    def __repr__(self):
+        return "ThreadedServer(threads=%d, workers=%d)" % (
+            self.options.get("threads", ThreadPoolWSGIServer.threads),
+            self.options.get("workers", 1),
+        )
+
+    def run(self, handler):
+        handler_class = QuietRequestHandler if self.quiet else WSGIRequestHandler
+        server = make_server(
+            self.host, int(self.port), handler, ThreadPoolWSGIServer, handler_class
+        )
+        server.threads = self.options.get("threads", ThreadPoolWSGIServer.threads)
+        workers = self.options.get("workers", 1)
+        init_worker = self.options.get("init_worker")
+        try:
+            if workers > 1:
+                run_prefork(server, workers, init_worker)
+            else:
+                if init_worker:
+                    init_worker()
+                server.serve_forever()
+        finally:
+            server.server_close()
+
+
+def run_prefork(server, workers, init_worker=None):
+    """Fork worker processes serving requests from the listening socket of
+    the server, restarting the ones that die. On exit, workers are
+    terminated.
+    """
+    master_pid = os.getpid()
+    children = set()
+
+    def spawn():
+        pid = os.fork()
+        if pid:
+            children.add(pid)
+            return
+
+        code = 0
+        try:
+            setproctitle("shoebill worker")
+            if init_worker:
+                init_worker()
+            server.serve_forever()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        except Exception:
+            log.exception("Worker %d failed", os.getpid())
+            code = 1
+        # Signals sent to the whole process group must not interrupt the
+        # shutdown, which runs the atexit handlers
+        ignore_stop_signals()
+        sys.exit(code)
+
+    try:
+        for _ in range(workers):
+            spawn()
+
+        while True:
+            pid, status = os.wait()
+            children.discard(pid)
+            log.error("Worker %d exited with status %d, restarting", pid, status)
+            time.sleep(1)
+            spawn()
+
+    finally:
+        if os.getpid() == master_pid:
+            ignore_stop_signals()
+            stop_workers(children)
+
+
+def ignore_stop_signals():
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def stop_workers(pids, timeout=10):
+    """Terminate worker processes, killing the ones still running after
+    the timeout
+    """
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    deadline = time.monotonic() + timeout
+    try:
+        while pids and time.monotonic() < deadline:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+            if pid:
+                pids.discard(pid)
+            else:
+                time.sleep(0.05)
+
+        for pid in pids:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+    except ChildProcessError:
+        pass
+
+
+# Name of the option setting the number of threads of each server
+SERVER_THREADS_OPTIONS = {
+    "threaded": "threads",
+    "cheroot": "numthreads",
+    "cherrypy": "numthreads",
+    "gunicorn": "threads",
+    "paste": "threadpool_workers",
+    "waitress": "threads",
+}
+
+# Servers able to run more than one worker process
+PREFORK_SERVERS = ("threaded", "gunicorn")
+
+
+def server_options(server, threads=None, workers=1, init_worker=None):
+    """Translate the thread and worker counts into options of a server
+
+    :returns: dict
+    :raises: ValueError if the server does not support them
+    """
+    options = {}
+    if threads is not None:
+        if server not in SERVER_THREADS_OPTIONS:
+            raise ValueError("--threads is not supported by %s" % server)
+        options[SERVER_THREADS_OPTIONS[server]] = threads
+
+    if workers > 1:
+        if server not in PREFORK_SERVERS:
+            raise ValueError("--workers is not supported by %s" % server)
+        options["workers"] = workers
+
+    if init_worker is None:
+        pass
+    elif server == "gunicorn":
+        options["post_fork"] = lambda arbiter, worker: init_worker()
+    elif server == "threaded":
+        options["init_worker"] = init_worker
+
+    return options
+
+
 def check_site_dir(site_path, content_path):
 
     if not os.path.isdir(site_path):
@@ -479,18 +4786,92 @@ def check_site_dir(site_path, content_path):
         print("WARNING: missing Makefile at %s" % makefile)
 
 
-def setup_git_repo(site_path):
+def setup_search_index(site_path, content_path, sync=True):
+    global search_index
+    db_path = os.path.join(site_path, ".shoebill_search.sqlite")
+    try:
+        search_index = SearchIndex(db_path, content_path)
+    except sqlite3.Error as e:
+        print("Search disabled: unable to create the search index: %s" % e)
+        return
+
+    if sync:
+        t0 = time.monotonic()
+        cnt = search_index.sync()
+        elapsed = time.monotonic() - t0
+        print("Search index updated (%d files) in %.3fs" % (cnt, elapsed))
+
+
+def setup_git_repo(site_path, untracked_cache=False, fsmonitor=None, in_process=False):
+    """Open the site Git repository, optionally enabling the untracked
+    cache and a filesystem monitor for every Git command we run.
+    With in_process, objects are read and written without running git.
+    """
     global git_repo
+    global git_ops
     try:
-        git_repo = Repo(site_path)
+        git_repo = Repo(site_path, odbt=GitDB) if in_process else Repo(site_path)
     except InvalidGitRepositoryError:
         print("%s is not a valid Git repository" % site_path)
+        return
+
+    config = []
+    if untracked_cache:
+        config.append(("core.untrackedCache", "true"))
+    if fsmonitor:
+        config.append(("core.fsmonitor", fsmonitor))
+
+    env = {"GIT_CONFIG_COUNT": str(len(config))}
+    for n, (key, value) in enumerate(config):
+        env["GIT_CONFIG_KEY_%d" % n] = key
+        env["GIT_CONFIG_VALUE_%d" % n] = value
+
+    if config:
+        git_repo.git.update_environment(**env)
+
+    git_ops = InProcessGit() if in_process else SubprocessGit()
+    # Worker processes update the index in turn
+    git_lock.path = os.path.join(git_repo.git_dir, "shoebill.lock")
+
+
+def setup_process_state(site_path, args, run_dir=None):
+    """Set up the content and search indexes, the Git repository and the
+    build queue of a server process. Worker processes run this after
+    forking, as threads, inotify watches, SQLite connections and git
+    subprocesses cannot be shared with the parent. They share the build
+    state, the lock files and the metrics in run_dir.
+    """
+    global build_queue
+    global content_index
+
+    content_index = ContentIndex(content_path)
+    dircnt = content_index.build()
+    mode = "inotify" if content_index.uses_inotify else "polling"
+    scan_time = content_index.scan_time
+    print("Indexed %d directories in %.3fs (%s)" % (dircnt, scan_time, mode))
+    # With worker processes the index is synced once, before forking
+    setup_search_index(site_path, content_path, sync=run_dir is None)
+    setup_git_repo(
+        site_path,
+        untracked_cache=args.git_untracked_cache,
+        fsmonitor=args.git_fsmonitor,
+        in_process=args.git_in_process,
+    )
+    if run_dir:
+        build_queue = BuildQueue(state_dir=os.path.join(run_dir, "builds"))
+        locks.configure(os.path.join(run_dir, "locks"))
+        metrics.directory = os.path.join(run_dir, "metrics")
+    atexit.register(committer.flush)
 
 
 def main():
     global aaa
     global app
     global content_path
+    global large_file_threshold
+    global fsync_policy
+    global metrics_token
+    global profile_store
 
     setproctitle("shoebill")
 
@@ -500,15 +4881,53 @@ def main():
     content_path = os.path.join(site_path, "content")
     check_site_dir(site_path, content_path)
 
+    # Forking servers set up each worker process after forking it
+    forking = args.workers > 1 or args.server == "gunicorn"
+    run_dir = None
+    init_worker = None
+    if forking:
+        run_dir = tempfile.mkdtemp(prefix="shoebill-")
+        os.mkdir(os.path.join(run_dir, "builds"))
+        os.mkdir(os.path.join(run_dir, "locks"))
+        os.mkdir(os.path.join(run_dir, "metrics"))
+        init_worker = functools.partial(setup_process_state, site_path, args, run_dir)
+
+    try:
+        options = server_options(args.server, args.threads, args.workers, init_worker)
+    except ValueError as e:
+        print("Error: %s" % e)
+        sys.exit(1)
+
+    if args.sessions is None:
+        args.sessions = "sqlite" if forking else "memory"
+    elif args.sessions == "memory" and forking:
+        print("Error: worker processes cannot share in-memory sessions")
+        sys.exit(1)
+
     print("Starting Shoebill...")
-    setup_git_repo(site_path)
+    if forking:
+        setup_search_index(site_path, content_path)
+        if search_index:
+            search_index.close()
+    else:
+        setup_process_state(site_path, args)
+
+    committer.delay = args.commit_delay
+    password_hasher.processes = args.hash_processes
+    large_file_threshold = args.large_file_threshold
+    fsync_policy = args.fsync
+    if args.metrics_token_file:
+        with open(args.metrics_token_file) as f:
+            metrics_token = f.read().strip() or None
+    # Run atexit handlers on SIGTERM too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
     if not args.no_auth:
         # Setup authentication
         if not aaa_available:
             print(
-                """Error: the Beaker and/or Cork libraries are missing. \
-            \nPlease install them or disable authentication using --no-auth"""
+                """Error: the Cork library is missing. \
+            \nPlease install it or disable authentication using --no-auth"""
             )
             sys.exit(1)
 
@@ -517,11 +4936,8 @@ def main():
             print("Creating authentication data")
             os.mkdir(auth_dir)
 
-            token = gen_random_token(21)
-            with open(os.path.join(auth_dir, "token"), "w") as f:
-                f.write(token)
-
-            aaa = Cork(auth_dir, initialize=True, preferred_hashing_algorithm="scrypt")
+            backend = open_auth_backend(auth_dir, args.auth_backend, initialize=True)
+            aaa = PooledCork(backend=backend, preferred_hashing_algorithm="scrypt")
             aaa._store.roles["admin"] = 100
             aaa._store.roles["editor"] = 50
             aaa._store.save_roles()
@@ -529,7 +4945,9 @@ def main():
             admin_password = gen_random_token(6)
             aaa._store.users["admin"] = {
                 "role": "admin",
-                "hash": aaa._hash("admin", admin_password),
+                # Hashed here: a pool started before forking the worker
+                # processes would be unusable in them
+                "hash": Cork._hash(aaa, "admin", admin_password),
                 "email_addr": "",
                 "desc": "admin",
                 "creation_date": tstamp,
@@ -542,40 +4960,82 @@ def main():
             print("\n", "*" * 32, "\n")
 
         else:
-            aaa = Cork(auth_dir, preferred_hashing_algorithm="scrypt")
+            backend = open_auth_backend(auth_dir, args.auth_backend)
+            aaa = PooledCork(backend=backend, preferred_hashing_algorithm="scrypt")
 
     if aaa:
         # Sessions are enabled only if authentication is enabled
-        with open(os.path.join(auth_dir, "token")) as f:
-            session_encrypt_key = f.read()
-
-        session_opts = {
-            "session.cookie_expires": True,
-            "session.encrypt_key": session_encrypt_key,
-            "session.httponly": True,
-            "session.timeout": 3600 * 24,  # 1 day
-            "session.type": "cookie",
-            "session.validate_key": True,
-        }
-        wrapped_app = SessionMiddleware(app, session_opts)
-        bottle.run(
-            wrapped_app,
-            host=args.host,
-            port=args.port,
-            debug=args.debug,
-            reloader=args.debug,
-            server="auto",
-        )
+        if args.sessions == "cookie":
+            try:
+                wrapped_app = cookie_session_app(app, auth_dir)
+            except ValueError as e:
+                print("Error: %s" % e)
+                sys.exit(1)
+        else:
+            if args.sessions == "sqlite":
+                db_path = os.path.join(auth_dir, "sessions.sqlite")
+                session_store = SQLiteSessionStore(db_path)
+            else:
+                session_store = MemorySessionStore()
+            wrapped_app = SessionMiddleware(app, session_store)
 
     else:
+        wrapped_app = app
+
+    if args.profile or args.profile_slow is not None:
+        profile_dir = None
+        if run_dir:
+            profile_dir = os.path.join(run_dir, "profiles")
+            os.mkdir(profile_dir)
+        profile_store = ProfileStore(args.profile_keep, profile_dir)
+        wrapped_app = ProfilerMiddleware(
+            wrapped_app, profile_store, rate=args.profile, slow=args.profile_slow
+        )
+
+    master_pid = os.getpid()
+    try:
         bottle.run(
-            app,
+            CompressionMiddleware(wrapped_app),
             host=args.host,
             port=args.port,
             debug=args.debug,
             reloader=args.debug,
-            server="auto",
+            server=ThreadedServer if args.server == "threaded" else args.server,
+            **options,
         )
+    finally:
+        if run_dir and os.getpid() == master_pid:
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def parse_duration(value):
+    """Parse a duration in seconds, with optional 'ms', 's' or 'm' suffix
+
+    :returns: float
+    """
+    multiplier = 1
+    if value.endswith("ms"):
+        multiplier = 0.001
+    elif value.endswith("m"):
+        multiplier = 60
+    try:
+        return float(value.rstrip("sm")) * multiplier
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid duration: %r" % value)
+
+
+def parse_fraction(value):
+    """Parse a number between 0 and 1
+
+    :returns: float
+    """
+    try:
+        fraction = float(value)
+    except ValueError:
+        fraction = -1
+    if not 0 <= fraction <= 1:
+        raise argparse.ArgumentTypeError("invalid fraction: %r" % value)
+    return fraction
 
 
 def parse_args():
@@ -594,9 +5054,112 @@ def parse_args():
         default=[],
     )
     ap.add_argument("--host", default="localhost")
+    ap.add_argument(
+        "--server",
+        help="Web server: 'threaded' (default, built in) or one supported by "
+        "Bottle, e.g. waitress, cheroot or gunicorn",
+        choices=["threaded"] + sorted(bottle.server_names),
+        default="threaded",
+    )
+    ap.add_argument(
+        "--workers",
+        help="Number of server processes, for the threaded and gunicorn "
+        "servers (default: 1)",
+        type=int,
+        default=1,
+    )
+    ap.add_argument(
+        "--threads",
+        help="Number of threads handling requests in each server process "
+        "(default: 8 for the threaded server)",
+        type=int,
+    )
     ap.add_argument("-D", "--debug", action="store_true")
     ap.add_argument("directory", help="site directory")
     ap.add_argument("--no-auth", help="Disable authentication", action="store_true")
+    ap.add_argument(
+        "--auth-backend",
+        help="Store users and roles in JSON files ('json', the default) or "
+        "in SQLite ('sqlite'), importing the JSON files on first use",
+        choices=AUTH_BACKENDS,
+        default="json",
+    )
+    ap.add_argument(
+        "--sessions",
+        help="Keep sessions in memory ('memory', the default with one worker), "
+        "in SQLite, shared by worker processes ('sqlite') or in encrypted "
+        "cookies with Beaker ('cookie')",
+        choices=SESSION_STORES,
+    )
+    ap.add_argument(
+        "--metrics-token-file",
+        help="File holding a token that allows reading /metrics without "
+        "logging in, sent as 'Authorization: Bearer <token>'",
+    )
+    ap.add_argument(
+        "--profile",
+        help="Profile this fraction of the requests with cProfile, e.g. 0.01",
+        type=parse_fraction,
+        default=0.0,
+    )
+    ap.add_argument(
+        "--profile-slow",
+        help="Sample the stacks of every request and keep the profiles of "
+        "those slower than this (e.g. 500ms, 2s)",
+        type=parse_duration,
+    )
+    ap.add_argument(
+        "--profile-keep",
+        help="Number of profiles kept by each process (default: %d)"
+        % PROFILES_KEPT,
+        type=int,
+        default=PROFILES_KEPT,
+    )
+    ap.add_argument(
+        "--hash-processes",
+        help="Number of processes hashing passwords (default: %d)"
+        % PASSWORD_HASH_PROCESSES,
+        type=int,
+        default=PASSWORD_HASH_PROCESSES,
+    )
+    ap.add_argument(
+        "--commit-delay",
+        help="Commit files saved within this time window together "
+        "(e.g. 30s or 2m, default: commit on every save)",
+        type=parse_duration,
+        default=0,
+    )
+    ap.add_argument(
+        "--large-file-threshold",
+        help="Edit files bigger than this size (in bytes) one page at a time "
+        "(default: 1048576)",
+        type=int,
+        default=large_file_threshold,
+    )
+    ap.add_argument(
+        "--fsync",
+        help="Flush saved files to disk before renaming them into place "
+        "('file', the default), also flush their directory ('full') "
+        "or never ('none')",
+        choices=FSYNC_POLICIES,
+        default=fsync_policy,
+    )
+    ap.add_argument(
+        "--git-in-process",
+        help="Stage and commit files through GitPython without running git "
+        "(commit hooks are not run)",
+        action="store_true",
+    )
+    ap.add_argument(
+        "--git-untracked-cache",
+        help="Enable the Git untracked cache",
+        action="store_true",
+    )
+    ap.add_argument(
+        "--git-fsmonitor",
+        help="Set Git core.fsmonitor: 'true' for the builtin daemon "
+        "or the path of a hook, e.g. for Watchman",
+    )
 
     args = ap.parse_args()
     make_targets = args.target
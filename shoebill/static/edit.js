@@ -0,0 +1,5 @@
+function updateNewFileAction() {
+    var path = document.getElementById('newfileform').action;
+    var fname = document.getElementById("newfileinput").value;
+    document.getElementById('newfileform').action = path + fname;
+}
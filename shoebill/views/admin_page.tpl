@@ -51,6 +51,13 @@
             <tr><td>{{r[0]}}</td><td>{{r[1]}}</td></tr>
             %end
         </table>
+        <br/>
+        <p>Logins handled by this process: {{login_latency.count}}
+        %if login_latency.count:
+        - latency: median &le; {{"%g" % login_latency.quantile(0.5)}}s,
+        90th percentile &le; {{"%g" % login_latency.quantile(0.9)}}s
+        %end
+        - password hashes in progress: {{password_hasher.pending}}</p>
     </div>
 
     <div class="clear"></div>
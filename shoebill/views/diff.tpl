@@ -0,0 +1,17 @@
+% include("msgbox_head")
+        <p>Commit {{sha[:8]}} on <a href="/history/{{path.as_url}}">{{path.as_url}}</a></p>
+        <div id="outputbox">
+            % for line in lines:
+                % if line.startswith("+") and not line.startswith("+++"):
+                <span class="addedline">{{line}}</span>
+                % elif line.startswith("-") and not line.startswith("---"):
+                <span class="errorline">{{line}}</span>
+                % else:
+                <span>{{line}}</span>
+                % end
+                <br/>
+            % end
+        </div>
+        <a href="/history/{{path.as_url}}">go back</a>
+    </body>
+</html>
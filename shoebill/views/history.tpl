@@ -0,0 +1,23 @@
+% include("msgbox_head")
+        <p>History of <a href="/edit/{{path.as_url}}">{{path.as_url}}</a></p>
+        <div id="outputbox">
+            % for c in commits:
+            <span>
+                <a href="/diff/{{path.as_url}}?rev={{c['sha']}}">{{c['sha'][:8]}}</a>
+                {{c['date'].strftime("%Y-%m-%d %H:%M")}} {{c['author']}}: {{c['summary']}}
+            </span>
+            <br/>
+            % end
+            % if not commits:
+            <span>No commits found.</span>
+            % end
+        </div>
+        % if page > 1:
+        <a href="/history/{{path.as_url}}?page={{page - 1}}">newer</a>
+        % end
+        % if has_next:
+        <a href="/history/{{path.as_url}}?page={{page + 1}}">older</a>
+        % end
+        <a href="/edit/{{path.as_url}}">go back</a>
+    </body>
+</html>
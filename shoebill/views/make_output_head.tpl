@@ -0,0 +1,3 @@
+% include("msgbox_head")
+        <p>Build #{{job.job_id}}: make {{job.target}}</p>
+        <div id="outputbox">
@@ -0,0 +1,7 @@
+        </div>
+        % if job.returncode:
+        <div id="errmsg">make {{job.target}} failed with exit status {{job.returncode}}</div>
+        % end
+        <a href="/edit">go back</a>
+    </body>
+</html>
@@ -0,0 +1,7 @@
+<!DOCTYPE HTML>
+<html>
+    <head>
+        <title>Pelican editor</title>
+        <link rel="stylesheet" href="{{asset_url('msgbox.css')}}">
+    </head>
+    <body>
@@ -0,0 +1,19 @@
+% include("msgbox_head")
+        <form action="/search" method="GET">
+            <input type="text" name="q" value="{{query}}">
+            <input type="submit" value="Search">
+        </form>
+        % if not search_enabled:
+        <div id="errmsg">Search is not available.</div>
+        % elif query and not results:
+        <p>No results for "{{query}}".</p>
+        % end
+        % for url, snippet in results:
+        <div class="result">
+            <a href="/edit/{{url}}">{{url}}</a>
+            <p>{{!snippet}}</p>
+        </div>
+        % end
+        <a href="/edit">go back</a>
+    </body>
+</html>
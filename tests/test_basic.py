@@ -2,8 +2,21 @@
 # Shoebill unit testing
 #
 
+from io import BytesIO
 from mock import patch, Mock
+from tempfile import mkdtemp
+from webtest import TestApp
+import argparse
+import gzip
+import http.client
+import marshal
 import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import zlib
 
 import shoebill
 from shoebill import Path, gen_random_token
@@ -39,6 +52,23 @@ class TestPathOnDir(object):
     def test_url_chunks(self):
         assert self._p.url_chunks() == ["a", "b", ""]
 
+    def test_as_abs_path(self):
+        assert self._p.as_abs_path == "/tmp/foo/a/b/"
+
+    def test_root(self):
+        p = Path(relurl="")
+        assert p.is_dir
+        assert p.as_url == "/"
+        assert p.as_relative_path == ""
+        assert p.as_abs_path == "/tmp/foo/"
+        assert p.basename() == "foo"
+
+    def test_basedir_outside_content_dir(self):
+        p = Path(relurl="test.rst").basedir()
+        assert p.as_abs_path == "/tmp/foo"
+        assert not p.is_dir
+        assert p.basedir().as_abs_path == "/tmp"
+
 
 class TestPathOnFile(object):
     def setUp(self):
@@ -58,6 +88,9 @@ class TestPathOnFile(object):
     def test_as_abs_path(self):
         assert self._p.as_abs_path == "/tmp/foo/a/b/test.rst"
 
+    def test_as_site_relative_path(self):
+        assert self._p.as_site_relative_path == "foo/a/b/test.rst"
+
     def test_url_chunks(self):
         assert self._p.url_chunks() == ["a", "b", "test.rst"]
 
@@ -70,3 +103,1230 @@ class TestPathOnFile(object):
 
     def test_repr(self):
         assert "<Path" in repr(self._p)
+
+    def test_slots(self):
+        assert not hasattr(self._p, "__dict__")
+
+
+class TestPathListing(object):
+    def setUp(self):
+        self._tmpdir = mkdtemp()
+        shoebill.content_path = self._tmpdir
+        for name in ("c", "c-d", "sub", ".git"):
+            os.mkdir(os.path.join(self._tmpdir, name))
+        for name in ("b.rst", "a.rst", ".hidden.rst", "sub/c.rst"):
+            open(os.path.join(self._tmpdir, name), "w").close()
+
+    def tearDown(self):
+        shoebill.content_path = None
+        shutil.rmtree(self._tmpdir)
+
+    def test_list_current_dir(self):
+        dirs, files = Path(relurl="a.rst").list_current_dir()
+        assert [d.as_url for d in dirs] == ["c/", "c-d/", "sub/"]
+        assert [f.as_url for f in files] == ["a.rst", "b.rst"]
+        assert [d.basename() for d in dirs] == ["c", "c-d", "sub"]
+
+        dirs, files = Path(relurl="sub/").list_current_dir()
+        assert dirs == []
+        assert [f.as_url for f in files] == ["sub/c.rst"]
+
+    def test_list_hidden_dir(self):
+        assert Path(relurl=".git/x").list_current_dir() == ([], [])
+
+    def test_types_from_scan(self):
+        dirs, files = Path(relurl="").list_current_dir()
+        with patch("os.stat", side_effect=AssertionError("Unexpected stat")):
+            assert all(d.is_real_dir and not d.is_real_file for d in dirs)
+            assert all(f.is_real_file and not f.is_real_dir for f in files)
+
+
+class TestBuildQueue(object):
+    def setUp(self):
+        self._release = threading.Event()
+        self._queue = shoebill.BuildQueue()
+
+    def tearDown(self):
+        self._release.set()
+
+    def _fake_make(self, target, changed_files=None, changed_list=None):
+        self._release.wait(5)
+        if changed_files is not None:
+            with open(changed_list) as f:
+                assert f.read().splitlines() == changed_files
+        cmd = Mock()
+        cmd.stdout = BytesIO(b"built %s\n" % target.encode())
+        cmd.wait.return_value = 0
+        return cmd
+
+    @patch("shoebill.spawn_make")
+    def test_queued_target_is_merged(self, spawn_make):
+        spawn_make.side_effect = self._fake_make
+        running = self._queue.submit("publish")
+        while running.state == "queued":
+            running.wait(0.01)
+
+        queued = self._queue.submit("publish")
+        assert queued is not running
+        assert self._queue.submit("publish") is queued
+        other = self._queue.submit("other")
+        assert other is not queued
+
+        self._release.set()
+        assert other.wait(5)
+        assert self._queue.get(queued.job_id) is queued
+        assert list(queued.follow()) == ["built publish\n"]
+        assert spawn_make.call_count == 3
+
+    @patch("shoebill.spawn_make")
+    def test_changed_files_since_last_build(self, spawn_make):
+        self._release.set()
+        spawn_make.side_effect = self._fake_make
+        assert self._queue.submit("publish").wait(5)
+        self._queue.record_change("content/b.rst")
+        self._queue.record_change("content/a.rst")
+        assert self._queue.submit("publish").wait(5)
+        assert self._queue.submit("publish").wait(5)
+        calls = [c[0][:2] for c in spawn_make.call_args_list]
+        assert calls == [
+            ("publish", None),
+            ("publish", ["content/a.rst", "content/b.rst"]),
+            ("publish", []),
+        ]
+
+    @patch("shoebill.spawn_make")
+    def test_full_build_after_failure(self, spawn_make):
+        self._release.set()
+        spawn_make.side_effect = self._fake_make
+        assert self._queue.submit("publish").wait(5)
+        self._queue.record_change("content/a.rst")
+        spawn_make.side_effect = Exception("E2BIG")
+        job = self._queue.submit("publish")
+        assert job.wait(5)
+        assert job.returncode == -1
+        spawn_make.side_effect = self._fake_make
+        self._queue.record_change("content/b.rst")
+        assert self._queue.submit("publish").wait(5)
+        assert self._queue.submit("publish").wait(5)
+        calls = [c[0][:2] for c in spawn_make.call_args_list]
+        assert calls[2:] == [("publish", None), ("publish", [])]
+
+    @patch("shoebill.spawn_make")
+    def test_full_build_after_too_many_changes(self, spawn_make):
+        self._release.set()
+        spawn_make.side_effect = self._fake_make
+        assert self._queue.submit("publish").wait(5)
+        with patch("shoebill.MAX_CHANGED_FILES", 2):
+            for name in "abc":
+                self._queue.record_change("content/%s.rst" % name)
+        assert self._queue._changed["publish"] == set()
+        assert self._queue.submit("publish").wait(5)
+        assert spawn_make.call_args_list[1][0][:2] == ("publish", None)
+
+    def test_large_change_set(self):
+        site_path = mkdtemp()
+        try:
+            with open(os.path.join(site_path, "Makefile"), "w") as f:
+                f.write("publish:\n\t@cat /dev/null $(CHANGED_FILES_LIST) | wc -l\n")
+                f.write('\t@echo "[$(CHANGED_FILES)]"\n')
+            with patch("shoebill.content_path", os.path.join(site_path, "content")):
+                assert self._queue.submit("publish").wait(5)
+                # Longer than the maximum length of an argument
+                for n in range(5000):
+                    self._queue.record_change("content/posts/post-%06d.rst" % n)
+                self._queue.record_change("content/with space.rst")
+                job = self._queue.submit("publish")
+                assert job.wait(5)
+        finally:
+            shutil.rmtree(site_path)
+
+        assert job.returncode == 0, list(job.output)
+        assert list(job.output) == ["5001\n", "[]\n"]
+
+    @patch("shoebill.spawn_make")
+    def test_shared_state_dir(self, spawn_make):
+        spawn_make.side_effect = self._fake_make
+        state_dir = mkdtemp()
+        try:
+            queue = shoebill.BuildQueue(state_dir=state_dir)
+            other_queue = shoebill.BuildQueue(state_dir=state_dir)
+            job = queue.submit("publish")
+            shared = other_queue.get(job.job_id)
+            assert isinstance(shared, shoebill.SharedBuildJob)
+            assert shared.target == "publish"
+            other_job = other_queue.submit("html")
+            assert other_job.job_id != job.job_id
+            assert other_queue.get(other_job.job_id + 1) is None
+
+            self._release.set()
+            assert list(shared.follow()) == ["built publish\n"]
+            assert shared.as_dict()["state"] == "succeeded"
+            assert shared.as_dict()["output_lines"] == 1
+            assert other_job.wait(5)
+            # Builds run one at a time and are never incremental
+            calls = [c[0][:2] for c in spawn_make.call_args_list]
+            assert calls == [("publish", None), ("html", None)]
+        finally:
+            shutil.rmtree(state_dir)
+
+    def test_follow_skips_dropped_lines(self):
+        job = shoebill.BuildJob(1, "publish")
+        job.output = shoebill.collections.deque(maxlen=2)
+        for n in range(5):
+            job.append_output(str(n))
+        job.finish(0)
+        assert list(job.follow()) == ["3", "4"]
+
+
+    def test_output_size_limit(self):
+        job = shoebill.BuildJob(1, "publish")
+        with patch("shoebill.MAX_BUILD_OUTPUT_SIZE", 10):
+            for n in range(5):
+                job.append_output("line %d" % n)
+            job.append_output("a long line")
+        job.finish(0)
+        assert list(job.follow()) == ["a long line"]
+        assert job.as_dict()["output_lines"] == 6
+
+    @patch("shoebill.spawn_make")
+    def test_old_outputs_dropped(self, spawn_make):
+        self._release.set()
+        spawn_make.side_effect = self._fake_make
+        with patch("shoebill.BUILD_OUTPUTS_KEPT", 2):
+            jobs = []
+            for _ in range(3):
+                jobs.append(self._queue.submit("publish"))
+                assert jobs[-1].wait(5)
+            # The build thread expires jobs after marking them as done
+            for _ in range(100):
+                if jobs[0].output_dropped:
+                    break
+                time.sleep(0.01)
+        assert list(jobs[0].follow()) == []
+        assert self._queue.get(jobs[0].job_id).as_dict()["state"] == "succeeded"
+        assert list(jobs[1].follow()) == ["built publish\n"]
+        assert list(jobs[2].follow()) == ["built publish\n"]
+
+
+def test_file_lock():
+    tmpdir = mkdtemp()
+    try:
+        lock = shoebill.FileLock(os.path.join(tmpdir, "lock"))
+        # Try locking the file from another process
+        cmd = [
+            sys.executable,
+            "-c",
+            "import fcntl, sys; f = open(sys.argv[1]); "
+            "fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)",
+            lock.path,
+        ]
+        with lock:
+            with lock:
+                pass
+            assert subprocess.call(cmd, stderr=subprocess.DEVNULL) != 0
+
+        assert subprocess.call(cmd) == 0
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+class TestSharedLock(object):
+    def setUp(self):
+        self._tmpdir = mkdtemp()
+        self._lock = shoebill.SharedLock(os.path.join(self._tmpdir, "lock"))
+
+    def tearDown(self):
+        shutil.rmtree(self._tmpdir)
+
+    def _try_flock(self, mode):
+        """Try locking the file from another process
+
+        :returns: True if the lock has been acquired
+        """
+        cmd = [
+            sys.executable,
+            "-c",
+            "import fcntl, sys; f = open(sys.argv[1]); "
+            "fcntl.flock(f, getattr(fcntl, sys.argv[2]) | fcntl.LOCK_NB)",
+            self._lock.path,
+            mode,
+        ]
+        return subprocess.call(cmd, stderr=subprocess.DEVNULL) == 0
+
+    def test_shared(self):
+        entered = threading.Barrier(2, timeout=5)
+
+        def reader():
+            with self._lock.shared():
+                entered.wait()
+
+        t = threading.Thread(target=reader)
+        t.start()
+        with self._lock.shared():
+            # Both threads hold the lock
+            entered.wait()
+            assert self._try_flock("LOCK_SH")
+            assert not self._try_flock("LOCK_EX")
+        t.join()
+
+    def test_exclusive(self):
+        events = []
+        with self._lock.exclusive():
+            assert not self._try_flock("LOCK_SH")
+            t = threading.Thread(target=self._read, args=(events,))
+            t.start()
+            time.sleep(0.05)
+            events.append("writer done")
+        t.join()
+        assert events == ["writer done", "read"]
+        assert self._try_flock("LOCK_EX")
+
+    def test_waiting_writer_blocks_readers(self):
+        events = []
+        with self._lock.shared():
+            writer = threading.Thread(target=self._write, args=(events,))
+            writer.start()
+            while not self._lock._writers_waiting:
+                time.sleep(0.01)
+            reader = threading.Thread(target=self._read, args=(events,))
+            reader.start()
+            time.sleep(0.05)
+            assert events == []
+        writer.join()
+        reader.join()
+        assert events == ["write", "read"]
+
+    def _read(self, events):
+        with self._lock.shared():
+            events.append("read")
+
+    def _write(self, events):
+        with self._lock.exclusive():
+            events.append("write")
+
+
+def test_lock_manager():
+    locks = shoebill.LockManager(stripes=8)
+    assert locks.path("a.rst") is locks.path("a.rst")
+    assert len(set(locks.path("%d.rst" % n) for n in range(100))) == 8
+    tmpdir = mkdtemp()
+    try:
+        locks.configure(tmpdir)
+        with locks.writing("a.rst"):
+            with locks.path("a.rst"):
+                pass
+        assert "content.lock" in os.listdir(tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_locked_json_backend():
+    tmpdir = mkdtemp()
+    try:
+        backend = shoebill.LockedJsonBackend(tmpdir, initialize=True)
+        other = shoebill.LockedJsonBackend(tmpdir, ttl=3600)
+        roles = other.roles
+        backend.roles["editor"] = 50
+        backend.save_roles()
+        assert other.roles == {}
+        # Served from memory until the TTL expires
+        with patch("shoebill.open") as mock_open:
+            other.refresh()
+            assert not mock_open.called
+        assert other.roles == {}
+        other.refresh(force=True)
+        assert other.roles == {"editor": 50}
+        # The dict has been replaced, not updated in place
+        assert roles == {}
+        other.refresh(force=True)
+        assert other.roles == {"editor": 50}
+        assert sorted(os.listdir(tmpdir)) == [
+            "auth.lock",
+            "register.json",
+            "roles.json",
+            "users.json",
+        ]
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_sqlite_auth_backend():
+    tmpdir = mkdtemp()
+    try:
+        db_path = os.path.join(tmpdir, "auth.sqlite")
+        backend = shoebill.SQLiteAuthBackend(db_path)
+        backend.roles["editor"] = 50
+        backend.users["bob"] = {"role": "editor", "email_addr": "bob@example.com"}
+        assert "bob" in backend.users
+        assert "alice" not in backend.users
+        # Records changed in place are written back one field at a time
+        backend.users["bob"]["role"] = "admin"
+        other = shoebill.SQLiteAuthBackend(db_path)
+        assert other.users["bob"] == {"role": "admin", "email_addr": "bob@example.com"}
+        assert other.roles["editor"] == 50
+        assert list(other.users) == ["bob"]
+        assert dict(other.users.iteritems())["bob"]["role"] == "admin"
+        assert backend.users.pop("bob")["role"] == "admin"
+        assert backend.users.pop("bob", None) is None
+        assert len(other.users) == 0
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_sqlite_auth_backend_cache():
+    tmpdir = mkdtemp()
+    try:
+        db_path = os.path.join(tmpdir, "auth.sqlite")
+        backend = shoebill.SQLiteAuthBackend(db_path)
+        backend.roles["editor"] = 50
+        backend.users["bob"] = {"role": "editor"}
+        other = shoebill.SQLiteAuthBackend(db_path, ttl=3600)
+        assert other.users["bob"] == {"role": "editor"}
+        assert "alice" not in other.users
+        assert other.roles["editor"] == 50
+        # Served from memory until the TTL expires
+        with patch.object(other, "execute", side_effect=Exception("Unexpected")):
+            other.refresh()
+            assert other.users["bob"] == {"role": "editor"}
+            assert "alice" not in other.users
+            assert "editor" in other.roles
+        backend.users["alice"] = {"role": "editor"}
+        backend.users["bob"]["role"] = "admin"
+        assert "alice" not in other.users
+        other.refresh(force=True)
+        assert "alice" in other.users
+        assert other.users["bob"]["role"] == "admin"
+        # Changes made through the same backend are seen at once
+        other.users["carol"] = {"role": "editor"}
+        other.users["bob"]["role"] = "editor"
+        assert other.users["carol"] == {"role": "editor"}
+        assert backend.users["bob"]["role"] == "editor"
+        del other.users["carol"]
+        assert "carol" not in other.users
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_sqlite_auth_migration():
+    tmpdir = mkdtemp()
+    try:
+        backend = shoebill.LockedJsonBackend(tmpdir, initialize=True)
+        backend.roles["admin"] = 100
+        backend.save_roles()
+        backend.users["admin"] = {"role": "admin", "hash": b"abc"}
+        backend.save_users()
+        backend.pending_registrations["code"] = {"username": "bob"}
+        backend.save_pending_registrations()
+
+        backend = shoebill.open_auth_backend(tmpdir, "sqlite")
+        assert backend.users["admin"] == {"role": "admin", "hash": "abc"}
+        assert backend.roles["admin"] == 100
+        assert backend.pending_registrations["code"] == {"username": "bob"}
+        # Done only once
+        backend.users.pop("admin")
+        backend.users["bob"] = {"role": "admin"}
+        backend = shoebill.open_auth_backend(tmpdir, "sqlite")
+        assert list(backend.users) == ["bob"]
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_metrics_registry():
+    registry = shoebill.MetricsRegistry()
+    requests = registry.counter("requests_total", "Requests", ("path",))
+    duration = registry.histogram("duration_seconds", "Duration", buckets=(0.1, 1))
+    requests.labels('/a"b').inc()
+    requests.labels('/a"b').inc(2)
+    duration.labels().observe(0.5)
+    duration.labels().observe(5)
+    assert registry.render().splitlines() == [
+        "# HELP requests_total Requests",
+        "# TYPE requests_total counter",
+        'requests_total{path="/a\\"b"} 3',
+        "# HELP duration_seconds Duration",
+        "# TYPE duration_seconds histogram",
+        'duration_seconds_bucket{le="0.1"} 0',
+        'duration_seconds_bucket{le="1.0"} 1',
+        'duration_seconds_bucket{le="+Inf"} 2',
+        "duration_seconds_sum 5.5",
+        "duration_seconds_count 2",
+    ]
+
+
+def test_metrics_shared_by_workers():
+    tmpdir = mkdtemp()
+    try:
+        registries = [shoebill.MetricsRegistry() for _ in range(2)]
+        for pid, registry in enumerate(registries, 1):
+            registry.directory = tmpdir
+            registry.counter("saves_total", "Saves").labels().inc(pid)
+            with patch("os.getpid", return_value=pid):
+                registry.flush()
+        # Saved at most once per flush interval
+        registries[0].counter("other_total", "Other")
+        with patch("os.getpid", return_value=1):
+            registries[0].flush()
+        assert sorted(os.listdir(tmpdir)) == ["1.json", "2.json"]
+        with open(os.path.join(tmpdir, "1.json")) as f:
+            assert "other_total" not in f.read()
+
+        with patch("os.getpid", return_value=2):
+            assert "saves_total 3" in registries[1].render().splitlines()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def busy_app(environ, start_response):
+    """WSGI app spending some time in busy_wait()"""
+    busy_wait(float(environ["PATH_INFO"].strip("/") or 0))
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [b"done"]
+
+
+def busy_wait(duration):
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        pass
+
+
+class TestProfilerMiddleware(object):
+    def setUp(self):
+        self._store = shoebill.ProfileStore(keep=2)
+
+    def test_profile_fraction(self):
+        mw = shoebill.ProfilerMiddleware(busy_app, self._store, rate=1)
+        assert TestApp(mw).get("/0.05").body == b"done"
+        (info,) = self._store.list()
+        assert info["path"] == "/0.05"
+        assert info["status"] == 200
+        assert info["duration"] >= 0.05
+        assert info["formats"] == ["txt", "pstats", "collapsed"]
+        txt = self._store.render(info["id"], "txt").decode()
+        assert "busy_wait" in txt
+        stats = marshal.loads(self._store.render(info["id"], "pstats"))
+        assert any(func[2] == "busy_wait" for func in stats)
+        assert self._store.render("0-0", "txt") is None
+
+    def test_slow_requests(self):
+        mw = shoebill.ProfilerMiddleware(busy_app, self._store, slow=0.05)
+        app = TestApp(mw)
+        app.get("/")
+        assert self._store.list() == []
+        app.get("/0.1")
+        (info,) = self._store.list()
+        assert info["formats"] == ["collapsed"]
+        assert self._store.render(info["id"], "pstats") is None
+        collapsed = self._store.render(info["id"], "collapsed").decode()
+        stack, samples = collapsed.splitlines()[-1].rsplit(" ", 1)
+        assert stack.startswith("busy_app ("), stack
+        assert "busy_wait (" in stack
+        assert int(samples) > 0
+        # Not profiled
+        mw.slow = None
+        app.get("/0.1")
+        assert len(self._store.list()) == 1
+
+    def test_no_samples_after_request(self):
+        added = []
+
+        def add(info, profile, stacks):
+            total = sum(stacks.values())
+            # Let the sampler finish describing the last stack
+            time.sleep(0.2)
+            added.append((total, sum(stacks.values())))
+
+        def slow_collapse(frame):
+            # Still running when the request ends
+            time.sleep(0.1)
+            return "stack"
+
+        mw = shoebill.ProfilerMiddleware(busy_app, Mock(add=add), slow=0)
+        with patch.object(mw, "_collapse", slow_collapse):
+            TestApp(mw).get("/0.05")
+        ((before, after),) = added
+        assert before == after
+
+    def test_store_in_directory(self):
+        tmpdir = mkdtemp()
+        try:
+            store = shoebill.ProfileStore(keep=1, directory=tmpdir)
+            mw = shoebill.ProfilerMiddleware(busy_app, store, rate=1)
+            TestApp(mw).get("/")
+            TestApp(mw).get("/0.05")
+            (info,) = store.list()
+            assert info["path"] == "/0.05"
+            assert sorted(os.listdir(tmpdir)) == [
+                info["id"] + ".json",
+                info["id"] + ".pstats",
+            ]
+            assert b"busy_wait" in store.render(info["id"], "txt")
+            assert b"busy_wait" in store.render(info["id"], "collapsed")
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+def test_memory_session_store():
+    store = shoebill.MemorySessionStore(max_sessions=2)
+    store.save("a", {"username": "alice"})
+    store.save("b", {"username": "bob"})
+    assert store.get("a") == {"username": "alice"}
+    # The least recently used session is dropped
+    store.save("c", {"username": "carol"})
+    assert store.get("b") is None
+    assert store.get("a") == {"username": "alice"}
+    store.delete("a")
+    assert store.get("a") is None
+
+
+def test_sqlite_session_store():
+    tmpdir = mkdtemp()
+    try:
+        db_path = os.path.join(tmpdir, "sessions.sqlite")
+        store = shoebill.SQLiteSessionStore(db_path)
+        store.save("a", {"username": "alice"})
+        other = shoebill.SQLiteSessionStore(db_path, timeout=0)
+        assert other.get("a") == {"username": "alice"}
+        other.save("b", {"username": "bob"})
+        assert other.get("b") is None
+        store.delete("a")
+        assert other.get("a") is None
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+class TestSessionMiddleware(object):
+    def setUp(self):
+        def app(environ, start_response):
+            session = environ["beaker.session"]
+            if environ["PATH_INFO"] == "/login":
+                session["username"] = "alice"
+                session.save()
+            elif environ["PATH_INFO"] == "/logout":
+                session.delete()
+            elif environ["PATH_INFO"] == "/visit":
+                session["visited"] = True
+                session.save()
+            start_response("200 OK", [("Content-Type", "text/plain")])
+            return [session.get("username", "-").encode()]
+
+        self._store = shoebill.MemorySessionStore()
+        self._mw = shoebill.SessionMiddleware(app, self._store, timeout=100)
+        self._app = TestApp(self._mw)
+
+    def test_session(self):
+        r = self._app.get("/")
+        assert r.text == "-"
+        assert "Set-Cookie" not in r.headers
+        r = self._app.get("/login")
+        cookie = r.headers["Set-Cookie"]
+        assert cookie.startswith("shoebill_session=")
+        assert cookie.endswith("; Path=/; HttpOnly; SameSite=Lax")
+        # The cookie carries the session id only
+        session_id = self._app.cookies["shoebill_session"]
+        assert len(session_id) == 32
+        assert self._store.get(session_id)["username"] == "alice"
+        r = self._app.get("/")
+        assert r.text == "alice"
+        assert "Set-Cookie" not in r.headers
+        r = self._app.get("/logout")
+        assert "Max-Age=0" in r.headers["Set-Cookie"]
+        assert self._store.get(session_id) is None
+        assert self._app.get("/").text == "-"
+
+    def test_unknown_session_id(self):
+        self._app.set_cookie("shoebill_session", "forged")
+        assert self._app.get("/").text == "-"
+        self._app.get("/login")
+        # A new id is issued instead of the one sent by the client
+        assert self._app.cookies["shoebill_session"] != "forged"
+
+    def test_new_id_on_login(self):
+        self._app.get("/visit")
+        planted = self._app.cookies["shoebill_session"]
+        r = self._app.get("/login")
+        assert "Set-Cookie" in r.headers
+        session_id = self._app.cookies["shoebill_session"]
+        assert session_id != planted
+        assert self._store.get(planted) is None
+        assert self._store.get(session_id)["visited"]
+        # Saves by the same user keep the id
+        self._app.get("/visit")
+        assert self._app.cookies["shoebill_session"] == session_id
+
+    def test_expiry(self):
+        self._app.get("/login")
+        session_id = self._app.cookies["shoebill_session"]
+        accessed = self._store.get(session_id)["_accessed_time"]
+        with patch("time.time", return_value=accessed + 30):
+            assert self._app.get("/").text == "alice"
+        assert self._store.get(session_id)["_accessed_time"] == accessed
+        # Access times are stored at most once a minute
+        with patch("time.time", return_value=accessed + 90):
+            assert self._app.get("/").text == "alice"
+        assert self._store.get(session_id)["_accessed_time"] == accessed + 90
+        with patch("time.time", return_value=accessed + 191):
+            assert self._app.get("/").text == "-"
+        assert self._store.get(session_id) is None
+
+
+def test_cookie_session_app():
+    if shoebill.BeakerSessionMiddleware is None:
+        return
+    auth_dir = mkdtemp()
+    try:
+        crypto = Mock(has_aes=False)
+        with patch("beaker.crypto.get_crypto_module", return_value=crypto):
+            try:
+                shoebill.cookie_session_app(Mock(), auth_dir)
+                assert False, "ValueError not raised"
+            except ValueError as e:
+                assert "AES" in str(e)
+            crypto.has_aes = True
+            mw = shoebill.cookie_session_app(Mock(), auth_dir)
+        assert isinstance(mw, shoebill.BeakerSessionMiddleware)
+        token_path = os.path.join(auth_dir, "token")
+        assert os.stat(token_path).st_mode & 0o777 == 0o600
+        with open(token_path) as f:
+            assert mw.options["encrypt_key"] == f.read()
+    finally:
+        shutil.rmtree(auth_dir)
+
+
+def test_pooled_cork():
+    tmpdir = mkdtemp()
+    try:
+        backend = shoebill.LockedJsonBackend(tmpdir, initialize=True)
+        aaa = shoebill.PooledCork(backend=backend)
+        h = aaa._hash("admin", "secret")
+        # Computed in the pool
+        assert shoebill.password_hasher._pool is not None
+        assert aaa._verify_password("admin", "secret", h)
+        assert not aaa._verify_password("admin", "wrong", h)
+        assert not aaa._verify_password("other", "secret", h)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_password_hasher_queue_limit():
+    hasher = shoebill.PasswordHasher(max_queue=0)
+    try:
+        hasher.run(len, "abc")
+    except shoebill.PasswordHasherBusy:
+        pass
+    else:
+        assert False, "PasswordHasherBusy not raised"
+    assert hasher.pending == 0
+
+
+def test_login_throttle():
+    throttle = shoebill.LoginThrottle(free_attempts=2, max_delay=4)
+    with patch("time.monotonic", return_value=100):
+        throttle.failed("1.2.3.4")
+        assert throttle.retry_after("1.2.3.4") == 0
+        for delay in (1, 2, 4, 4):
+            throttle.failed("1.2.3.4")
+            assert throttle.retry_after("1.2.3.4") == delay
+        assert throttle.retry_after("5.6.7.8") == 0
+
+    with patch("time.monotonic", return_value=104):
+        assert throttle.retry_after("1.2.3.4") == 0
+    throttle.succeeded("1.2.3.4")
+    throttle.failed("1.2.3.4")
+    assert throttle.retry_after("1.2.3.4") == 0
+
+
+def test_histogram():
+    h = shoebill.Histogram(buckets=(0.1, 1))
+    assert h.quantile(0.5) is None
+    for value in (0.05, 0.1, 0.5, 2):
+        h.observe(value)
+    assert h.counts == [2, 1, 1]
+    assert h.count == 4
+    assert h.quantile(0.5) == 0.1
+    assert h.quantile(0.75) == 1
+    assert h.quantile(1) == float("inf")
+
+
+def test_thread_pool_server():
+    release = threading.Event()
+
+    def app(environ, start_response):
+        if environ["PATH_INFO"] == "/slow":
+            release.wait(5)
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [environ["PATH_INFO"].encode()]
+
+    server = shoebill.make_server(
+        "localhost",
+        0,
+        app,
+        shoebill.ThreadPoolWSGIServer,
+        shoebill.QuietRequestHandler,
+    )
+    server.threads = 2
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        slow = http.client.HTTPConnection("localhost", server.server_port)
+        slow.request("GET", "/slow")
+        # Served while the slow request is still running
+        fast = http.client.HTTPConnection("localhost", server.server_port, timeout=5)
+        fast.request("GET", "/fast")
+        assert fast.getresponse().read() == b"/fast"
+        release.set()
+        assert slow.getresponse().read() == b"/slow"
+    finally:
+        release.set()
+        server.shutdown()
+        server.server_close()
+
+
+def test_server_options():
+    init = Mock()
+    assert shoebill.server_options("threaded") == {}
+    options = shoebill.server_options("threaded", 4, 2, init)
+    assert options == dict(threads=4, workers=2, init_worker=init)
+    assert shoebill.server_options("cheroot", 4) == dict(numthreads=4)
+    options = shoebill.server_options("gunicorn", 4, 2, init)
+    assert options["threads"] == 4 and options["workers"] == 2
+    options["post_fork"](None, None)
+    assert init.called
+
+    for args in (("wsgiref", 4), ("waitress", None, 2)):
+        try:
+            shoebill.server_options(*args)
+        except ValueError:
+            pass
+        else:
+            assert False, "ValueError not raised"
+
+
+def test_lru_cache():
+    cache = shoebill.LRUCache(maxsize=2)
+    assert cache.get("a", lambda: 1) == 1
+    assert cache.get("a", lambda: 2) == 1
+    cache.get("b", lambda: 2)
+    cache.get("a", lambda: 3)
+    cache.get("c", lambda: 3)
+    assert cache.get("b", lambda: 4) == 4
+    assert cache.get("a", lambda: 5) == 5
+
+
+def test_lru_cache_maxbytes():
+    cache = shoebill.LRUCache(maxbytes=10)
+    cache.get("a", lambda: "aaaa", len)
+    cache.get("b", lambda: "bbbb", len)
+    cache.get("c", lambda: "cccc", len)
+    # "a" has been dropped to stay within 10 bytes
+    assert cache.get("a", lambda: "AAAA", len) == "AAAA"
+    assert cache.get("c", lambda: "CCCC", len) == "cccc"
+    # Too large to be cached
+    cache.get("d", lambda: "d" * 11, len)
+    assert cache.get("d", lambda: "D", len) == "D"
+    assert cache.get("c", lambda: "CCCC", len) == "cccc"
+
+
+class TestContentIndex(object):
+    def setUp(self):
+        self._root = mkdtemp()
+        os.makedirs(os.path.join(self._root, "a", "b"))
+        os.mkdir(os.path.join(self._root, ".git"))
+        for fn in ("z.rst", "y.rst", ".hidden.rst", "a/x.rst"):
+            open(os.path.join(self._root, fn), "w").close()
+
+    def tearDown(self):
+        shutil.rmtree(self._root)
+
+    def test_build(self):
+        ci = shoebill.ContentIndex(self._root, use_inotify=False)
+        assert ci.build() == 3
+        assert ci.scan_time is not None
+        dirs, files = ci.listdir("")
+        assert dirs == [("a/", "a")]
+        assert files == [("y.rst", "y.rst"), ("z.rst", "z.rst")]
+        assert ci.listdir("a") == ([("a/b/", "b")], [("a/x.rst", "x.rst")])
+
+    def test_build_symlinks(self):
+        os.symlink(".", os.path.join(self._root, "a", "loop"))
+        outside = mkdtemp()
+        try:
+            os.mkdir(os.path.join(outside, "c"))
+            os.symlink(outside, os.path.join(self._root, "out"))
+            ci = shoebill.ContentIndex(self._root, use_inotify=False)
+            assert ci.build() == 3
+        finally:
+            shutil.rmtree(outside)
+        assert ci.listdir("")[0] == [("a/", "a"), ("out/", "out")]
+        assert ci.listdir("a")[0] == [("a/b/", "b"), ("a/loop/", "loop")]
+
+    def test_build_unreadable_dir(self):
+        scandir = os.scandir
+
+        def fake_scandir(path):
+            if path == os.path.join(self._root, "a", "b"):
+                raise PermissionError(13, "Permission denied", path)
+            return scandir(path)
+
+        ci = shoebill.ContentIndex(self._root, use_inotify=False)
+        with patch("shoebill.os.scandir", side_effect=fake_scandir):
+            with patch("shoebill.log") as log:
+                assert ci.build() == 3
+        assert log.warning.call_count == 1
+        assert ci.listdir("a/b") == ([], [])
+        assert ci.listdir("a")[1] == [("a/x.rst", "x.rst")]
+
+    def test_polling(self):
+        ci = shoebill.ContentIndex(self._root, use_inotify=False)
+        ci.build()
+        # make sure the directory mtime changes
+        time.sleep(0.01)
+        open(os.path.join(self._root, "a", "w.rst"), "w").close()
+        assert ci.listdir("a")[1] == [("a/w.rst", "w.rst"), ("a/x.rst", "x.rst")]
+
+    def test_invalidate(self):
+        ci = shoebill.ContentIndex(self._root, use_inotify=False)
+        ci.build()
+        with patch("shoebill.os.scandir") as scandir:
+            ci.listdir("a")
+            assert not scandir.called
+        ci.invalidate("a")
+        assert ci.listdir("a")[1] == [("a/x.rst", "x.rst")]
+
+    def test_inotify(self):
+        ci = shoebill.ContentIndex(self._root)
+        if not ci.uses_inotify:
+            return
+        ci.build()
+        os.mkdir(os.path.join(self._root, "a", "c"))
+        for _ in range(100):
+            if ci.listdir("a")[0] == [("a/b/", "b"), ("a/c/", "c")]:
+                break
+            time.sleep(0.01)
+        assert ci.listdir("a")[0] == [("a/b/", "b"), ("a/c/", "c")]
+
+    def test_inotify_out_of_watches(self):
+        ci = shoebill.ContentIndex(self._root)
+        if not ci.uses_inotify:
+            return
+        err = OSError(28, "No space left on device")
+        with patch.object(ci._inotify, "add_watch", side_effect=err):
+            with patch("shoebill.log") as log:
+                ci.build()
+        assert log.warning.call_count == 1
+        # make sure the directory mtime changes
+        time.sleep(0.01)
+        open(os.path.join(self._root, "a", "w.rst"), "w").close()
+        assert ci.listdir("a")[1] == [("a/w.rst", "w.rst"), ("a/x.rst", "x.rst")]
+
+
+class TestSearchIndex(object):
+    def setUp(self):
+        self._root = mkdtemp()
+        os.mkdir(os.path.join(self._root, "a"))
+        self._write("a/birds.rst", "The shoebill is a very large stork-like bird")
+        self._write("storks.rst", "Storks are large birds. Storks storks storks.")
+        self._write(".hidden.rst", "hidden stork")
+        self._si = shoebill.SearchIndex(":memory:", self._root)
+        self._si.sync()
+
+    def tearDown(self):
+        shutil.rmtree(self._root)
+
+    def _write(self, relpath, text):
+        with open(os.path.join(self._root, relpath), "w") as f:
+            f.write(text)
+
+    def test_search(self):
+        results = self._si.search("storks")
+        assert [url for url, _ in results] == ["storks.rst"]
+        assert "<b>Storks</b>" in results[0][1]
+
+    def test_search_ranking(self):
+        results = self._si.search("large")
+        assert [url for url, _ in results] == ["storks.rst", "a/birds.rst"]
+
+    def test_search_escaping(self):
+        assert self._si.search('"<b> OR') == []
+
+    def test_sync_is_incremental(self):
+        assert self._si.sync() == 0
+        os.remove(os.path.join(self._root, "storks.rst"))
+        self._write("new.rst", "A new stork")
+        assert self._si.sync() == 1
+        urls = sorted(url for url, _ in self._si.search("stork"))
+        assert urls == ["a/birds.rst", "new.rst"], urls
+
+    def test_sync_symlinks(self):
+        os.symlink(".", os.path.join(self._root, "a", "loop"))
+        outside = mkdtemp()
+        try:
+            with open(os.path.join(outside, "out.rst"), "w") as f:
+                f.write("An outside stork")
+            os.symlink(outside, os.path.join(self._root, "out"))
+            os.symlink("birds.rst", os.path.join(self._root, "a", "link.rst"))
+            assert self._si.sync() == 1
+        finally:
+            shutil.rmtree(outside)
+        urls = sorted(url for url, _ in self._si.search("stork"))
+        assert urls == ["a/birds.rst", "a/link.rst"], urls
+
+    def test_sync_unreadable(self):
+        self._write("a/new.rst", "A new stork")
+        self._write("b.rst", "Another stork")
+        os.mkdir(os.path.join(self._root, "c"))
+        scandir = os.scandir
+        real_open = open
+
+        def fake_scandir(path):
+            if path == os.path.join(self._root, "c"):
+                raise PermissionError(13, "Permission denied", path)
+            return scandir(path)
+
+        def fake_open(path, *a):
+            if path.endswith("new.rst"):
+                raise PermissionError(13, "Permission denied", path)
+            return real_open(path, *a)
+
+        with patch("shoebill.os.scandir", side_effect=fake_scandir):
+            with patch("shoebill.open", side_effect=fake_open, create=True):
+                with patch("shoebill.log") as log:
+                    assert self._si.sync() == 1
+        assert log.warning.call_count == 2
+        urls = sorted(url for url, _ in self._si.search("stork"))
+        assert urls == ["a/birds.rst", "b.rst"], urls
+        # retried on next sync
+        assert self._si.sync() == 1
+
+    def test_sync_file_name_not_utf8(self):
+        self._write(os.fsdecode(b"\xe8.rst"), "A latin-1 stork")
+        self._write("b.rst", "Another stork")
+        with patch("shoebill.log") as log:
+            assert self._si.sync() == 1
+        assert log.warning.call_count == 1
+
+    def test_update(self):
+        self._write("storks.rst", "No more birds here")
+        self._si.update("storks.rst")
+        assert self._si.search("storks") == []
+        os.remove(os.path.join(self._root, "storks.rst"))
+        self._si.update("storks.rst")
+        assert self._si.search("birds") == []
+
+
+class TestGroupCommitter(object):
+    def setUp(self):
+        shoebill.git_repo = Mock()
+        shoebill.git_repo.git.diff.return_value = "content/a.rst\ncontent/b.rst"
+
+    def tearDown(self):
+        shoebill.git_repo = None
+
+    def test_commit_without_delay(self):
+        gc = shoebill.GroupCommitter()
+        gc.add("content/a.rst", "Fix a", "alice <a@example.com>")
+        shoebill.git_repo.git.commit.assert_called_once_with(
+            "--", "content/a.rst", m="Fix a", author="alice <a@example.com>"
+        )
+
+    def test_group_commit(self):
+        gc = shoebill.GroupCommitter(delay=3600)
+        gc.add("content/b.rst", "Fix b", "alice <a@example.com>")
+        gc.add("content/a.rst", "Fix a", "bob <b@example.com>")
+        gc.add("content/c.rst", "Revert c", None)
+        gc.add("content/b.rst", "Fix b again", "alice <a@example.com>")
+        assert not shoebill.git_repo.git.commit.called
+
+        gc.flush()
+        shoebill.git_repo.git.commit.assert_called_once_with(
+            "--",
+            "content/a.rst",
+            "content/b.rst",
+            m="Update 3 files\n\n- Fix b (alice)\n- Fix a (bob)\n- Revert c\n"
+            "- Fix b again (alice)\n\nCo-authored-by: bob <b@example.com>",
+            author="alice <a@example.com>",
+        )
+        gc.flush()
+        assert shoebill.git_repo.git.commit.call_count == 1
+
+    def test_nothing_left_to_commit(self):
+        shoebill.git_repo.is_dirty.return_value = False
+        gc = shoebill.GroupCommitter(delay=3600)
+        gc.add("content/a.rst", "Fix a")
+        gc.add("content/a.rst", "Unfix a")
+        gc.flush()
+        assert not shoebill.git_repo.git.commit.called
+
+    def test_commit_when_window_expires(self):
+        gc = shoebill.GroupCommitter(delay=0.01)
+        gc.add("content/a.rst", "Fix a")
+        for _ in range(100):
+            if shoebill.git_repo.git.commit.called:
+                break
+            time.sleep(0.01)
+        shoebill.git_repo.git.commit.assert_called_once_with(
+            "--", "content/a.rst", m="Fix a"
+        )
+
+    def test_parse_duration(self):
+        assert shoebill.parse_duration("30") == 30
+        assert shoebill.parse_duration("30s") == 30
+        assert shoebill.parse_duration("2m") == 120
+        assert shoebill.parse_duration("500ms") == 0.5
+
+    def test_parse_fraction(self):
+        assert shoebill.parse_fraction("0.01") == 0.01
+        for value in ("2", "-0.5", "x"):
+            try:
+                shoebill.parse_fraction(value)
+            except argparse.ArgumentTypeError:
+                pass
+            else:
+                assert False, "ArgumentTypeError not raised for %r" % value
+
+
+class TestLargeFiles(object):
+    def setUp(self):
+        self._root = mkdtemp()
+        self._fn = os.path.join(self._root, "big.txt")
+        with open(self._fn, "wb") as f:
+            f.write(b"".join(b"line %03d\n" % n for n in range(100)))
+
+    def tearDown(self):
+        shutil.rmtree(self._root)
+
+    def _read(self):
+        with open(self._fn, "rb") as f:
+            return f.read()
+
+    def test_read_file_page(self):
+        page = shoebill.read_file_page(self._fn, 0, 25)
+        assert page.data == b"line 000\nline 001\nline 002\n"
+        assert (page.start, page.end, page.size, page.prev) == (0, 27, 900, None)
+
+        page = shoebill.read_file_page(self._fn, page.end, 25)
+        assert page.data == b"line 003\nline 004\nline 005\n"
+        assert page.prev == 0
+
+    def test_read_file_page_aligns_offset(self):
+        page = shoebill.read_file_page(self._fn, 895, 25)
+        assert page.data == b"line 099\n"
+        assert page.prev == 864
+
+    def test_read_file_page_long_lines(self):
+        with open(self._fn, "wb") as f:
+            f.write("\u00e8".encode() * 100)
+        page = shoebill.read_file_page(self._fn, 0, 25)
+        assert page.data == "\u00e8".encode() * 12
+        page = shoebill.read_file_page(self._fn, 25, 25)
+        assert page.start == 24
+
+    def test_read_empty_file(self):
+        open(self._fn, "w").close()
+        assert shoebill.read_file_page(self._fn, 10, 25).data == b""
+
+    def test_patch_file_same_size(self):
+        inode = os.stat(self._fn).st_ino
+        shoebill.patch_file(self._fn, 9, 9, b"LINE 001\n")
+        assert self._read().startswith(b"line 000\nLINE 001\nline 002\n")
+        assert len(self._read()) == 900
+        # Not written in place: readers never see a partial change
+        assert os.stat(self._fn).st_ino != inode
+
+    def test_patch_file_resize(self):
+        os.chmod(self._fn, 0o640)
+        shoebill.patch_file(self._fn, 9, 18, b"new\n")
+        assert self._read().startswith(b"line 000\nnew\nline 003\n")
+        assert self._read().endswith(b"line 099\n")
+        assert len(self._read()) == 900 - 18 + 4
+        assert os.stat(self._fn).st_mode & 0o777 == 0o640
+        assert os.listdir(self._root) == ["big.txt"]
+
+    def test_patch_file_without_copy_file_range(self):
+        with patch("shoebill.os.copy_file_range", side_effect=OSError):
+            shoebill.patch_file(self._fn, 891, 9, b"end")
+        assert self._read().endswith(b"line 098\nend")
+
+
+class TestWriteFile(object):
+    def setUp(self):
+        self._root = mkdtemp()
+        self._fn = os.path.join(self._root, "file.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self._root)
+
+    def _read(self):
+        with open(self._fn, "rb") as f:
+            return f.read()
+
+    def test_create(self):
+        assert shoebill.write_file(self._fn, [b"foo", b"bar"])
+        assert self._read() == b"foobar"
+        assert os.stat(self._fn).st_mode & 0o777 == shoebill.NEW_FILE_MODE
+
+    def test_replace_keeps_mode(self):
+        shoebill.write_file(self._fn, [b"foo"])
+        os.chmod(self._fn, 0o600)
+        ino = os.stat(self._fn).st_ino
+        assert shoebill.write_file(self._fn, [b"bar"])
+        assert self._read() == b"bar"
+        assert os.stat(self._fn).st_mode & 0o777 == 0o600
+        assert os.stat(self._fn).st_ino != ino
+
+    def test_skip_unchanged(self):
+        shoebill.write_file(self._fn, [b"foobar"])
+        ino = os.stat(self._fn).st_ino
+        assert not shoebill.write_file(self._fn, [b"foo", b"bar"])
+        assert os.stat(self._fn).st_ino == ino
+        assert os.listdir(self._root) == ["file.txt"]
+
+    def test_failed_write(self):
+        shoebill.write_file(self._fn, [b"foo"])
+
+        def chunks():
+            yield b"partial"
+            raise IOError("Connection lost")
+
+        try:
+            shoebill.write_file(self._fn, chunks())
+        except IOError:
+            pass
+        else:
+            assert False, "IOError not raised"
+
+        assert self._read() == b"foo"
+        assert os.listdir(self._root) == ["file.txt"]
+
+    def test_fsync_policy(self):
+        for policy, calls in (("none", 0), ("file", 1), ("full", 2)):
+            with patch("shoebill.fsync_policy", policy):
+                with patch("shoebill.os.fsync") as fsync:
+                    shoebill.write_file(self._fn, [policy.encode()])
+            assert fsync.call_count == calls, policy
+
+
+def test_negotiate_encoding():
+    for header, expected in (
+        ("", None),
+        ("gzip", "gzip"),
+        ("deflate, gzip;q=0.8", "gzip"),
+        ("gzip;q=0", None),
+        ("*", "gzip"),
+        ("*;q=0.5, gzip;q=0", None),
+        ("br", None),
+        ("GZIP; q=bogus", None),
+    ):
+        assert shoebill.negotiate_encoding(header) == expected, header
+
+    with patch("shoebill.brotli", Mock()):
+        assert shoebill.negotiate_encoding("gzip, br") == "br"
+        assert shoebill.negotiate_encoding("gzip, br;q=0.5") == "gzip"
+        assert shoebill.negotiate_encoding("*") == "br"
+
+
+def test_gzip_compressor_flushes_chunks():
+    c = shoebill.GzipCompressor()
+    first = c.compress(b"first chunk\n")
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    assert d.decompress(first) == b"first chunk\n"
+    data = first + c.compress(b"second\n") + c.finish()
+    assert gzip.decompress(data) == b"first chunk\nsecond\n"
@@ -2,12 +2,24 @@
 # Shoebill functional testing
 #
 
+from io import BytesIO
 from mock import patch, Mock
 from tempfile import mkdtemp
+from webob import Request
 from webtest import TestApp
+import http.client
+import io
 import os
+import signal
+import socket
 import subprocess
 import shutil
+import gzip
+import sys
+import tarfile
+import threading
+import time
+import zipfile
 
 import shoebill
 
@@ -15,6 +27,21 @@ import shoebill
 shoebill.app.catchall = False
 
 
+def make_tar(files, mode="w"):
+    """Create a tar archive from a {name: bytes or None for dirs} dict"""
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode=mode) as tf:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            if data is None:
+                info.type = tarfile.DIRTYPE
+                tf.addfile(info)
+            else:
+                info.size = len(data)
+                tf.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
 class PelicanDirSetup(object):
     def __init__(self):
         self._patchers = []
@@ -31,9 +58,13 @@ class PelicanDirSetup(object):
         assert os.path.isdir(os.path.join(self._site_path, "content"))
         assert os.path.isdir(os.path.join(self._site_path, "content/pages"))
         shoebill.content_path = os.path.join(self._site_path, "content")
+        shoebill.content_index = shoebill.ContentIndex(
+            shoebill.content_path, use_inotify=False
+        )
 
     def dir_teardown(self):
         shoebill.content_path = None
+        shoebill.content_index = None
         assert self._site_path.startswith("/tmp/tmp")
         shutil.rmtree(self._site_path)
         print("Removed %s" % self._site_path)
@@ -50,8 +81,15 @@ class PelicanDirSetup(object):
 
     def webapp_setup(self):
         shoebill.make_targets = []
+        shoebill.build_queue = shoebill.BuildQueue()
+        shoebill.history_cache = shoebill.LRUCache()
         env = {"REMOTE_ADDR": "127.0.0.1"}
-        self._app = TestApp(shoebill.app, extra_environ=env)
+        self._wsgi_app = shoebill.CompressionMiddleware(shoebill.app)
+        self._app = TestApp(self._wsgi_app, extra_environ=env)
+
+    def get_encoded(self, url, **headers):
+        """GET without decoding the response, unlike webtest"""
+        return Request.blank(url, headers=headers).get_response(self._wsgi_app)
 
     def webapp_teardown(self):
         pass
@@ -108,6 +146,171 @@ class TestWebapp(PelicanDirSetup):
         assert r.status == "200 OK", r.status
         assert "Error: the directory you specified does not exists." in r
 
+    def test_edit_lists_new_files(self):
+        r = self._app.get("/edit/")
+        assert "/edit/pages/" in r
+        assert "/edit/hi.rst" not in r
+        self._app.post("/edit/hi.rst", {"file_contents": "test_contents"})
+        open(os.path.join(self._site_path, "content", ".hidden.rst"), "w").close()
+        r = self._app.get("/edit/")
+        assert "/edit/hi.rst" in r
+        assert ".hidden.rst" not in r
+
+    def test_edit_without_index(self):
+        shoebill.content_index = None
+        r = self._app.get("/edit/pages/")
+        assert r.status == "200 OK"
+
+    def test_edit_not_modified(self):
+        fn = os.path.join(shoebill.content_path, "hi.rst")
+        with open(fn, "w") as f:
+            f.write("hello")
+        r = self._app.get("/edit/hi.rst")
+        etag = r.headers["ETag"]
+        assert "hello" in r
+
+        r = self._app.get("/edit/hi.rst", headers={"If-None-Match": etag}, status=304)
+        assert r.body == b""
+        assert r.headers["ETag"] == etag
+        r = self._app.get("/edit/hi.rst", headers={"If-None-Match": '"x", W/%s' % etag})
+        assert r.status == "304 Not Modified"
+
+        # a change in the directory listing changes the page
+        open(os.path.join(shoebill.content_path, "new.rst"), "w").close()
+        r = self._app.get("/edit/hi.rst", headers={"If-None-Match": etag})
+        assert r.status == "200 OK"
+        assert r.headers["ETag"] != etag
+
+        # and so does a change in the file
+        etag = r.headers["ETag"]
+        with open(fn, "w") as f:
+            f.write("hello world")
+        r = self._app.get("/edit/hi.rst", headers={"If-None-Match": etag})
+        assert r.status == "200 OK"
+        assert "hello world" in r
+
+    def test_edit_if_modified_since(self):
+        past = time.time() - 10
+        os.utime(os.path.join(shoebill.content_path, "pages"), (past, past))
+        r = self._app.get("/edit/pages/")
+        last_modified = r.headers["Last-Modified"]
+        r = self._app.get(
+            "/edit/pages/", headers={"If-Modified-Since": last_modified}, status=304
+        )
+        r = self._app.get(
+            "/edit/pages/",
+            headers={"If-Modified-Since": "Thu, 01 Jan 1970 00:00:00 GMT"},
+        )
+        assert r.status == "200 OK"
+
+    def test_edit_if_modified_since_same_second(self):
+        fn = os.path.join(shoebill.content_path, "pages", "hi.rst")
+        now = int(time.time())
+        with open(fn, "w") as f:
+            f.write("hello")
+        past = now - 10
+        os.utime(os.path.join(shoebill.content_path, "pages"), (past, past))
+        os.utime(fn, (now, now))
+        with patch("time.time", return_value=now + 0.5):
+            r = self._app.get("/edit/pages/hi.rst")
+            # Changes within the same second would keep the same date
+            assert "Last-Modified" not in r.headers
+            with open(fn, "w") as f:
+                f.write("hello world")
+            os.utime(fn, (now, now))
+            ims = {"If-Modified-Since": shoebill.bottle.http_date(now)}
+            r = self._app.get("/edit/pages/hi.rst", headers=ims)
+            assert r.status == "200 OK"
+            assert "hello world" in r
+        with patch("time.time", return_value=now + 1):
+            r = self._app.get("/edit/pages/hi.rst")
+            assert r.headers["Last-Modified"] == shoebill.bottle.http_date(now)
+            self._app.get("/edit/pages/hi.rst", headers=ims, status=304)
+
+    def _write_large_file(self):
+        fn = os.path.join(shoebill.content_path, "big.txt")
+        with open(fn, "wb") as f:
+            f.write(b"".join(b"line %05d\n" % n for n in range(10000)))
+        return fn
+
+    def test_edit_large_file(self):
+        self._write_large_file()
+        with patch("shoebill.large_file_threshold", 1000):
+            r = self._app.get("/edit/big.txt")
+            assert "Large file: showing bytes 0-65538 of 110000." in r
+            assert "line 05957" in r
+            assert "line 05958" not in r
+            assert "?offset=65538" in r
+            r = self._app.get("/edit/big.txt", {"offset": 65538})
+            assert "line 05957" not in r
+            assert "line 05958" in r
+            assert "previous page" in r
+
+    def test_save_large_file_page(self):
+        fn = self._write_large_file()
+        with patch("shoebill.large_file_threshold", 1000):
+            form = self._app.get("/edit/big.txt", {"offset": 65538}).forms["saveform"]
+            assert form["page_offset"].value == "65538"
+            form["file_contents"] = "edited\r\nlines\r\n"
+            r = form.submit()
+            assert "Saved." in r
+            assert "edited\nlines" in r
+        with open(fn, "rb") as f:
+            data = f.read()
+        assert data.endswith(b"line 05957\nedited\nlines\n")
+
+    def test_save_large_file_page_unchanged(self):
+        fn = self._write_large_file()
+        mtime = os.stat(fn).st_mtime_ns
+        shoebill.build_queue._changed["publish"] = set()
+        with patch("shoebill.large_file_threshold", 1000):
+            form = self._app.get("/edit/big.txt", {"offset": 65538}).forms["saveform"]
+            r = form.submit()
+            assert "No changes to be saved!" in r
+        assert os.stat(fn).st_mtime_ns == mtime
+        assert shoebill.build_queue._changed["publish"] == set()
+
+    def test_save_large_file_page_conflict(self):
+        fn = self._write_large_file()
+        with patch("shoebill.large_file_threshold", 1000):
+            form = self._app.get("/edit/big.txt").forms["saveform"]
+            with open(fn, "ab") as f:
+                f.write(b"more\n")
+            r = form.submit()
+            assert "The file has been changed, please reload it" in r
+
+    def test_large_file_page_not_utf8(self):
+        fn = os.path.join(shoebill.content_path, "latin1.txt")
+        data = "caf\xe9 cr\xe8me\n".encode("latin-1") * 30
+        with open(fn, "wb") as f:
+            f.write(data)
+        with patch("shoebill.large_file_threshold", 100):
+            r = self._app.get("/edit/latin1.txt")
+            assert "This page is not UTF-8 text and cannot be edited." in r
+            assert "saveform" not in r.forms
+            # Submitting the page unchanged, as it was displayed
+            form = {
+                "file_contents": data.decode("utf-8", errors="replace"),
+                "page_offset": "0",
+                "page_length": str(len(data)),
+                "page_base": shoebill.file_version(os.stat(fn)),
+            }
+            r = self._app.post("/edit/latin1.txt", form)
+            assert "This page is not UTF-8 text and cannot be edited" in r
+        with open(fn, "rb") as f:
+            assert f.read() == data
+
+    def test_raw_range(self):
+        self._write_large_file()
+        r = self._app.get("/raw/big.txt", headers={"Range": "bytes=11-20"})
+        assert r.status == "206 Partial Content"
+        assert r.body == b"line 00001"
+        assert r.headers["Content-Range"] == "bytes 11-20/110000"
+        r = self._app.get("/raw/big.txt")
+        assert len(r.body) == 110000
+        self._app.get("/raw/big.txt", headers={"Range": "bytes=200000-"}, status=416)
+        self._app.get("/raw/.hidden", status=404)
+
     def test_edit_dir_without_slash(self):
         r = self._app.get("/edit/pages")
         assert r.status == "302 Found", r
@@ -120,6 +323,64 @@ class TestWebapp(PelicanDirSetup):
         assert r.status == "200 OK"
         assert "Saved." in r, [l.strip() for l in r.body.split("\n") if '"errmsg' in l]
 
+    def test_write_records_change(self):
+        shoebill.build_queue._changed["publish"] = set()
+        self._app.post("/edit/pages/hi.rst", {"file_contents": "test_contents"})
+        assert shoebill.build_queue._changed["publish"] == {"content/pages/hi.rst"}
+
+    def test_write_unchanged_file(self):
+        self._app.post("/edit/pages/hi.rst", {"file_contents": "test_contents"})
+        shoebill.build_queue._changed["publish"] = set()
+        fn = os.path.join(shoebill.content_path, "pages/hi.rst")
+        mtime = os.stat(fn).st_mtime_ns
+        r = self._app.post("/edit/pages/hi.rst", {"file_contents": "test_contents"})
+        assert "No changes to be saved!" in r
+        assert os.stat(fn).st_mtime_ns == mtime
+        assert shoebill.build_queue._changed["publish"] == set()
+
+    def test_write_through_symlink(self):
+        shared = os.path.join(self._site_path, "shared")
+        os.mkdir(shared)
+        with open(os.path.join(shared, "about.rst"), "w") as f:
+            f.write("old")
+        link = os.path.join(shoebill.content_path, "pages/about.rst")
+        os.symlink("../../shared/about.rst", link)
+        r = self._app.post("/edit/pages/about.rst", {"file_contents": "new"})
+        assert "Saved." in r
+        assert os.path.islink(link)
+        with open(os.path.join(shared, "about.rst")) as f:
+            assert f.read() == "new"
+        assert os.listdir(shared) == ["about.rst"]
+
+    def test_write_large_file_multipart(self):
+        contents = "line\r\n" * 100000
+        r = self._app.post(
+            "/edit/pages/hi.rst",
+            {"file_contents": contents},
+            content_type="multipart/form-data",
+        )
+        assert "Saved." in r
+        with open(os.path.join(shoebill.content_path, "pages/hi.rst"), "rb") as f:
+            assert f.read() == contents.encode()
+        assert os.listdir(os.path.join(shoebill.content_path, "pages")) == ["hi.rst"]
+
+    def test_search(self):
+        shoebill.search_index = shoebill.SearchIndex(":memory:", shoebill.content_path)
+        try:
+            self._app.post("/edit/pages/hi.rst", {"file_contents": "hello <world>"})
+            r = self._app.get("/search", {"q": "world"})
+            assert '<a href="/edit/pages/hi.rst">' in r
+            assert "hello &lt;<b>world</b>&gt;" in r
+        finally:
+            shoebill.search_index = None
+
+    def test_history_without_git(self):
+        assert "Git is not enabled" in self._app.get("/history/hi.rst")
+
+    def test_search_disabled(self):
+        r = self._app.get("/search", {"q": "world"})
+        assert "Search is not available." in r
+
     def test_write_missing_dir(self):
         r = self._app.post("/edit/nothere/hi.rst", {"file_contents": "test_contents"})
         assert r.status == "200 OK", r.status
@@ -135,6 +396,312 @@ class TestWebapp(PelicanDirSetup):
         assert r.status == "200 OK"
         assert "Saved." in r, r.content.split("\n")
 
+    def test_login_backoff(self):
+        aaa = Mock()
+        aaa.login.return_value = False
+        with patch("shoebill.aaa", aaa), patch(
+            "shoebill.login_throttle", shoebill.LoginThrottle(free_attempts=2)
+        ), patch("shoebill.login_latency", shoebill.Histogram()):
+            creds = {"username": "admin", "password": "wrong"}
+            for _ in range(2):
+                r = self._app.post("/login", creds, status=302)
+                assert r.headers["Location"].endswith("/login")
+            r = self._app.post("/login", creds, status=429)
+            assert r.headers["Retry-After"] == "1"
+            assert "Too many failed logins" in r
+            assert aaa.login.call_count == 2
+            # Other clients are not affected
+            aaa.login.return_value = True
+            env = {"REMOTE_ADDR": "127.0.0.2"}
+            r = self._app.post("/login", creds, extra_environ=env, status=302)
+            assert r.headers["Location"].endswith("/edit")
+            assert shoebill.login_latency.count == 3
+
+    def test_login_busy(self):
+        aaa = Mock()
+        aaa.login.side_effect = shoebill.PasswordHasherBusy()
+        with patch("shoebill.aaa", aaa):
+            creds = {"username": "admin", "password": "secret"}
+            r = self._app.post("/login", creds, status=503)
+            assert r.headers["Retry-After"] == "1"
+
+    def test_login_session(self):
+        auth_dir = os.path.join(self._site_path, "auth")
+        os.mkdir(auth_dir)
+        backend = shoebill.LockedJsonBackend(auth_dir, initialize=True)
+        aaa = shoebill.PooledCork(backend=backend)
+        backend.roles["admin"] = 100
+        backend.users["admin"] = {
+            "role": "admin",
+            "hash": aaa._hash("admin", "secret"),
+            "email_addr": "",
+            "desc": "admin",
+        }
+        store = shoebill.SQLiteSessionStore(os.path.join(auth_dir, "sessions.sqlite"))
+        app = TestApp(shoebill.SessionMiddleware(self._wsgi_app, store))
+        # A session id planted in the browser before the login
+        store.save("planted", {"_accessed_time": time.time()})
+        app.set_cookie("shoebill_session", "planted")
+        with patch("shoebill.aaa", aaa):
+            r = app.get("/edit/", status=302)
+            assert r.headers["Location"].endswith("/login")
+            creds = {"username": "admin", "password": "secret"}
+            r = app.post("/login", creds, status=302)
+            assert r.headers["Location"].endswith("/edit")
+            assert "Set-Cookie" in r.headers
+            assert app.cookies["shoebill_session"] != "planted"
+            assert store.get("planted") is None
+            r = app.get("/edit/")
+            assert "Set-Cookie" not in r.headers
+            app.get("/logout", status=302)
+            app.get("/edit/", status=302)
+
+    def test_profiles(self):
+        self._app.get("/admin/profiles", status=404)
+        store = shoebill.ProfileStore()
+        app = TestApp(shoebill.ProfilerMiddleware(self._wsgi_app, store, rate=1))
+        with patch("shoebill.profile_store", store):
+            app.get("/edit/")
+            r = app.get("/admin/profiles")
+            profile = r.json["profiles"][-1]
+            assert profile["path"] == "/edit/"
+            r = app.get("/admin/profiles/%s.txt" % profile["id"])
+            assert r.content_type == "text/plain"
+            assert "route_edit" in r
+            r = app.get("/admin/profiles/%s.pstats" % profile["id"])
+            assert r.content_type == "application/octet-stream"
+            app.get("/admin/profiles/%s.collapsed" % profile["id"])
+            app.get("/admin/profiles/%s.svg" % profile["id"], status=404)
+            app.get("/admin/profiles/1-12345.txt", status=404)
+
+            aaa = Mock()
+            aaa.require.side_effect = shoebill.AuthException()
+            with patch("shoebill.aaa", aaa):
+                app.get("/admin/profiles", status=401)
+            aaa.require.assert_called_once_with(role="admin")
+
+    def test_auth_data_refresh(self):
+        store = Mock(spec=shoebill.LockedJsonBackend)
+        with patch("shoebill.aaa", Mock(_store=store)):
+            self._app.get("/favicon.ico")
+            self._app.post("/make/unknown")
+        assert store.refresh.call_args_list == [
+            ((), {"force": False}),
+            ((), {"force": True}),
+        ]
+
+    # Static assets and compression
+
+    def test_static_assets(self):
+        r = self._app.get("/edit/")
+        assert "<style>" not in r
+        for name in shoebill.STATIC_ASSETS:
+            url = shoebill.asset_url(name)
+            assert url.startswith("/static/%s." % name.split(".")[0]), url
+            r = self._app.get(url)
+            assert r.headers["Cache-Control"] == "public, max-age=31536000, immutable"
+            with open(os.path.join(shoebill.static_path, name), "rb") as f:
+                assert r.body == f.read()
+
+        self._app.get("/static/edit.000000000000.css", status=404)
+        self._app.get("/static/edit.css", status=404)
+
+    def test_edit_page_gzip(self):
+        plain = self._app.get("/edit/")
+        assert "Content-Encoding" not in plain.headers
+        assert plain.headers["Vary"] == "Accept-Encoding"
+
+        r = self.get_encoded("/edit/", **{"Accept-Encoding": "br;q=1, gzip;q=0.5"})
+        assert r.headers["Content-Encoding"] == "gzip"
+        assert r.headers["ETag"] == "W/" + plain.headers["ETag"]
+        assert gzip.decompress(r.body) == plain.body
+        assert len(r.body) < len(plain.body)
+
+        r = self.get_encoded(
+            "/edit/", **{"Accept-Encoding": "gzip", "If-None-Match": r.headers["ETag"]}
+        )
+        assert r.status == "304 Not Modified"
+        assert "Content-Encoding" not in r.headers
+
+    def test_no_compression(self):
+        for encoding in ("identity", "gzip;q=0", "*;q=0"):
+            r = self.get_encoded("/edit/", **{"Accept-Encoding": encoding})
+            assert "Content-Encoding" not in r.headers, encoding
+
+        # Small responses and binary files are not compressed
+        self._app.put("/api/files/a.rst", b"a" * 10000, status=201)
+        r = self.get_encoded("/api/files/a.rst", **{"Accept-Encoding": "gzip"})
+        assert "Content-Encoding" not in r.headers
+        r = self.get_encoded("/api/tree/", **{"Accept-Encoding": "gzip"})
+        assert "Content-Encoding" not in r.headers
+
+    def test_brotli(self):
+        class FakeCompressor(object):
+            def __init__(self, quality):
+                pass
+
+            def process(self, data):
+                return b"<" + data
+
+            def flush(self):
+                return b">"
+
+            def finish(self):
+                return b"."
+
+        fake_brotli = Mock(Compressor=FakeCompressor)
+        with patch("shoebill.brotli", fake_brotli):
+            r = self.get_encoded("/edit/", **{"Accept-Encoding": "gzip, br"})
+            assert r.headers["Content-Encoding"] == "br"
+            assert r.body.startswith(b"<<!DOCTYPE HTML>")
+            assert r.body.endswith(b">.")
+
+    # JSON API
+
+    def test_api_put_get_delete(self):
+        r = self._app.put("/api/files/pages/a.rst", b"hello\n", status=201)
+        assert r.json == {"path": "pages/a.rst", "changed": True}
+        r = self._app.put("/api/files/pages/a.rst", b"hello\n")
+        assert r.json == {"path": "pages/a.rst", "changed": False}
+
+        r = self._app.get("/api/files/pages/a.rst")
+        assert r.body == b"hello\n"
+        assert r.content_type == "application/octet-stream"
+        self._app.get(
+            "/api/files/pages/a.rst",
+            headers={"If-None-Match": r.headers["ETag"]},
+            status=304,
+        )
+
+        self._app.delete("/api/files/pages/a.rst", status=204)
+        assert not os.path.exists(os.path.join(shoebill.content_path, "pages/a.rst"))
+        r = self._app.get("/api/files/pages/a.rst", status=404)
+        assert r.json == {"error": "File not found"}
+        self._app.delete("/api/files/pages/a.rst", status=404)
+
+    def test_api_put_incomplete_body(self):
+        req = Request.blank("/api/files/a.rst", method="PUT")
+        req.environ["REMOTE_ADDR"] = "127.0.0.1"
+        req.environ["CONTENT_LENGTH"] = "10"
+        req.environ["wsgi.input"] = BytesIO(b"hello")
+        r = req.get_response(self._wsgi_app)
+        assert r.status_code == 400
+        assert r.json == {"error": "Incomplete request body"}
+        assert not os.path.exists(os.path.join(shoebill.content_path, "a.rst"))
+
+    def test_api_invalid_paths(self):
+        for url in (
+            "/api/files/.hidden",
+            "/api/files/pages/../../x",
+            "/api/files/pages/",
+            "/api/files/pages",
+            "/api/files/nothere/a.rst",
+        ):
+            r = self._app.put(url, b"x", status=404)
+            assert r.json == {"error": "Invalid path"}, url
+            self._app.get(url, status=404)
+        assert os.listdir(shoebill.content_path) == ["pages"]
+
+    def test_api_tree(self):
+        self._app.put("/api/files/pages/a.rst", b"a", status=201)
+        self._app.put("/api/files/b.rst", b"b", status=201)
+        r = self._app.get("/api/tree/")
+        assert r.json == {
+            "path": "/",
+            "dirs": [{"name": "pages", "path": "pages/"}],
+            "files": [{"name": "b.rst", "path": "b.rst"}],
+        }
+        r = self._app.get("/api/tree/pages")
+        assert r.json["files"] == [{"name": "a.rst", "path": "pages/a.rst"}]
+        self._app.get("/api/tree/.git", status=404)
+        self._app.get("/api/tree/nothere/", status=404)
+
+    def test_api_records_change(self):
+        shoebill.build_queue._changed["publish"] = set()
+        self._app.put("/api/files/b.rst", b"b", status=201)
+        self._app.delete("/api/files/b.rst", status=204)
+        assert shoebill.build_queue._changed["publish"] == {"content/b.rst"}
+
+    def test_bulk_import_tar(self):
+        with open(os.path.join(shoebill.content_path, "b.rst"), "w") as f:
+            f.write("b")
+        body = make_tar(
+            {
+                "./": None,
+                "./a.rst": b"a",
+                "./b.rst": b"b",
+                "./new/deep/c.rst": b"c",
+                "./.hidden": b"x",
+                "../escape.rst": b"x",
+                "pages": b"not a dir",
+            }
+        )
+        r = self._app.post("/bulk", body, content_type="application/x-tar")
+        assert r.json == {
+            "committed": False,
+            "files": [
+                {"path": "a.rst", "status": "created"},
+                {"path": "b.rst", "status": "unchanged"},
+                {"path": "new/deep/c.rst", "status": "created"},
+                {"path": ".hidden", "status": "rejected", "error": "Invalid path"},
+                {
+                    "path": "../escape.rst",
+                    "status": "rejected",
+                    "error": "Invalid path",
+                },
+                {"path": "pages", "status": "rejected", "error": "Invalid path"},
+            ],
+        }
+        with open(os.path.join(shoebill.content_path, "new/deep/c.rst")) as f:
+            assert f.read() == "c"
+        assert not os.path.exists(os.path.join(self._site_path, "escape.rst"))
+        r = self._app.get("/api/tree/")
+        assert {"name": "new", "path": "new/"} in r.json["dirs"]
+
+    def test_bulk_import_tar_gz(self):
+        body = make_tar({"a.rst": b"a" * 100000}, mode="w:gz")
+        r = self._app.post("/bulk", body, content_type="application/gzip")
+        assert r.json["files"] == [{"path": "a.rst", "status": "created"}]
+        assert os.path.getsize(os.path.join(shoebill.content_path, "a.rst")) == 100000
+
+    def test_bulk_import_zip(self):
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w") as zf:
+            zf.writestr("pages/a.rst", "a")
+            zf.writestr("new/", "")
+            info = zipfile.ZipInfo("link")
+            info.external_attr = 0o120777 << 16
+            zf.writestr(info, "/etc/passwd")
+        r = self._app.post("/bulk", buf.getvalue(), content_type="application/zip")
+        assert r.json["files"] == [
+            {"path": "pages/a.rst", "status": "created"},
+            {"path": "new", "status": "created"},
+            {"path": "link", "status": "rejected", "error": "Unsupported file type"},
+        ]
+        assert os.path.isdir(os.path.join(shoebill.content_path, "new"))
+
+    def test_bulk_import_dirs(self):
+        shoebill.content_index.build()
+        shoebill.build_queue._changed["publish"] = set()
+        body = make_tar({"pages": None, "new": None})
+        r = self._app.post("/bulk", body, content_type="application/x-tar")
+        assert r.json["files"] == [
+            {"path": "pages", "status": "unchanged"},
+            {"path": "new", "status": "created"},
+        ]
+        assert shoebill.build_queue._changed["publish"] == {"content/new"}
+        r = self._app.get("/api/tree/")
+        assert {"name": "new", "path": "new/"} in r.json["dirs"]
+
+    def test_bulk_import_truncated(self):
+        body = make_tar({"a.rst": b"a", "b.rst": b"b" * 10000})
+        r = self._app.post(
+            "/bulk", body[:2048], content_type="application/x-tar", status=400
+        )
+        assert r.json["error"].startswith("Invalid archive")
+        assert r.json["files"] == [{"path": "a.rst", "status": "created"}]
+        assert not os.path.exists(os.path.join(shoebill.content_path, "b.rst"))
+
     def test_get_make(self):
         r = self._app.get("/make/foo")
         assert r.status == "302 Found"
@@ -142,11 +709,19 @@ class TestWebapp(PelicanDirSetup):
     @patch("subprocess.Popen")
     def test_make_publish(self, popen):
         cmd = popen.return_value
-        cmd.communicate.return_value = ["test_output\n"]
+        cmd.stdout = BytesIO(b"test_output\nERROR: <broken>\n")
+        cmd.wait.return_value = 0
 
         r = self._app.post("/make/publish")
+        assert r.status == "303 See Other", r.status
+        job_id = int(r.headers["X-Build-Id"])
+        assert r.location.endswith("/builds/%d" % job_id), r.location
+
+        r = r.follow()
         assert r.status == "200 OK"
-        assert "test_output" in r
+        assert "<span> test_output</span>" in r
+        assert '<span class="errorline"> ERROR: &lt;broken&gt;</span>' in r
+        assert "failed with exit status" not in r
         popen.assert_called_once_with(
             ["make", "publish"],
             cwd=self._site_path,
@@ -154,6 +729,76 @@ class TestWebapp(PelicanDirSetup):
             stderr=subprocess.STDOUT,
         )
 
+        r = self._app.get("/builds/%d/status" % job_id)
+        assert r.json["state"] == "succeeded", r.json
+        assert r.json["output_lines"] == 2
+
+    @patch("subprocess.Popen")
+    def test_make_output_compressed(self, popen):
+        cmd = popen.return_value
+        cmd.stdout = BytesIO(b"".join(b"line %d\n" % n for n in range(100)))
+        cmd.wait.return_value = 0
+
+        r = self._app.post("/make/publish")
+        r = self.get_encoded(r.location, **{"Accept-Encoding": "gzip"})
+        assert r.headers["Content-Encoding"] == "gzip"
+        body = gzip.decompress(r.body).decode()
+        assert "<span> line 99</span>" in body
+
+    @patch("subprocess.Popen")
+    def test_make_publish_failure(self, popen):
+        cmd = popen.return_value
+        cmd.stdout = BytesIO(b"")
+        cmd.wait.return_value = 2
+
+        r = self._app.post("/make/publish").follow()
+        assert r.status == "200 OK"
+        assert "make publish failed with exit status 2" in r
+
+    @patch("subprocess.Popen")
+    def test_metrics(self, popen):
+        popen.return_value.stdout = BytesIO(b"")
+        popen.return_value.wait.return_value = 2
+        self._app.post("/edit/m.rst", {"file_contents": "x" * 2000})
+        self._app.get("/edit/m.rst")
+        job_id = self._app.post("/make/publish").headers["X-Build-Id"]
+        shoebill.build_queue.get(int(job_id)).wait()
+
+        r = self._app.get("/metrics")
+        assert r.content_type == "text/plain"
+        lines = r.text.splitlines()
+        assert "# TYPE shoebill_http_request_duration_seconds histogram" in lines
+        for line in (
+            'shoebill_http_requests_total{route="/edit/<path:path>",'
+            'method="GET",status="200"}',
+            'shoebill_http_requests_total{route="/make/<target>",'
+            'method="POST",status="303"}',
+            'shoebill_make_runs_total{target="publish",exit_code="2"}',
+            'shoebill_make_duration_seconds_count{target="publish"}',
+            'shoebill_file_write_bytes_bucket{le="1024.0"}',
+            'shoebill_file_read_bytes_count',
+        ):
+            assert any(l.startswith(line + " ") for l in lines), line
+
+    def test_metrics_auth(self):
+        aaa = Mock()
+        aaa.require.side_effect = shoebill.AuthException()
+        with patch("shoebill.aaa", aaa), patch("shoebill.metrics_token", "s3cret"):
+            self._app.get("/metrics", status=401)
+            headers = {"Authorization": "Bearer wrong"}
+            self._app.get("/metrics", headers=headers, status=401)
+            headers = {"Authorization": "Bearer s3cret"}
+            self._app.get("/metrics", headers=headers, status=200)
+
+    def test_make_unknown_target(self):
+        r = self._app.post("/make/clean")
+        assert "Unknown make target" in r
+
+    def test_unknown_build(self):
+        r = self._app.get("/builds/12345")
+        assert "Unknown build" in r
+        self._app.get("/builds/12345/status", status=404)
+
 
 class TestWebappWithGitRepo(PelicanDirSetup):
     """Functional tests with Git repo"""
@@ -174,8 +819,356 @@ class TestWebappWithGitRepo(PelicanDirSetup):
         )
         assert r.status == "200 OK"
         assert "Saved." in r
-        assert shoebill.git_repo.is_dirty.called
-        assert shoebill.git_repo.git.add.called
-        shoebill.git_repo.git.add.assert_called_once_with(
-            "%s/content/hi.rst" % self._site_path
+        shoebill.git_repo.is_dirty.assert_called_once_with(
+            index=True, working_tree=False, path="content/hi.rst"
+        )
+        shoebill.git_repo.git.add.assert_called_once_with("content/hi.rst")
+        shoebill.git_repo.git.commit.assert_called_once_with(
+            "--", "content/hi.rst", m="blah"
+        )
+
+    def test_write_unchanged_file_with_git(self):
+        open(os.path.join(shoebill.content_path, "hi.rst"), "w").close()
+        shoebill.git_repo.is_dirty.return_value = False
+        r = self._app.post("/edit/hi.rst", {"file_contents": ""})
+        assert "No changes to be saved!" in r
+        assert not shoebill.git_repo.git.commit.called
+
+
+class TestWebappWithRealGitRepo(PelicanDirSetup):
+    """Functional tests with an actual Git repo"""
+
+    in_process = False
+
+    def setUp(self):
+        self.dir_setup()
+        subprocess.check_call(["git", "init", "-q", self._site_path])
+        for k, v in (("user.name", "Tester"), ("user.email", "tester@example.com")):
+            subprocess.check_call(["git", "-C", self._site_path, "config", k, v])
+        shoebill.setup_git_repo(
+            self._site_path, untracked_cache=True, in_process=self.in_process
+        )
+        self.webapp_setup()
+
+    def tearDown(self):
+        self.dir_teardown()
+        shoebill.git_repo = None
+        shoebill.git_ops = shoebill.SubprocessGit()
+        shoebill.git_lock.path = None
+        self.webapp_teardown()
+
+    def _git_log(self):
+        try:
+            out = subprocess.check_output(
+                ["git", "-C", self._site_path, "log", "--format=%s", "--name-only"],
+                stderr=subprocess.DEVNULL,
+            )
+        except subprocess.CalledProcessError:
+            # no commits yet
+            return []
+        return out.decode().split()
+
+    def test_write_commits_only_the_saved_file(self):
+        with open(os.path.join(self._site_path, "content", "other.rst"), "w") as f:
+            f.write("unrelated")
+        subprocess.check_call(
+            ["git", "-C", self._site_path, "add", "content/other.rst"]
+        )
+
+        r = self._app.post("/edit/hi.rst", {"file_contents": "one", "desc": "first"})
+        assert "Saved." in r
+        assert self._git_log() == ["first", "content/hi.rst"]
+
+        r = self._app.post("/edit/hi.rst", {"file_contents": "one", "desc": "again"})
+        assert "No changes to be saved!" in r
+        assert self._git_log() == ["first", "content/hi.rst"]
+
+    def test_git_metrics(self):
+        commits = shoebill.git_duration.labels("commit")
+        count = commits.count
+        self._app.post("/edit/hi.rst", {"file_contents": "one", "desc": "first"})
+        assert commits.count == count + 1
+        assert shoebill.git_duration.labels("add").count
+        assert shoebill.git_duration.labels("is_dirty").count
+
+    @patch("shoebill.spawn_make")
+    def test_group_commit_before_build(self, spawn_make):
+        spawn_make.return_value.stdout = BytesIO(b"")
+        spawn_make.return_value.wait.return_value = 0
+        shoebill.committer = shoebill.GroupCommitter(delay=3600)
+        try:
+            r = self._app.post("/edit/a.rst", {"file_contents": "a", "desc": "A"})
+            assert "Saved, commit pending." in r
+            self._app.post("/edit/b.rst", {"file_contents": "b", "desc": "B"})
+            assert self._git_log() == []
+
+            self._app.post("/make/publish").follow()
+            log = self._git_log()
+            assert log[:3] == ["Update", "2", "files"], log
+            assert log[-2:] == ["content/a.rst", "content/b.rst"], log
+        finally:
+            shoebill.committer = shoebill.GroupCommitter()
+
+    @patch("shoebill.spawn_make")
+    def test_save_during_build(self, spawn_make):
+        started = threading.Event()
+        release = threading.Event()
+
+        def make(target, changed_files=None, changed_list=None):
+            started.set()
+            release.wait(5)
+            return Mock(stdout=BytesIO(b""), **{"wait.return_value": 0})
+
+        spawn_make.side_effect = make
+        shoebill.build_queue._changed["publish"] = set()
+        shoebill.build_queue._built.add("publish")
+        job = shoebill.build_queue.submit("publish")
+        try:
+            assert started.wait(5)
+            # Saves do not wait for make to end
+            r = self._app.post("/edit/a.rst", {"file_contents": "a", "desc": "A"})
+            assert "Saved." in r
+            assert job.state == "running"
+            assert self._git_log() == ["A", "content/a.rst"]
+        finally:
+            release.set()
+        job.wait(5)
+        assert spawn_make.call_args[0][1] == []
+        # Built by the next run
+        assert shoebill.build_queue._changed["publish"] == {"content/a.rst"}
+
+    def test_concurrent_saves(self):
+        def save(name, n):
+            self._app.post("/edit/%s" % name, {"file_contents": n, "desc": n})
+
+        threads = [
+            threading.Thread(target=save, args=(name, n))
+            for n in range(8)
+            for name in ("same.rst", "f%d.rst" % n)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # The worktree, the index and HEAD agree
+        status = subprocess.check_output(
+            ["git", "-C", self._site_path, "status", "--porcelain", "content"]
         )
+        assert status == b"", status
+        assert len(self._git_log()) > 16
+
+    def test_history_and_diff(self):
+        self._app.post("/edit/hi.rst", {"file_contents": "one\n", "desc": "first"})
+        self._app.post("/edit/hi.rst", {"file_contents": "two\n", "desc": "second"})
+        r = self._app.get("/history/hi.rst")
+        assert "Tester: second" in r
+        assert "Tester: first" in r
+        assert "older" not in r
+
+        sha = shoebill.git_repo.head.commit.hexsha
+        r = self._app.get("/diff/hi.rst", {"rev": sha[:10]})
+        assert '<span class="errorline">-one</span>' in r
+        assert '<span class="addedline">+two</span>' in r
+
+    def test_history_is_cached_by_head(self):
+        self._app.post("/edit/hi.rst", {"file_contents": "one\n", "desc": "first"})
+        self._app.get("/history/hi.rst")
+        with patch.object(shoebill.git_repo, "iter_commits") as iter_commits:
+            iter_commits.side_effect = Exception("Unexpected call")
+            assert "Tester: first" in self._app.get("/history/hi.rst")
+
+        self._app.post("/edit/hi.rst", {"file_contents": "two\n", "desc": "second"})
+        assert "Tester: second" in self._app.get("/history/hi.rst")
+
+    def test_history_pagination(self):
+        with patch("shoebill.HISTORY_PAGE_SIZE", 1):
+            for n in range(3):
+                self._app.post("/edit/hi.rst", {"file_contents": str(n), "desc": n})
+            r = self._app.get("/history/hi.rst", {"page": "2"})
+            assert "Tester: 1" in r
+            assert "Tester: 2" not in r
+            assert "?page=1" in r
+            assert "?page=3" in r
+
+    def test_diff_bad_revision(self):
+        self._app.post("/edit/hi.rst", {"file_contents": "one\n", "desc": "first"})
+        assert "Invalid revision" in self._app.get("/diff/hi.rst", {"rev": "HEAD"})
+        assert "Unknown revision" in self._app.get("/diff/hi.rst", {"rev": "abcd1234"})
+
+    def test_api_commits(self):
+        self._app.put("/api/files/a.rst?desc=add", b"a", status=201)
+        assert self._git_log() == ["add", "content/a.rst"]
+        self._app.put("/api/files/a.rst?desc=again", b"a")
+        self._app.delete("/api/files/a.rst?desc=remove", status=204)
+        assert self._git_log()[:2] == ["remove", "content/a.rst"]
+        status = subprocess.check_output(
+            ["git", "-C", self._site_path, "status", "--porcelain"]
+        )
+        assert status == b"", status
+
+    def test_api_delete_untracked_file(self):
+        open(os.path.join(shoebill.content_path, "a.rst"), "w").close()
+        self._app.delete("/api/files/a.rst", status=204)
+        assert self._git_log() == []
+
+    def test_bulk_import_single_commit(self):
+        self._app.post("/edit/a.rst", {"file_contents": "a", "desc": "first"})
+        files = {"a.rst": b"a", "b.rst": b"b", "pages/c.rst": b"c"}
+        r = self._app.post(
+            "/bulk?desc=import", make_tar(files), content_type="application/x-tar"
+        )
+        assert r.json["committed"] is True
+        log = self._git_log()
+        assert log[:3] == ["import", "content/b.rst", "content/pages/c.rst"], log
+        assert log[3:] == ["first", "content/a.rst"]
+
+    def test_bulk_import_incomplete_body(self):
+        body = make_tar({"a.rst": b"a", "b.rst": b"b" * 100000})
+        req = Request.blank("/bulk", method="POST", content_type="application/x-tar")
+        req.environ["REMOTE_ADDR"] = "127.0.0.1"
+        req.environ["CONTENT_LENGTH"] = str(len(body))
+        req.environ["wsgi.input"] = BytesIO(body[:50000])
+        r = req.get_response(self._wsgi_app)
+        assert r.status_code == 400
+        assert r.json["error"] == "Invalid archive: Incomplete request body"
+        assert r.json["files"] == [{"path": "a.rst", "status": "created"}]
+        # What has been written is committed
+        assert r.json["committed"] is True
+        assert self._git_log() == ["Import", "1", "files", "content/a.rst"]
+        assert not os.path.exists(os.path.join(shoebill.content_path, "b.rst"))
+
+    def test_git_config_environment(self):
+        env = shoebill.git_repo.git._environment
+        assert env["GIT_CONFIG_COUNT"] == "1"
+        assert env["GIT_CONFIG_KEY_0"] == "core.untrackedCache"
+
+
+class TestWebappWithRealGitRepoInProcess(TestWebappWithRealGitRepo):
+    """Functional tests with an actual Git repo, without running git"""
+
+    in_process = True
+
+    def test_index_matches_head(self):
+        self._app.post("/edit/hi.rst", {"file_contents": "one", "desc": "first"})
+        self._app.post("/edit/hi.rst", {"file_contents": "two", "desc": "second"})
+        status = subprocess.check_output(
+            ["git", "-C", self._site_path, "status", "--porcelain"]
+        )
+        assert status == b"", status
+        assert self._git_log()[:2] == ["second", "content/hi.rst"]
+
+    def test_no_git_processes(self):
+        self._app.post("/edit/hi.rst", {"file_contents": "one", "desc": "first"})
+        with patch("subprocess.Popen") as popen:
+            popen.side_effect = Exception("Unexpected call to git")
+            self._app.post("/edit/hi.rst", {"file_contents": "two", "desc": "second"})
+        assert self._git_log()[:2] == ["second", "content/hi.rst"]
+
+    def test_no_chdir(self):
+        os.symlink("hi.rst", os.path.join(shoebill.content_path, "link.rst"))
+        self._app.post("/edit/hi.rst", {"file_contents": "one", "desc": "first"})
+        with patch("os.chdir", side_effect=Exception("Unexpected chdir")):
+            self._app.post("/edit/hi.rst", {"file_contents": "two", "desc": "second"})
+            shoebill.commit_files([shoebill.Path(relurl="link.rst")], "link")
+        assert self._git_log()[:2] == ["link", "content/link.rst"]
+        status = subprocess.check_output(
+            ["git", "-C", self._site_path, "status", "--porcelain"]
+        )
+        assert status == b"", status
+        subprocess.check_call(["git", "-C", self._site_path, "fsck", "--strict"])
+
+    def test_commit_in_subdir(self):
+        self._app.post("/edit/pages/a.rst", {"file_contents": "a", "desc": "A"})
+        self._app.post("/edit/b.rst", {"file_contents": "b", "desc": "B"})
+        tree = subprocess.check_output(
+            ["git", "-C", self._site_path, "ls-tree", "-r", "--name-only", "HEAD"]
+        )
+        assert tree.split() == [b"content/b.rst", b"content/pages/a.rst"]
+        subprocess.check_call(["git", "-C", self._site_path, "fsck", "--strict"])
+
+
+class TestPreforkServer(object):
+    """Run the server with worker processes on a site with a Git repo"""
+
+    def setUp(self):
+        self._site_path = mkdtemp()
+        os.mkdir(os.path.join(self._site_path, "content"))
+        subprocess.check_call(["git", "init", "-q", self._site_path])
+        for k, v in (("user.name", "Tester"), ("user.email", "tester@example.com")):
+            subprocess.check_call(["git", "-C", self._site_path, "config", k, v])
+        with open(os.path.join(self._site_path, "Makefile"), "w") as f:
+            f.write("html:\n\techo built\n")
+
+        with socket.socket() as s:
+            s.bind(("localhost", 0))
+            self._port = s.getsockname()[1]
+
+        self._tmpdir = os.path.join(self._site_path, "tmp")
+        os.mkdir(self._tmpdir)
+        env = dict(
+            os.environ,
+            PYTHONPATH=os.path.dirname(shoebill.__path__[0]),
+            TMPDIR=self._tmpdir,
+        )
+        cmd = [sys.executable, "-c", "import shoebill; shoebill.main()"]
+        cmd += ["--no-auth", "--workers", "3", "--threads", "2", "-t", "html"]
+        cmd += ["-p", str(self._port), self._site_path]
+        self._server = subprocess.Popen(
+            cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        for _ in range(100):
+            try:
+                socket.create_connection(("localhost", self._port)).close()
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.1)
+
+    def tearDown(self):
+        if self._server.poll() is None:
+            self._server.terminate()
+            self._server.wait()
+        shutil.rmtree(self._site_path)
+
+    def _request(self, method, url, body=None):
+        conn = http.client.HTTPConnection("localhost", self._port, timeout=10)
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        conn.request(method, url, body, headers)
+        resp = conn.getresponse()
+        return resp, resp.read()
+
+    def test_concurrent_saves(self):
+        def save(n):
+            body = "file_contents=%d&desc=save+%d" % (n, n)
+            resp, _ = self._request("POST", "/edit/f%d.rst" % n, body)
+            assert resp.status == 200
+
+        threads = [threading.Thread(target=save, args=(n,)) for n in range(12)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        log = subprocess.check_output(
+            ["git", "-C", self._site_path, "log", "--format=%s"]
+        )
+        assert sorted(log.split(b"\n")[:-1]) == sorted(
+            b"save %d" % n for n in range(12)
+        )
+
+    def test_build_served_by_any_worker(self):
+        resp, _ = self._request("POST", "/make/html")
+        assert resp.status == 303
+        job_id = resp.getheader("X-Build-Id")
+        for _ in range(6):
+            resp, body = self._request("GET", "/builds/%s" % job_id)
+            assert resp.status == 200
+            assert b"built" in body
+
+    def test_shutdown(self):
+        resp, _ = self._request("GET", "/edit/")
+        assert resp.status == 200
+        self._server.send_signal(signal.SIGTERM)
+        assert self._server.wait(15) == 0
+        # The run dir has been removed
+        assert os.listdir(self._tmpdir) == []